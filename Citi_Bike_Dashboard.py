@@ -13,12 +13,17 @@ import numpy as np
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import matplotlib.pyplot as plt
+import os
 from streamlit_plotly_events import plotly_events
 from datetime import datetime as dt
 from numerize.numerize import numerize
 from PIL import Image
+from citibike.downsample import downsample, window
+from citibike import registry, query, snapshot, sketches, profiles, maps, flows, rolling, anomalies, simulate, inventory, zones, network, coverage, incentives
+from citibike.live_feed import StationStatusFeed, drain
+from citibike.refresh import Refresher
 
-# Kepler no longer needed since maps are embedded as html and Kepler causes Streamlit deployment issues.
+# Kepler no longer needed since maps are drawn with deck.gl (pydeck) and Kepler causes Streamlit deployment issues.
 # Removed:
 # from streamlit_keplergl import keplergl_static  
 # from keplergl import KeplerGl
@@ -50,17 +55,243 @@ page = st.sidebar.selectbox(' ',
    "5. Daily Distribution: Weekday vs Weekend",
    "6. Imbalance of Arrivals vs Departures",
    "7. Most Popular Routes",
-   "8. Recommendations"])
+   "8. Trip Durations",
+   "9. Ad-hoc Query",
+   "10. Recommendations"])
 
 
 ############################## Import data #########################################
 
+# Datasets are registered per city and year in data/manifest.json.  Only the tables a page
+# actually uses are read, and only for the selected partition, so memory does not grow as
+# more cities and years are added.  The cache keeps a handful of recently used tables.
+# Tables are read into compact types (repeated names as categoricals, 32-bit counts, float32
+# coordinates; see registry.COLUMN_TYPES), and python -m citibike.registry --memory reports the savings.
+#
+# When an aggregate snapshot has been activated (python -m citibike.snapshot build --activate)
+# tables are memory-mapped from it instead, which shares them between all Streamlit processes.
+# The version is part of the cache key so activating a new snapshot is picked up on the next run.
+#
+# A background refresher (one per server process) rebuilds the snapshot whenever the registered
+# tables change; a build lock lets only one process on the host do the work.  Sessions keep reading the previous snapshot until the new one has been built,
+# validated and warmed, and are then re-run to show the new data.
 
+def warm_snapshot(version):
+    # Open every table once so the new files are in the page cache before anyone needs them
+    for entry in registry.load_manifest()['datasets']:
+        for table in entry['tables']:
+            snapshot.load_table(version, entry['city'], entry['year'], table)
+
+
+@st.cache_resource
+def aggregate_refresher():
+    refresher = Refresher(interval = 60, warm = warm_snapshot)
+    refresher.start()
+    return refresher
+
+
+refresher = aggregate_refresher()
+
+manifest = registry.load_manifest()
+snapshot_version = snapshot.current_version()
+
+st.session_state['data_version'] = snapshot_version
+
+
+def check_for_new_data():
+    # Re-render this session once a newer snapshot has been activated
+    if refresher.version != st.session_state['data_version']:
+        st.session_state['data_version'] = refresher.version
+        st.rerun()
+
+
+if hasattr(st, 'fragment'):
+    with st.sidebar:
+        st.fragment(run_every = 15)(check_for_new_data)()
+
+city_names = registry.cities(manifest)
+city = st.sidebar.selectbox('City', list(city_names), format_func = lambda c: city_names[c])
+year = st.sidebar.selectbox('Year', registry.years(manifest, city)[::-1])
+dataset = registry.find(manifest, city, year)
+
+
+@st.cache_resource(max_entries = 8)
+def load_snapshot_table(version, city, year, table):
+    return snapshot.load_table(version, city, year, table)
+
+
+@st.cache_data(max_entries = 8)
+def load_csv_table(city, year, table):
+    return registry.load_table(registry.find(manifest, city, year), table)
+
+
+def load_table(city, year, table):
+    if snapshot_version:
+        df = load_snapshot_table(snapshot_version, city, year, table)
+        if df is not None:
+            return df
+    return load_csv_table(city, year, table)
+
+
+@st.cache_data(max_entries = 4)
+def load_zone_outlines(city, year):
+    # Rebalancing zone boundaries (python -m citibike.zones) for the station and route maps
+    return zones.outlines(load_table(city, year, 'zones'))
+
+
+@st.cache_resource(max_entries = 4)
+def load_travel_matrix(city, year):
+    # Station-to-station street distances and cycling times (python -m citibike.network)
+    path = network.matrix_path(registry.find(manifest, city, year))
+    return network.TravelMatrix(path) if os.path.isdir(path) else None
+
+
+@st.cache_data(max_entries = 4)
+def load_rider_speeds(city, year):
+    return network.rider_speeds(query.trips_path(registry.find(manifest, city, year)), load_travel_matrix(city, year))
+
+
+@st.cache_resource(max_entries = 4)
+def load_incentive_model(city, year):
+    # Trip matrix and nearby station pairs for the incentive what-if on page 6
+    return incentives.IncentiveModel(load_table(city, year, 'routes'))
+
+
+@st.cache_data(max_entries = 4)
+def coverage_surface(city, year, n_sites):
+    # Distance to the nearest station as a map image, and the best sites for new stations once they have
+    # been ranked against a population/transit layer (python -m citibike.coverage --weights ...)
+    grid, distance, weight, sites = coverage.analyse(load_table(city, year, 'start_stations'), n_sites = n_sites)
+    if registry.has_table(registry.find(manifest, city, year), 'expansion_sites'):
+        sites = load_table(city, year, 'expansion_sites').head(n_sites)
+    image = coverage.surface_image(distance, weight)
+    return grid.bounds(), coverage.image_url(image), sites, coverage.coverage_share(distance, weight)
+
+
+def zone_toggle(key):
+    if not registry.has_table(dataset, 'zones'):
+        return False
+    return st.checkbox('Show rebalancing zones', key = key)
+
+
+############################## Station detail ######################################
+
+# Clicking a station on the bar charts or maps of pages 3 and 6 opens this detail view.  It is
+# read from the precomputed station profile store (python -m citibike.profiles), so showing a
+# station is a lookup of one row per array rather than a filter over the trip data.
+
+@st.cache_resource(max_entries = 4)
+def load_profiles(city, year):
+    path = profiles.profiles_path(registry.find(manifest, city, year))
+    return profiles.StationProfiles(path) if os.path.isdir(path) else None
+
+
+@st.cache_data(max_entries = 512)
+def weekly_grid(city, year, station, months, direction):
+    # Day of week x hour grid for one station (or all when None); kept so switching back is instant
+    return load_profiles(city, year).weekly(station, range(months[0], months[1] + 1), direction)
+
+
+@st.cache_resource(max_entries = 4)
+def load_inventory(city, year):
+    path = inventory.inventory_path(registry.find(manifest, city, year))
+    return inventory.StationInventory(path) if os.path.isdir(path) else None
+
+
+def station_detail(station):
+
+    profile_store = load_profiles(city, year)
+    if profile_store is None or station not in profile_store:
+        st.info(f"No detailed profile is available for {station}.")
+        return
+
+    st.markdown(f"### {station}")
+
+    net = profile_store.net(station)
+    st.metric('Net imbalance (arrivals - departures)', f"{net:+,}")
+
+    # Hourly weekday/weekend profiles
+    df_hourly = profile_store.hourly(station)
+    fig_hourly = make_subplots(cols = 2, shared_yaxes = True, subplot_titles = ['Weekday', 'Weekend'])
+    for i, day_type in enumerate(['Weekday', 'Weekend'], start = 1):
+        for direction, color in [('Departures', '#fdae61'), ('Arrivals', '#2c7bb6')]:
+            df_subset = df_hourly[(df_hourly['day_type'] == day_type) & (df_hourly['direction'] == direction)]
+            fig_hourly.add_trace(
+                go.Bar(x = df_subset['hour'], y = df_subset['trips'], name = direction,
+                       marker = dict(color = color), showlegend = (i == 1)),
+                row = 1, col = i)
+
+    fig_hourly.update_layout(
+        title = 'Average Trips by Hour',
+        barmode = 'group',
+        plot_bgcolor = '#2b2b2b',
+        paper_bgcolor = '#2b2b2b',
+        font = dict(color = 'white'),
+        height = 350)
+    fig_hourly.update_xaxes(title_text = 'Hour of Day', tickvals = list(range(0, 24, 2)), gridcolor = '#444')
+    fig_hourly.update_yaxes(gridcolor = '#444')
+    st.plotly_chart(fig_hourly, use_container_width = True)
+
+    chart_column, table_column = st.columns([2, 1])
+
+    # Daily departures through the year
+    with chart_column:
+        df_station_daily = profile_store.daily(station)
+        fig_station_daily = go.Figure(go.Scattergl(
+            x = df_station_daily['date'], y = df_station_daily['departures'], line = dict(color = '#fdae61')))
+        fig_station_daily.update_layout(
+            title = 'Daily Departures',
+            plot_bgcolor = '#2b2b2b',
+            paper_bgcolor = '#2b2b2b',
+            font = dict(color = 'white'),
+            height = 350)
+        fig_station_daily.update_xaxes(gridcolor = '#444')
+        fig_station_daily.update_yaxes(gridcolor = '#444')
+        st.plotly_chart(fig_station_daily, use_container_width = True)
+
+    # Most common destinations
+    with table_column:
+        st.markdown("**Top destinations**")
+        st.dataframe(profile_store.destinations(station).rename(columns = {'destination': 'Destination', 'trips': 'Trips'}),
+                     use_container_width = True, hide_index = True)
+
+    # Bikes at the station through the year, rebuilt from its trips (python -m citibike.inventory)
+    inventory_store = load_inventory(city, year)
+    if inventory_store is None or station not in inventory_store:
+        return
+
+    capacity = inventory_store.capacity(station)
+    df_bikes = downsample(inventory_store.hourly(station), 'time', 'bikes', 1500, method = 'minmax')
+    df_moved = inventory_store.rebalancing(station)
+
+    fig_inventory = make_subplots(rows = 2, shared_xaxes = True, row_heights = [0.7, 0.3], vertical_spacing = 0.05)
+    fig_inventory.add_trace(
+        go.Scattergl(x = df_bikes['time'], y = df_bikes['bikes'], name = 'Bikes docked',
+                     line = dict(color = 'white', width = 1, shape = 'hv')),
+        row = 1, col = 1)
+    fig_inventory.add_hline(y = capacity, line_dash = 'dash', line_color = '#888',
+                            annotation_text = f'Estimated capacity ({capacity})', row = 1, col = 1)
+    fig_inventory.add_trace(
+        go.Bar(x = df_moved['date'], y = df_moved['dropoffs'], name = 'Bikes dropped off', marker = dict(color = '#2c7bb6')),
+        row = 2, col = 1)
+    fig_inventory.add_trace(
+        go.Bar(x = df_moved['date'], y = -df_moved['pickups'], name = 'Bikes picked up', marker = dict(color = '#fdae61')),
+        row = 2, col = 1)
+
+    fig_inventory.update_layout(
+        title = 'Bikes Docked and Implied Rebalancing',
+        barmode = 'relative',
+        plot_bgcolor = '#2b2b2b',
+        paper_bgcolor = '#2b2b2b',
+        font = dict(color = 'white'),
+        height = 450)
+    fig_inventory.update_xaxes(gridcolor = '#444')
+    fig_inventory.update_yaxes(gridcolor = '#444')
+    st.plotly_chart(fig_inventory, use_container_width = True)
+    st.caption("The station is assumed to start the year half full.  Whenever its trips alone would leave it below "
+               "empty or above its estimated number of docks, bikes must have been dropped off or picked up without a "
+               "trip; the lower panel shows the fewest such moves that explain the trips.")
 
-df_daily = pd.read_csv('daily_trips_temp.csv', index_col = 0)
-start_stations = pd.read_csv('start_stations.csv', index_col = 0)
-df_avg_day = pd.read_csv('avg_day.csv', index_col = 0)
-station_counts_to_graph = pd.read_csv('station_imbalance_to_graph.csv', index_col = 0)
 
 ####################################################################################
 ############################### 1. Introduction ####################################
@@ -107,14 +338,66 @@ elif page == "2. Distribution of Stations Throughout NYC":
     st.markdown("## Distribution of stations throughout NYC")
     st.markdown("We start off by looking at how the stations are distributed throughout New York City across Manhattan as well as the outer boroughs.")
     st.markdown("The map has been rotated in order to see the full the distribution across the screen.  Each dot represents one of over 1700 Citi Bike stations in New York City with the color of each dot determined by the number of departures made from that station. Orange colours signify more departures from the station and the blue colours, fewer departures.")
-    st.markdown("Click on the legend to see details of the colour scale or manipulate the map using the controls.")
-
-    # Insert the start_stations interactive Kepler map
-    path_to_html = "start_stations_v3.html"
-    with open(path_to_html, 'r') as f:
-        html_data = f.read()
-
-    st.components.v1.html(html_data, height =450)
+    st.markdown("Hover over a station for its number of departures, or switch to the density view to see where departures are concentrated.")
+
+    # Station map drawn with deck.gl from the station table, styled from the Kepler map config
+    map_config = maps.load_map_config()
+    start_stations = load_table(city, year, 'start_stations')
+
+    density_view = st.toggle('Density view') if hasattr(st, 'toggle') else st.checkbox('Density view')
+
+    # Station types (python -m citibike.typology) colour the stations by how they are used instead, and the
+    # coverage view shades the walking distance to the nearest station with the best sites for new ones
+    views = ['Departures'] + (['Station type'] if registry.has_table(dataset, 'typology') else []) + ['Coverage gaps']
+    view = 'Departures' if density_view else st.radio('Colour stations by', views, horizontal = True)
+    type_view = view == 'Station type'
+
+    if density_view:
+        tooltip = {'text': '{elevationValue} departures'}
+        layers = maps.station_layers(start_stations, map_config, hexagons = True)
+    elif view == 'Coverage gaps':
+        has_sites = registry.has_table(dataset, 'expansion_sites')
+        n_sites = st.slider('Candidate sites', min_value = 5, max_value = 50, value = 20, step = 5) if has_sites else 0
+        bounds, surface_url, df_sites, share = coverage_surface(city, year, n_sites)
+        tooltip = {'text': '{station_name}\n{label}'}
+        layers = (maps.image_layer(surface_url, bounds) +
+                  maps.category_layer(start_stations.assign(label = 'Existing station'), map_config,
+                                      colors = {'Existing station': [255, 255, 255]}) +
+                  maps.site_layer(df_sites))
+        st.markdown(' &nbsp; '.join(f"<span style='color:rgb({r},{g},{b})'>■</span> {label}" for label, (r, g, b) in
+                                    [('300-600 m', (254, 224, 139)), ('600 m - 1 km', (253, 174, 97)),
+                                     ('over 1 km', (215, 48, 39))]) +
+                    f" &nbsp; to the nearest station.  {share:.0%} of the area around the network is within a 300 m walk.",
+                    unsafe_allow_html = True)
+    elif type_view:
+        df_typology = load_table(city, year, 'typology')
+        df_typed = start_stations.merge(df_typology[['station', 'label']], how = 'left',
+                                        left_on = 'station_name', right_on = 'station')
+        df_typed['label'] = df_typed['label'].astype(object).fillna('Low use')
+        tooltip = {'text': '{station_name}\n{label}'}
+        layers = maps.category_layer(df_typed, map_config)
+        st.markdown(' &nbsp; '.join(f"<span style='color:rgb({r},{g},{b})'>●</span> {label}"
+                                    for label, (r, g, b) in maps.TYPE_COLORS.items()), unsafe_allow_html = True)
+    else:
+        tooltip = {'text': '{station_name}\n{value} departures'}
+        layers = maps.station_layers(start_stations, map_config)
+
+    if zone_toggle('station_map_zones'):
+        layers = maps.zone_layer(load_zone_outlines(city, year)) + layers
+
+    st.pydeck_chart(maps.deck(layers, maps.view_state(map_config), tooltip))
+
+    if view == 'Coverage gaps':
+        st.caption("Distances are measured in a straight line from every 50 m square to the nearest station, within "
+                   f"{coverage.REACH / 1000:.1f} km of the network, so rivers are shaded too.  " +
+                   ("Candidate sites are picked one at a time, each where a new station would put the most population "
+                    "and transit stops not yet near a station within a 300 m walk." if has_sites else
+                    "Sites for new stations are ranked once a population or transit layer has been added "
+                    "(`python -m citibike.coverage --weights`)."))
+    if type_view:
+        st.caption("Stations are grouped by the shape of their weekday and weekend hourly departures and arrivals. "
+                   "Commuter origins lose bikes in the morning rush and get them back in the evening, commuter "
+                   "destinations do the opposite, and leisure stations are busier at the weekend than on weekdays.")
 
     st.markdown("##### **Analysis**")
     st.markdown("The densist cluster of yellow/orange stations shows that Manhattan is extremely well-served with stations spread throughout, especially in Midtown and Lower Manhattan.  North of Central Park the usage begins to decrease and coverage starts to thin out through Harlem, Upper Manhatan and Washington Heights.  Over the Harlem river, the Bronx we also see usage but on a smaller scale with coverage coming to an end at Mosholu Parkway.")
@@ -142,11 +425,12 @@ elif page == "3. Most Popular Stations":
 
     st.markdown("## Most popular stations")
 
-    st.markdown("With over 1700 stations distributed throughout the city and possibilities for future expansion, we now turn our attention to the busiest of these stations.  The figure below shows the top 20 most-used stations in New York City and their locations. Hover over the chart or graph for specific departure counts.")
+    st.markdown("With over 1700 stations distributed throughout the city and possibilities for future expansion, we now turn our attention to the busiest of these stations.  The figure below shows the top 20 most-used stations in New York City and their locations. Hover over the chart or graph for specific departure counts, or click on a station for a detailed profile.")
 
 
 # Map of top 20 stations and bar chart together using subplots.  Seeing the locations of the stations in the graph makes this a lot more meaningful to the reader.
     
+    start_stations = load_table(city, year, 'start_stations')
     top20_stations = start_stations.head(20)
 
     fig = make_subplots(
@@ -241,7 +525,15 @@ elif page == "3. Most Popular Stations":
         margin=dict(l=40, r=40, t=100, b=150)
     )
           
-    st.plotly_chart(fig, use_container_width = True)
+    # Clicking a bar or a map marker opens the station detail below the chart
+    clicked = plotly_events(fig, click_event = True, override_height = 600)
+    if clicked:
+        point = clicked[0]
+        st.session_state['station_detail'] = (point['x'] if point['curveNumber'] == 0
+                                              else top20_stations['station_name'].iloc[point['pointNumber']])
+
+    if st.session_state.get('station_detail') in set(top20_stations['station_name']):
+        station_detail(st.session_state['station_detail'])
 
     st.markdown("##### **Analysis**")
     st.markdown("Perhaps unsurprisingly given the distribution of stations on the previous page, the top 20 most-used stations all lie in Manhattan with clusters in Midtown and Lower Manhattan.  These are the core business and commercial districts with of these stations lying on or near major north-south avenues for commuter routes. The most popular station for starting journeys with over 128,000 departures is at W 21st & 6th Ave near the Chelsea/Flatiron district.  This area is a major transit hub and destination sitting near offices, residential areas and attractions, acting as a gateway to and from the Flatiron district, Madison Square Park, Union Square and numerous tech and office buildings.")
@@ -251,6 +543,26 @@ elif page == "3. Most Popular Stations":
     st.markdown("The station at Broadway & W 58th Street is adjacent to Central Park, a major attraction for both tourists and local residents for recreational bike rides.  With 114,000 departures,  this station also serves the nearby theatre district and with the surrounding neighborhood consisting of residential buildings, hotels and office spaces, there is a constant flow of people in the area day and night.")
 
     st.markdown("There is some consistency in the usage of the rest of the top 20 with these stations scattered throughout Manhattan with a clear drop-off after the top 3 stations.  The top station has 40% more departures than the 20th station showing concentrated demand.  A possible implication of this could be that heavy reliance on a few key stations creates the potential for overcrowding.")
+
+    # Top stations and routes for any period, answered from the monthly heavy-hitter summaries
+    if registry.has_table(dataset, 'heavy_hitters'):
+        st.markdown("##### **Busiest stations and routes by period**")
+        st.markdown("Choose a range of months to see which stations and routes were busiest over that period.  The counts come from compact summaries kept for each month, so they can be combined over any period instantly.  Each count may be overstated by at most the error shown.")
+
+        heavy_hitters = load_table(city, year, 'heavy_hitters')
+
+        period_column, kind_column, k_column = st.columns(3)
+        first_month, last_month = period_column.select_slider(
+            'Months', options = list(range(1, 13)), value = (1, 12),
+            format_func = lambda m: dt(2000, m, 1).strftime('%b'))
+        kind = kind_column.radio('Show', ['station', 'route'], horizontal = True,
+                                 format_func = lambda k: 'Start stations' if k == 'station' else 'Routes')
+        k = k_column.slider('How many', min_value = 5, max_value = 50, value = 20, step = 5)
+
+        top = sketches.top_k(heavy_hitters, kind, list(range(first_month, last_month + 1)), k)
+        top = top.rename(columns = {'key': 'Start station' if kind == 'station' else 'Route',
+                                    'count': 'Trips', 'error': 'Possible overcount'})
+        st.dataframe(top, use_container_width = True, hide_index = True)
     
 
  
@@ -264,16 +576,31 @@ elif page == "4. Daily Trips and Temperature":
 
     st.markdown("## Daily Trips and Temperature")
 
-    st.markdown("Looking at the general usage of Citi Bike in New York throughout the year, we can see on the graph below how the daily number of trips (in orange) varied in 2022. Using a second y-axis we can also see the average daily temperature (in blue). Hover over the graph for details or use the controls to zoom in on specific sections.") 
+    st.markdown("Looking at the general usage of Citi Bike in New York throughout the year, we can see on the graph below how the daily number of trips (in orange) varied in 2022. Using a second y-axis we can also see the average daily temperature (in blue). Hover over the graph for details or use the date range slider to zoom in on specific sections.") 
 
     # Dual axis plot of trips and temperature.
+
+    # The chart is drawn with WebGL traces and the series are downsampled on the server to roughly
+    # one point per pixel, so the same code copes with hourly data over several years.  Narrowing
+    # the date range re-runs the downsampling on just that window, giving more detail when zoomed in.
+    chart_width_px = 1200
+
+    df_daily = load_table(city, year, 'daily')
+
+    first_date, last_date = df_daily['date'].min().to_pydatetime(), df_daily['date'].max().to_pydatetime()
+    date_range = st.slider('Date range', min_value = first_date, max_value = last_date,
+                           value = (first_date, last_date), format = 'YYYY-MM-DD')
+
+    df_window = window(df_daily, 'date', *date_range)
+    trips_to_plot = downsample(df_window, 'date', 'no_of_trips', chart_width_px, method = 'lttb')
+    temp_to_plot = downsample(df_window, 'date', 'avgTemp', chart_width_px, method = 'minmax')
     
     fig_2 = make_subplots(specs = [[{"secondary_y": True}]])
 
     fig_2.add_trace(
-        go.Scatter(
-            x = df_daily['date'], 
-            y = df_daily['no_of_trips'], 
+        go.Scattergl(
+            x = trips_to_plot['date'], 
+            y = trips_to_plot['no_of_trips'], 
             name = 'Daily bike rides',
             line=dict(color='#fdae61')
         ),
@@ -281,9 +608,9 @@ elif page == "4. Daily Trips and Temperature":
     )
 
     fig_2.add_trace(
-        go.Scatter(
-            x = df_daily['date'],
-            y = df_daily['avgTemp'], 
+        go.Scattergl(
+            x = temp_to_plot['date'],
+            y = temp_to_plot['avgTemp'], 
             name = 'Daily temperature', 
             line=dict(color='#2c7bb6')
         ),
@@ -326,8 +653,140 @@ elif page == "4. Daily Trips and Temperature":
         zerolinecolor="#444",
         secondary_y = True)
 
+    # Days the online detector finds far from what the day type, season and temperature predict
+    df_anomalies = anomalies.daily_anomalies(df_daily, load_table(city, year, 'avg_day'))
+    df_flagged = window(df_anomalies[df_anomalies['anomaly']], 'date', *date_range)
+
+    fig_2.add_trace(
+        go.Scattergl(
+            x = df_flagged['date'],
+            y = df_flagged['no_of_trips'],
+            name = 'Unusual days',
+            mode = 'markers',
+            marker = dict(color = 'white', size = 9, symbol = 'circle-open', line = dict(width = 2)),
+            customdata = df_flagged[['expected', 'z']],
+            hovertemplate = '%{x|%a %d %b}<br>%{y:,} trips, %{customdata[0]:,.0f} expected (z = %{customdata[1]})<extra></extra>'
+        ),
+        secondary_y=False
+    )
+
+    for _, day in df_flagged.iterrows():
+        fig_2.add_annotation(
+            x = day['date'], y = day['no_of_trips'], yref = 'y',
+            text = day['date'].strftime('%d %b'),
+            showarrow = True, arrowcolor = 'white', ay = 30 if day['kind'] == 'Drop' else -30,
+            font = dict(color = 'white', size = 10))
+
     st.plotly_chart(fig_2, use_container_width=True)
 
+    with st.expander(f"Unusual days ({len(df_flagged)})"):
+        st.markdown("Each day is compared with what its day type (weekday or weekend, from the hourly profiles on page 5), the time of year and the temperature would predict. Days more than three standard deviations away are flagged.")
+        st.dataframe(
+            df_flagged.assign(day = df_flagged['date'].dt.strftime('%a %d %b'))[
+                ['day', 'kind', 'no_of_trips', 'expected', 'avgTemp', 'z']].rename(columns = {
+                'day': 'Day', 'kind': 'Type', 'no_of_trips': 'Trips', 'expected': 'Expected', 'avgTemp': 'Temperature °C'}),
+            use_container_width = True, hide_index = True)
+
+        if registry.has_table(dataset, 'anomalies'):
+            st.markdown("**Unusual hours by station**")
+            df_hours = window(load_table(city, year, 'anomalies'), 'hour', *date_range)
+            station_filter = st.selectbox('Station', [anomalies.SYSTEM] + sorted(set(df_hours['station']) - {anomalies.SYSTEM}))
+            df_hours = df_hours[df_hours['station'] == station_filter]
+            st.dataframe(df_hours.sort_values('z', key = abs, ascending = False).head(200),
+                         use_container_width = True, hide_index = True)
+        else:
+            st.info("Hourly station anomalies appear here once they are built with python -m citibike.anomalies.")
+
+    # Year-over-year comparison built from the monthly summaries in the manifest, so other years
+    # are compared without loading their tables.
+    df_yoy = registry.year_over_year(manifest, city)
+
+    if df_yoy.shape[1] > 1:
+        fig_yoy = go.Figure()
+        for i, other_year in enumerate(df_yoy.columns):
+            fig_yoy.add_trace(
+                go.Bar(
+                    x = df_yoy.index,
+                    y = df_yoy[other_year],
+                    name = str(other_year),
+                    marker = dict(color = '#fdae61' if other_year == year else ['#2c7bb6', '#6199C7', '#96B6D8'][i % 3])))
+
+        fig_yoy.update_layout(
+            title = f'Monthly Trips by Year: {city_names[city]}',
+            barmode = 'group',
+            plot_bgcolor = '#2b2b2b',
+            paper_bgcolor = '#2b2b2b',
+            font = dict(color = 'white'),
+            height = 400)
+
+        fig_yoy.update_xaxes(
+            title_text = 'Month',
+            tickmode = 'array',
+            tickvals = list(range(1, 13)),
+            ticktext = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'],
+            gridcolor = '#444')
+
+        fig_yoy.update_yaxes(
+            title_text = 'No of trips',
+            gridcolor = '#444')
+
+        st.plotly_chart(fig_yoy, use_container_width=True)
+
+    # Quantifying the relationship that the dual axes can exaggerate
+    st.markdown("##### **How strong is the link with temperature?**")
+
+    overall_r = df_daily['avgTemp'].corr(df_daily['no_of_trips'])
+    st.metric('Correlation between daily temperature and trips (whole period)', f"{overall_r:.2f}")
+
+    window_days = st.slider('Rolling window (days)', min_value = 7, max_value = 90, value = 30)
+    # Kept apart from df_daily, which may be a table shared by every session
+    rolling_r = rolling.rolling_correlation(df_daily['avgTemp'], df_daily['no_of_trips'], window_days)
+
+    corr_column, lag_column = st.columns([2, 1])
+
+    with corr_column:
+        fig_corr = go.Figure(go.Scattergl(x = df_daily['date'], y = rolling_r, line = dict(color = '#fdae61'),
+                                          hovertemplate = '%{x|%d %b}<br>r = %{y:.2f}<extra></extra>'))
+        fig_corr.update_layout(
+            title = f'{window_days}-day Rolling Correlation of Trips and Temperature',
+            plot_bgcolor = '#2b2b2b',
+            paper_bgcolor = '#2b2b2b',
+            font = dict(color = 'white'),
+            height = 350)
+        fig_corr.update_xaxes(gridcolor = '#444')
+        fig_corr.update_yaxes(range = [-1, 1], gridcolor = '#444', zerolinecolor = 'white')
+        st.plotly_chart(fig_corr, use_container_width = True)
+
+    with lag_column:
+        df_lags = rolling.lagged_correlation(df_daily['avgTemp'], df_daily['no_of_trips'], 7)
+        fig_lags = go.Figure(go.Bar(x = df_lags['lag'], y = df_lags['correlation'], marker = dict(color = '#2c7bb6'),
+                                    hovertemplate = 'Lag %{x} days<br>r = %{y:.2f}<extra></extra>'))
+        fig_lags.update_layout(
+            title = 'Correlation by Lag (days)',
+            plot_bgcolor = '#2b2b2b',
+            paper_bgcolor = '#2b2b2b',
+            font = dict(color = 'white'),
+            height = 350)
+        fig_lags.update_xaxes(title_text = 'Temperature leads trips by (days)', gridcolor = '#444')
+        fig_lags.update_yaxes(gridcolor = '#444')
+        st.plotly_chart(fig_lags, use_container_width = True)
+
+    df_elasticity = rolling.temperature_elasticity(df_daily['avgTemp'], df_daily['no_of_trips'])
+    fig_elasticity = go.Figure(go.Bar(
+        x = df_elasticity['band'], y = df_elasticity['pct_change_per_degree'],
+        marker = dict(color = df_elasticity['pct_change_per_degree'], colorscale = ['#2c7bb6', '#fdae61']),
+        customdata = df_elasticity[['days', 'mean_trips']],
+        hovertemplate = '%{x}<br>%{y:.1f}% more trips per °C<br>%{customdata[0]} days, typically %{customdata[1]:,.0f} trips<extra></extra>'))
+    fig_elasticity.update_layout(
+        title = 'Change in Daily Trips for Each Extra Degree, by Temperature Band',
+        plot_bgcolor = '#2b2b2b',
+        paper_bgcolor = '#2b2b2b',
+        font = dict(color = 'white'),
+        height = 350)
+    fig_elasticity.update_xaxes(title_text = 'Temperature band', gridcolor = '#444')
+    fig_elasticity.update_yaxes(title_text = '% change in trips per °C', gridcolor = '#444', zerolinecolor = 'white')
+    st.plotly_chart(fig_elasticity, use_container_width = True)
+
     st.markdown("##### **Analysis**")
     st.markdown("We can see the ridership is clearly higher during the summer months compared to the winter and temperature does appear to be a factor with a general trend showing more rides when the temperature is warmer.  We must be careful not to infer too much though from this graph as the differently scaled axes can make a correlation look stronger than it actually is.  Even within warm months we see high variability with significant day-to-day fluctuations with spikes from the two graphs not always aligning.  This suggests that other aspects such as rain, holidays or events may also play a role in the usage of Citi Bikes. Additionally, we would expect there to be differences between weekday and weekend use, which we investigate next!")
 
@@ -347,6 +806,8 @@ elif page == "5. Daily Distribution: Weekday vs Weekend":
 
 
     # Two subplots showing average Weekday and Weekend use by aggregated by hour.
+
+    df_avg_day = load_table(city, year, 'avg_day')
     
     # Define colours, blue: '#2c7bb6', orange: '#fdae61'
     colors = {
@@ -409,6 +870,38 @@ elif page == "5. Daily Distribution: Weekday vs Weekend":
     st.markdown("These demand distributions can be used to inform bike redistribution strategies.  Stations near offices or transit hubs need more capacity during weekday rush hours while weekend capacity should focus on popular recreational areas during the afternoon.  Bike redistribution needs different strategies for weekdays compared to weekends. In the next section, we will look at the redistribution of bikes to the most imbalanced stations.")
     st.markdown("It is important to keep in mind that these are averages for all weekdays/weekends across the whole year and that there will be fluctuations depending on the the day of the week or the season.")
 
+    # Every day of the week separately, for any station and months, from the station profile store
+    # (python -m citibike.profiles)
+    profile_store = load_profiles(city, year)
+    if profile_store is not None and profile_store.has_weekly:
+        st.markdown("##### **Day of the week**")
+        st.markdown("The heatmap splits the week into its seven days, for the whole network or a single station and for any range of months.")
+
+        station_column, month_column, direction_column = st.columns([2, 2, 1])
+        weekly_station = station_column.selectbox('Station', ['All stations'] + profile_store.stations, key = 'weekly_station')
+        weekly_months = month_column.select_slider(
+            'Months', options = list(range(1, 13)), value = (1, 12), key = 'weekly_months',
+            format_func = lambda m: dt(2000, m, 1).strftime('%b'))
+        weekly_direction = direction_column.radio('Trips', ['Departures', 'Arrivals'], horizontal = True, key = 'weekly_direction')
+
+        df_week = weekly_grid(city, year, None if weekly_station == 'All stations' else weekly_station,
+                              weekly_months, ['Departures', 'Arrivals'].index(weekly_direction))
+
+        fig_week = go.Figure(go.Heatmap(
+            z = df_week.to_numpy(), x = list(df_week.columns), y = list(df_week.index),
+            colorscale = ['#2b2b2b', '#2c7bb6', '#fdae61'],
+            colorbar = dict(title = 'Trips per hour'),
+            hovertemplate = '<b>%{y} %{x}:00</b><br>%{z:.1f} trips per hour<extra></extra>'))
+        fig_week.update_layout(
+            title = f'Average {weekly_direction} by Day and Hour',
+            plot_bgcolor = '#2b2b2b',
+            paper_bgcolor = '#2b2b2b',
+            font = dict(color = 'white'),
+            height = 400)
+        fig_week.update_xaxes(title_text = 'Hour of Day', tickmode = 'array', tickvals = list(range(0, 24, 2)))
+        fig_week.update_yaxes(autorange = 'reversed')
+        st.plotly_chart(fig_week, use_container_width = True)
+
 
 
 
@@ -420,7 +913,7 @@ elif page == "6. Imbalance of Arrivals vs Departures":
 
     st.markdown("## Imbalance of Arrivals vs Departures")
     st.markdown("In order for bikes to be available for customers and for there to be empty docks in which to return bikes, it will be necessary to redistribute bikes manually.")
-    st.markdown("The figure below shows the 20 most unbalanced stations in the network.")
+    st.markdown("The figure below shows the 20 most unbalanced stations in the network.  Click on a station for a detailed profile.")
 
     st.markdown("The metric used here is 'Number of Arrivals' - 'Number of Departures' so a positive result (shown in orange) indicates stations likely to have problems with docks being unavailable, meaning that bikes must be removed in order to accept returning bikes. Conversely, a negative result (shown in blue) means that the station is likely to experience a shortage of bikes. This requires bikes to be transferred to these stations to keep up with demand.")
     
@@ -428,6 +921,15 @@ elif page == "6. Imbalance of Arrivals vs Departures":
     
     # Bar chart showing imbalaces with map showing locations
 
+    station_counts_to_graph = load_table(city, year, 'imbalance')
+
+    # Station types (python -m citibike.typology) are added to the hover text when they have been built
+    station_types, type_hover = None, ''
+    if registry.has_table(dataset, 'typology'):
+        labels = load_table(city, year, 'typology').set_index('station')['label'].astype(object)
+        station_types = station_counts_to_graph.index.map(labels).fillna('Low use')
+        type_hover = '<br>%{customdata}'
+
     # Create subplots with bar chart and map side by side
     fig = make_subplots(
         rows=1, cols=2,
@@ -454,7 +956,8 @@ elif page == "6. Imbalance of Arrivals vs Departures":
             textposition='outside',
             textfont=dict(size=12),
             name='',
-            hovertemplate='<b>%{y}</b><br>Difference: %{x}<extra></extra>'
+            customdata=station_types,
+            hovertemplate='<b>%{y}</b><br>Difference: %{x}' + type_hover + '<extra></extra>'
         ),
         row=1, col=1
         
@@ -476,7 +979,8 @@ elif page == "6. Imbalance of Arrivals vs Departures":
             text=station_counts_to_graph.index,
             textposition='top right',
             textfont=dict(size=12, color='white'),
-            hovertemplate='<b>%{text}</b><br>Difference: %{marker.color}<extra></extra>',
+            customdata=station_types,
+            hovertemplate='<b>%{text}</b><br>Difference: %{marker.color}' + type_hover + '<extra></extra>',
             name=''
         ),
         row=1, col=2
@@ -526,7 +1030,133 @@ elif page == "6. Imbalance of Arrivals vs Departures":
         margin=dict(l=40, r=40, t=70, b=100)
     )
     
-    st.plotly_chart(fig, use_container_width=True)
+    # Clicking a bar or a map marker opens the station detail below the chart
+    clicked = plotly_events(fig, click_event = True, override_height = 600)
+    if clicked:
+        point = clicked[0]
+        st.session_state['station_detail'] = (point['y'] if point['curveNumber'] == 0
+                                              else station_counts_to_graph.index[point['pointNumber']])
+
+    if st.session_state.get('station_detail') in set(station_counts_to_graph.index):
+        station_detail(st.session_state['station_detail'])
+
+    # Live dock and bike availability at these stations, from the GBFS feed set in CITIBIKE_GBFS_URL
+    # (the real feed is https://gbfs.citibikenyc.com/gbfs/en, or run python -m citibike.mock_gbfs).
+    # One feed poller runs per server process and every session subscribes to its updates.
+    gbfs_url = os.environ.get('CITIBIKE_GBFS_URL')
+
+    if gbfs_url:
+
+        @st.cache_resource
+        def live_feed(url):
+            feed = StationStatusFeed(url)
+            feed.start_in_thread()
+            return feed
+
+        feed = live_feed(gbfs_url)
+        # The subscription lives in session_state, so it leaves the feed once the session is gone
+        if 'live_updates' not in st.session_state:
+            st.session_state['live_updates'] = feed.subscribe()
+
+        def live_availability():
+            st.markdown("##### **Live availability**")
+
+            df_live = feed.snapshot()
+            if df_live.empty:
+                st.caption("Waiting for the first update from the station feed...")
+                return
+
+            df_live = df_live[df_live['name'].isin(station_counts_to_graph.index)].set_index('name')
+            df_live = df_live.join(station_counts_to_graph['difference'])
+            df_live['changed'] = df_live['station_id'].isin(drain(st.session_state['live_updates']).get('station_id', []))
+
+            st.caption(f"Updated {dt.fromtimestamp(feed.last_update):%H:%M:%S}" if feed.last_update else "")
+            st.dataframe(
+                df_live[['difference', 'num_bikes_available', 'num_docks_available', 'capacity', 'changed']]
+                    .sort_values('difference')
+                    .rename(columns = {'difference': 'Yearly difference', 'num_bikes_available': 'Bikes',
+                                       'num_docks_available': 'Free docks', 'capacity': 'Capacity',
+                                       'changed': 'Changed since last refresh'}),
+                use_container_width = True)
+
+        # Re-run just this section every few seconds where Streamlit supports it
+        if hasattr(st, 'fragment'):
+            live_availability = st.fragment(run_every = 10)(live_availability)
+
+        live_availability()
+
+    # Zones of stations that mostly exchange bikes with each other (python -m citibike.zones)
+    if registry.has_table(dataset, 'zones'):
+        with st.expander('Rebalancing zones'):
+            df_zones = load_table(city, year, 'zones')
+            df_zone_flows = load_table(city, year, 'zone_flows')
+            df_zone_summary = zones.zone_summary(df_zones, df_zone_flows)
+            st.caption("Stations are grouped into zones that mostly exchange bikes among themselves, found by community "
+                       "detection on the station-to-station trip network.  The hub is the station with the highest "
+                       "PageRank in the zone; a positive net means the zone gains bikes over the year.")
+            st.dataframe(df_zone_summary.rename(columns = {'stations': 'Stations', 'hub': 'Hub', 'departures': 'Departures',
+                                                           'self_contained': 'Trips staying in zone',
+                                                           'net_bikes': 'Net bikes'}),
+                         use_container_width = True)
+
+            st.markdown("**Largest flows between zones**")
+            st.dataframe(df_zone_flows[df_zone_flows['origin_zone'] != df_zone_flows['destination_zone']].head(10)
+                             .rename(columns = {'origin_zone': 'From zone', 'destination_zone': 'To zone', 'trips': 'Trips'}),
+                         use_container_width = True, hide_index = True)
+
+    # Order to visit these stations in, by street travel time (python -m citibike.network)
+    travel_matrix = load_travel_matrix(city, year)
+    if travel_matrix is not None:
+        with st.expander('Truck route through these stations'):
+            order, minutes = network.truck_route(travel_matrix, list(station_counts_to_graph.index))
+            st.caption(f"About {minutes:.0f} minutes of travel between stops, timed at cycling speed on the street network.")
+            st.dataframe(pd.DataFrame({'Stop': range(1, len(order) + 1), 'Station': order,
+                                       'Yearly difference': station_counts_to_graph.loc[order, 'difference'].to_numpy()}),
+                         use_container_width = True, hide_index = True)
+
+    # What a discount for ending trips at stations short of bikes might do (python -m citibike.incentives)
+    if registry.has_table(dataset, 'routes'):
+        incentive_model = load_incentive_model(city, year)
+
+        def incentive_what_if():
+            st.markdown("##### **What if riders were paid to rebalance?**")
+            st.markdown("Stations that lose bikes over the year offer a discount for ending a trip there.  Riders heading "
+                        "to another station within walking distance of one may ride on to it instead.")
+
+            col1, col2, col3 = st.columns(3)
+            shift = col1.slider('Riders taking the discount (%)', 0, 30, 10, key = 'incentive_shift') / 100
+            radius = col2.slider('Furthest extra ride (m)', 100, incentives.MAX_RADIUS, 400, step = 50, key = 'incentive_radius')
+            min_deficit = col3.slider('Offer at stations short of at least (bikes/year)', 0, 2000, 0, step = 50,
+                                      key = 'incentive_min_deficit')
+
+            df_what_if = incentive_model.what_if(shift, radius, min_deficit)
+            result = incentives.summary(df_what_if)
+
+            col1, col2, col3 = st.columns(3)
+            col1.metric('Bikes to rebalance', numerize(result['rebalancing_after']),
+                        f"{result['rebalancing_after'] - result['rebalancing_before']:+,}", delta_color = 'inverse')
+            col2.metric('Riders moved', numerize(result['riders_moved']))
+            col3.metric('Average extra ride', f"{result['extra_metres']:.0f} m")
+
+            df_changed = df_what_if.reindex(df_what_if['imbalance'].abs().sort_values(ascending = False).index).head(20)
+            fig_what_if = go.Figure()
+            fig_what_if.add_trace(go.Bar(y = df_changed.index, x = df_changed['imbalance'], orientation = 'h',
+                                         name = 'Today', marker_color = '#fdae61'))
+            fig_what_if.add_trace(go.Bar(y = df_changed.index, x = df_changed['imbalance_after'], orientation = 'h',
+                                         name = 'With discount', marker_color = '#2c7bb6'))
+            fig_what_if.update_layout(barmode = 'group', height = 600, title = 'Most unbalanced stations',
+                                      xaxis_title = 'Difference (Arrivals - Departures)',
+                                      plot_bgcolor = "#2b2b2b", paper_bgcolor = "#2b2b2b", font = dict(color = "white"),
+                                      legend = dict(orientation = 'h', y = 1.05))
+            fig_what_if.update_xaxes(gridcolor = "#444", zerolinecolor = 'white')
+            fig_what_if.update_yaxes(autorange = 'reversed', gridcolor = "#444")
+            st.plotly_chart(fig_what_if, use_container_width = True)
+
+        # Moving a slider re-runs just this section where Streamlit supports it
+        if hasattr(st, 'fragment'):
+            incentive_what_if = st.fragment(incentive_what_if)
+
+        incentive_what_if()
 
     st.markdown("")
 
@@ -545,16 +1175,60 @@ elif page == "6. Imbalance of Arrivals vs Departures":
 elif page == "7. Most Popular Routes":
 
     st.markdown("## Most Popular Routes")
-    st.markdown("Where are people actually going on Citi Bikes? Some of the most popular routes are round trips starting and ending at the same station, others are one way trips throughout the city.  The map below shows routes that were taken more than 3500 times in 2022. The orange end of the arcs represent the departure and the blue ends represent the arrival of the trip. A round trip is shown as just a point on the map.")
-
-
-    # Insert Most popular trips Kepler map
-    path_to_html = "Most popular trips_v3.html"
-
-    with open(path_to_html, 'r') as f:
-        html_data = f.read()
-    
-    st.components.v1.html(html_data, height =500)
+    st.markdown("Where are people actually going on Citi Bikes? Some of the most popular routes are round trips starting and ending at the same station, others are one way trips throughout the city.  The map below starts with routes that were taken more than 3500 times in 2022; use the slider to show more or fewer routes. The orange end of the arcs represent the departure and the blue ends represent the arrival of the trip. A round trip is shown as just a point on the map.")
+
+
+    # Routes map drawn with deck.gl from the full routes table.  The slider filters the routes
+    # before they are sent to the browser, so the whole dataset can be explored.
+    if not registry.has_table(dataset, 'routes'):
+        st.info(f"No routes table has been built for {city_names[city]} {year}.  Run `python -m citibike.maps` to create it.")
+    else:
+        # At coarser detail levels nearby stations are merged and parallel routes become one flow,
+        # read from the precomputed flow pyramid (python -m citibike.flows).
+        level, zoom = 'Station', flows.LEVELS['Station'][1]
+        if registry.has_table(dataset, 'flow_pyramid'):
+            level = st.select_slider('Detail level', options = list(flows.LEVELS), value = 'Station')
+            zoom = flows.LEVELS[level][1]
+            routes = load_table(city, year, 'flow_pyramid')
+            routes = routes[routes['level'] == level]
+        else:
+            routes = load_table(city, year, 'routes')
+
+        # Start by showing about the 2000 heaviest flows, or the original 3500-trip cut for station pairs
+        largest = int(routes['trips'].max())
+        default = 3500 if level == 'Station' else int(routes['trips'].nlargest(2000).min())
+        min_trips = st.slider('Show routes taken at least this many times', min_value = 1,
+                              max_value = largest, value = min(default, largest))
+        st.caption(f"{int((routes['trips'] >= min_trips).sum()):,} of {len(routes):,} routes shown")
+
+        map_config = maps.load_map_config()
+        route_layers = maps.route_layer(routes, min_trips)
+        if zone_toggle('route_map_zones'):
+            route_layers = maps.zone_layer(load_zone_outlines(city, year)) + route_layers
+        st.pydeck_chart(maps.deck(route_layers,
+                                  maps.view_state(map_config, bearing = 0, pitch = 30, zoom = zoom - 1),
+                                  {'text': '{from} to {to}\n{trips} trips'}))
+
+        # Street distances from the cached travel matrix instead of the straight arcs on the map
+        travel_matrix = load_travel_matrix(city, year)
+        if travel_matrix is not None and level == 'Station':
+            with st.expander('Street distances and riding speeds'):
+                df_detours = network.route_detours(routes[routes['trips'] >= min_trips], travel_matrix)
+                st.metric('Median detour over the straight line', f"{df_detours['detour'].median():.2f}x")
+                st.dataframe(
+                    df_detours.head(15).assign(straight_km = df_detours['straight_m'] / 1000,
+                                               network_km = df_detours['network_m'] / 1000)
+                        [['start_station_name', 'end_station_name', 'trips', 'straight_km', 'network_km', 'cycling_min', 'detour']]
+                        .rename(columns = {'start_station_name': 'From', 'end_station_name': 'To', 'trips': 'Trips',
+                                           'straight_km': 'Straight line (km)', 'network_km': 'By street (km)',
+                                           'cycling_min': 'Cycling time (min)', 'detour': 'Detour'}),
+                    use_container_width = True, hide_index = True)
+
+                if 'trips' in dataset:
+                    df_speeds = load_rider_speeds(city, year)
+                    st.metric('Median riding speed on busy routes', f"{df_speeds['speed_kmh'].median():.1f} km/h")
+                    st.caption("Speed is the street distance over the median trip time, leaving out trips that took more "
+                               "than twice the modelled cycling time, which are mostly stops along the way.")
 
     st.markdown("##### **Analysis**")
     st.markdown("Immediately we can see how busy it is at the southern end of Central Park. In fact, the top 2 trips are round trips starting from Central Park South & 6th Ave (12041 rides) and 7th Ave & Central Park South (8541 rides). This suggests that the most popular use of CitiBiki may be to ride around Central Park. Other trips starting and ending at stations around the edges of the park are also very popular routes. The route from the south of the park to the north is also popular. This makes sense as riding in Central Park is definitely one of the more relaxing ways to ride a bike in New York City!")
@@ -569,7 +1243,116 @@ elif page == "7. Most Popular Routes":
 
 
 ####################################################################################    
-########################### 8. Recommendations #####################################
+############################# 8. Trip Durations ####################################
+####################################################################################
+
+
+elif page == "8. Trip Durations":
+
+    st.markdown("## Trip Durations")
+    st.markdown("How long do people ride for?  The distributions below are read from duration sketches that were built while the trip data was ingested, so every trip is included rather than a sample, and any combination of member type, bike type, month and station is available instantly.  Durations are accurate to within 2%.")
+
+    if not registry.has_table(dataset, 'duration_sketches'):
+        st.info(f"No duration sketches have been built for {city_names[city]} {year}.  Run `python -m citibike.sketches` to create them.")
+    else:
+        duration_sketches = load_table(city, year, 'duration_sketches')
+
+        # Filters for the slice to show; leaving a filter empty includes everything
+        filter_columns = st.columns(4)
+        member_filter = filter_columns[0].multiselect('Member type', sorted(duration_sketches['member_casual'].dropna().unique()))
+        rideable_filter = filter_columns[1].multiselect('Bike type', sorted(duration_sketches['rideable_type'].dropna().unique()))
+        month_filter = filter_columns[2].multiselect('Month', list(range(1, 13)))
+        station_filter = filter_columns[3].multiselect('Start station', sorted(duration_sketches['start_station_name'].dropna().unique()))
+
+        # Compare members and casual riders side by side within the selected slice
+        colors = {'member': '#2c7bb6', 'casual': '#fdae61'}
+
+        fig_4 = go.Figure()
+        summary = []
+
+        for member_type in (member_filter or ['member', 'casual']):
+            counts = sketches.slice_histogram(
+                duration_sketches,
+                member_casual = [member_type],
+                rideable_type = rideable_filter,
+                month = month_filter,
+                start_station_name = station_filter)
+
+            if counts.sum() == 0:
+                continue
+
+            p50, p90, p99 = sketches.quantiles_from_counts(counts, [0.5, 0.9, 0.99])
+            summary.append({'Member type': member_type, 'Trips': int(counts.sum()),
+                            'Median (min)': round(p50, 1), '90th percentile (min)': round(p90, 1),
+                            '99th percentile (min)': round(p99, 1)})
+
+            # Trips longer than 200 minutes are left out of the chart as in Ex 2.4, but not the percentiles
+            counts = counts[sketches.bucket_value(counts.index) <= 200]
+            fig_4.add_trace(
+                go.Scatter(
+                    x = sketches.bucket_value(counts.index),
+                    y = counts / counts.sum(),
+                    name = member_type,
+                    mode = 'lines',
+                    line = dict(color = colors.get(member_type, '#96B6D8'), shape = 'hvh'),
+                    fill = 'tozeroy',
+                    hovertemplate = '%{x:.1f} min<br>%{y:.2%} of trips<extra></extra>'))
+
+        fig_4.update_layout(
+            title = 'Distribution of Trip Duration',
+            plot_bgcolor = '#2b2b2b',
+            paper_bgcolor = '#2b2b2b',
+            font = dict(color = 'white'),
+            height = 450)
+
+        fig_4.update_xaxes(
+            title_text = 'Trip duration (minutes, log scale)',
+            type = 'log',
+            gridcolor = '#444')
+
+        fig_4.update_yaxes(
+            title_text = 'Share of trips',
+            tickformat = '.1%',
+            gridcolor = '#444')
+
+        st.plotly_chart(fig_4, use_container_width=True)
+        st.dataframe(pd.DataFrame(summary), use_container_width=True, hide_index=True)
+
+
+####################################################################################    
+############################## 9. Ad-hoc Query #####################################
+####################################################################################
+
+
+elif page == "9. Ad-hoc Query":
+
+    st.markdown("## Ad-hoc Query")
+    st.markdown("Questions that are not answered by the pages above can be asked directly of the full trip data using SQL.  Queries run in an embedded DuckDB engine against the trip store on disk, so even a full year of around 30 million trips is answered in seconds without loading it into memory.  The data is available as a table called `trips`.")
+
+    if 'trips' not in dataset:
+        st.info(f"No trip store has been built for {city_names[city]} {year}.  Run `python -m citibike.query` to create one.")
+    else:
+        @st.cache_resource
+        def trips_connection(city, year):
+            return query.connect(query.trips_path(registry.find(manifest, city, year)))
+
+        example = st.selectbox('Start from an example', list(query.EXAMPLES))
+        sql = st.text_area('SQL', query.EXAMPLES[example].strip(), height=220)
+
+        if st.button('Run query'):
+            try:
+                df_result, seconds, truncated = query.run(trips_connection(city, year), sql)
+            except Exception as e:
+                st.error(str(e))
+            else:
+                st.caption(f"{len(df_result):,} rows in {seconds:.2f} seconds")
+                if truncated:
+                    st.warning(f"Only the first {len(df_result):,} rows are shown.  Add a LIMIT or aggregate further to see the rest.")
+                st.dataframe(df_result, use_container_width=True)
+
+
+####################################################################################    
+########################### 10. Recommendations ####################################
 ####################################################################################
 
     
@@ -632,5 +1415,44 @@ else:
         myImage_4 = Image.open("close-up-bicycle-gear.jpg")
         st.image(myImage_4, width=220)
 
+    # Replaying the year's trips against the docks under each rebalancing schedule (citibike.simulate)
+    st.markdown("#### **Testing the Rebalancing Schedules**")
+
+    if not registry.has_table(dataset, 'rebalancing'):
+        st.info("The rebalancing simulation appears here once it is built with python -m citibike.simulate.")
+    else:
+        df_rebalancing = load_table(city, year, 'rebalancing')
+        df_scenarios = simulate.summary(df_rebalancing)
+
+        st.markdown("Every trip of the year is replayed against the docks, starting with each station half full. A station with no bikes loses the ride and a full station turns the return away. The schedules move up to 2,000 bikes per window towards half-full stations. The recommended windows are weekday afternoons and evenings, plus weekend mornings.")
+
+        fig_scenarios = go.Figure()
+        for column, label, color in [('empty_hours', 'Hours with no bikes', '#fdae61'),
+                                     ('full_hours', 'Hours with no free docks', '#2c7bb6')]:
+            fig_scenarios.add_trace(go.Bar(x = df_scenarios.index, y = df_scenarios[column], name = label,
+                                           marker = dict(color = color)))
+        fig_scenarios.update_layout(
+            title = 'Station Hours Empty or Full over the Year',
+            barmode = 'group',
+            plot_bgcolor = '#2b2b2b',
+            paper_bgcolor = '#2b2b2b',
+            font = dict(color = 'white'),
+            height = 400)
+        fig_scenarios.update_yaxes(title_text = 'Station hours', gridcolor = '#444')
+        st.plotly_chart(fig_scenarios, use_container_width = True)
+
+        st.dataframe(df_scenarios.rename(columns = {
+            'empty_hours': 'Hours empty', 'full_hours': 'Hours full', 'lost_departures': 'Lost rides',
+            'blocked_arrivals': 'Blocked returns', 'bikes_moved': 'Bikes moved'}), use_container_width = True)
+
+        scenario = st.selectbox('Stations that still struggle under', df_scenarios.index, index = len(df_scenarios) - 1)
+        df_worst = df_rebalancing[df_rebalancing['scenario'] == scenario].assign(
+            hours_empty_or_full = lambda df: ((df['empty_minutes'] + df['full_minutes']) / 60).round())
+        st.dataframe(df_worst.nlargest(20, 'hours_empty_or_full')[
+            ['station', 'capacity', 'hours_empty_or_full', 'lost_departures', 'blocked_arrivals']].rename(columns = {
+            'station': 'Station', 'capacity': 'Docks', 'hours_empty_or_full': 'Hours empty or full',
+            'lost_departures': 'Lost rides', 'blocked_arrivals': 'Blocked returns'}),
+            use_container_width = True, hide_index = True)
+
 
 
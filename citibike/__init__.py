@@ -0,0 +1,5 @@
+# Helper modules for the Citi Bike Strategy Dashboard.
+#
+# The dashboard script (Citi_Bike_Dashboard.py) stays responsible for the page
+# layout and text.  Anything that is data processing rather than presentation
+# lives in here so that it can be re-used from the notebooks as well.
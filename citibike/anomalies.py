@@ -0,0 +1,198 @@
+####################################################################################
+############################ Ridership anomaly detection ###########################
+####################################################################################
+
+# Flags days and hours whose ridership is far from what the season, the day type
+# and (for daily totals) the temperature would predict - rain, holidays, events.
+#
+# The expected count for each step is a seasonal baseline (the weekday/weekend
+# hourly profile behind avg_day.csv, or a station's own profile from the profile
+# store) scaled by a slowly moving level.  Residuals are taken on a log scale and
+# scored against an exponentially weighted variance, so the detector is online:
+# each new reading is scored and then folded into the state in O(1).  The state
+# is held as arrays, so one update scores every station at once.
+#
+# The per-station hourly table is built from the trip store, one month at a time:
+#
+#   python -m citibike.anomalies --city nyc --year 2022
+
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from citibike import profiles, query, registry
+
+
+SYSTEM = 'All stations'
+
+
+class OnlineDetector:
+    """Exponentially weighted anomaly scores for many series, one time step at a time.
+
+    alpha is the weight of a new residual in the variance, beta the speed at
+    which the level follows the data.  Residuals beyond the threshold are
+    clipped before they update the state, so an anomaly does not drag the
+    baseline along with it.  An optional covariate (e.g. temperature) gets its
+    own online slope.
+    """
+
+    def __init__(self, n_series, alpha=0.1, beta=0.1, threshold=3.5, warmup=14, min_std=0.05):
+        self.alpha = alpha
+        self.beta = beta
+        self.threshold = threshold
+        self.warmup = warmup
+        self.min_std = min_std
+
+        self.steps = 0
+        self.level = np.zeros(n_series)             # log correction to the baseline
+        self.var = np.zeros(n_series)
+        self.cov_mean = np.zeros(n_series)          # EWMA of the covariate
+        self.cov_var = np.zeros(n_series)
+        self.cov_resid = np.zeros(n_series)         # EWMA of covariate x residual
+        self.slope = np.zeros(n_series)
+
+    def update(self, observed, baseline, covariate=None):
+        """Score one step and learn from it.  Returns expected counts, z-scores and flags."""
+        observed = np.asarray(observed, dtype=np.float64)
+        baseline = np.asarray(baseline, dtype=np.float64)
+
+        deviation = 0.0
+        if covariate is not None:
+            deviation = np.asarray(covariate, dtype=np.float64) - self.cov_mean
+
+        log_expected = np.log1p(baseline) + self.level + self.slope * deviation
+        residual = np.log1p(observed) - log_expected
+
+        std = np.maximum(np.sqrt(self.var), self.min_std)
+        z = residual / std
+        flagged = np.abs(z) > self.threshold if self.steps >= self.warmup else np.zeros(len(z), dtype=bool)
+
+        # Until the variance has settled every residual counts in full
+        alpha = max(self.alpha, 1 / (self.steps + 1))
+        learn = np.clip(residual, -self.threshold * std, self.threshold * std) if self.steps >= self.warmup else residual
+
+        self.level += self.beta * learn
+        self.var += alpha * (learn ** 2 - self.var)
+
+        if covariate is not None:
+            self.cov_var += alpha * (deviation ** 2 - self.cov_var)
+            self.cov_resid += alpha * (deviation * (learn + self.slope * deviation) - self.cov_resid)
+            self.slope = np.where(self.cov_var > 0, self.cov_resid / np.where(self.cov_var > 0, self.cov_var, 1), 0)
+            self.cov_mean += alpha * deviation
+
+        self.steps += 1
+        return np.expm1(log_expected), z, flagged
+
+
+############################ Seasonal baselines ####################################
+
+def hourly_baseline(avg_day):
+    """Average trips by (weekday/weekend, hour) from the avg_day table, as a (2, 24) array."""
+    table = avg_day.pivot_table(index='day_type', columns='start_hour', values='trip_count')
+    return table.reindex(index=profiles.DAY_TYPES, columns=range(24)).fillna(0).to_numpy()
+
+
+def daily_anomalies(daily, avg_day, **options):
+    """Score each day of the daily table against its day type, the season and the temperature."""
+    day_totals = hourly_baseline(avg_day).sum(axis=1)
+    daily = daily.sort_values('date')
+    weekend = (daily['date'].dt.dayofweek >= 5).astype(int).to_numpy()
+
+    options = {'alpha': 0.1, 'beta': 0.15, 'threshold': 3.0, 'warmup': 14, **options}
+    detector = OnlineDetector(1, **options)
+    expected, z, flagged = [], [], []
+    for trips, temp, day_type in zip(daily['no_of_trips'].to_numpy(), daily['avgTemp'].to_numpy(), weekend):
+        e, s, f = detector.update([trips], [day_totals[day_type]], [temp])
+        expected.append(e[0])
+        z.append(s[0])
+        flagged.append(f[0])
+
+    result = daily[['date', 'no_of_trips', 'avgTemp']].copy()
+    result['expected'] = np.round(expected)
+    result['z'] = np.round(z, 2)
+    result['anomaly'] = flagged
+    result['kind'] = np.where(result['z'] > 0, 'Spike', 'Drop')
+    return result
+
+
+############################ Per-station hourly ####################################
+
+def _hourly_counts(trips, stations, start, n_hours):
+    # Departures per (hour since start, station) for one chunk of trips; trips outside the
+    # n_hours from start are left out
+    times = pd.to_datetime(trips['start_time'])
+    codes = pd.Categorical(trips['start_station_name'], categories=stations).codes.astype(np.int64)
+    hours = ((times - start) // pd.Timedelta(hours=1)).to_numpy(dtype=np.float64, na_value=np.nan)
+    ok = (codes >= 0) & (hours >= 0) & (hours < n_hours)
+    counts = np.bincount(hours[ok].astype(np.int64) * len(stations) + codes[ok], minlength=n_hours * len(stations))
+    return counts.reshape(n_hours, len(stations))
+
+
+def _partition_month(path, trips, year):
+    # First hour of the month a trip store file holds, from its month=MM folder (or failing that
+    # the month most of its trips start in)
+    match = re.search(r'month=(\d+)', path)
+    if match:
+        month = int(match.group(1))
+    else:
+        month = int(pd.to_datetime(trips['start_time']).dt.month.mode().iloc[0])
+    return pd.Timestamp(year=year, month=month, day=1)
+
+
+def station_anomalies(trips_path, store, avg_day, min_excess=5, **options):
+    """Flagged hours for the whole system and for every station, streamed month by month.
+
+    Every month is scored hour by hour from its first hour to its last, in
+    order; trips in a month's file that start outside that month (the last
+    night of the previous year, say) are left out, as prepare_trips does.
+    Each station is compared with its own weekday/weekend departure profile and
+    the system total with the avg_day profile.  Stations that only see a trip or
+    two an hour are noisy on a log scale, so a flag also needs at least
+    min_excess trips more or fewer than expected.
+    """
+    stations = store.stations
+    station_profile = np.asarray(store.arrays['hourly'])[:, :, 0, :]      # departures, (stations, 2, 24)
+    baseline = np.concatenate([station_profile, hourly_baseline(avg_day)[None]], axis=0)
+    names = np.array(list(stations) + [SYSTEM], dtype=object)
+
+    options = {'alpha': 0.02, 'beta': 0.005, 'threshold': 4.0, 'warmup': 24 * 14, 'min_std': 0.3, **options}
+    detector = OnlineDetector(len(names), **options)
+
+    files = sorted(glob.glob(os.path.join(trips_path, '**', '*.parquet'), recursive=True))
+    flags = []
+    for f in files:
+        trips = pd.read_parquet(f, columns=['start_time', 'start_station_name'])
+        if trips.empty:
+            continue
+        start = _partition_month(f, trips, store.year)
+        n_hours = (start + pd.offsets.MonthBegin() - start) // pd.Timedelta(hours=1)
+        counts = _hourly_counts(trips, stations, start, n_hours)
+        counts = np.column_stack([counts, counts.sum(axis=1)])
+
+        for step, observed in enumerate(counts):
+            hour = start + pd.Timedelta(hours=step)
+            expected, z, flagged = detector.update(observed, baseline[:, int(hour.dayofweek >= 5), hour.hour])
+            flagged &= np.abs(observed - expected) >= min_excess
+            for i in np.flatnonzero(flagged):
+                flags.append((hour, names[i], int(observed[i]), round(float(expected[i]), 1), round(float(z[i]), 2)))
+
+    return pd.DataFrame(flags, columns=['hour', 'station', 'observed', 'expected', 'z'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the hourly anomaly table for a registered city/year.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    store = profiles.StationProfiles(profiles.profiles_path(entry))
+    flags = station_anomalies(query.trips_path(entry), store, registry.load_table(entry, 'avg_day'))
+    flags.to_parquet(os.path.join(registry.DATA_DIR, entry['path'], registry.TABLES['anomalies']), index=False)
+    registry.register(entry['city'], entry['city_name'], entry['year'], entry['path'])
+    print(f"{len(flags):,} anomalous station-hours written for {args.city} {args.year} "
+          f"({(flags['station'] == SYSTEM).sum():,} system-wide)")
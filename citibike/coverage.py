@@ -0,0 +1,255 @@
+####################################################################################
+############################ Expansion coverage ####################################
+####################################################################################
+
+# Where would a new station serve the most people who are not near one today?
+#
+# The area around the stations is cut into a grid of square cells (50 m by
+# default, a few hundred thousand cells for New York and millions at finer
+# sizes), and the distance from every cell centre to the nearest station is
+# looked up in a k-d tree of the station coordinates.  A cell counts as
+# covered when that distance is within a short walk.
+#
+# What a site would cover is given by a layer of points (population centroids,
+# subway and bus stops, ...) as a CSV with latitude, longitude and an optional
+# weight column.  Sites are only ranked against such a layer: the grid knows
+# nothing about land and water, so with every cell counting the same the rivers
+# and the far banks look as much in need of a station as the streets do.
+# Without a layer the surface is still drawn over every cell within `reach` of
+# an existing station.
+#
+# Candidate sites are ranked greedily.  Any cell within `reach` of the network
+# can take a new station; the points are only what it covers.  The gain of
+# opening a station at every cell, the uncovered weight within walking distance
+# of it, is one FFT convolution of the uncovered-weight grid with a disc.
+# After the best site is taken, only the gains within two walking distances of
+# it can change, so they are recomputed over that window alone.  Sites with the
+# same gain are told apart by the weight in their own cell and then by how near
+# they are to the network.
+#
+#   python -m citibike.coverage --city nyc --year 2022 --weights stops.csv
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.signal import fftconvolve
+from scipy.spatial import cKDTree
+
+from citibike import flows, registry
+
+
+WALK = 300              # metres; about a four-minute walk
+REACH = 1500            # metres from an existing station that count when there is no weight layer
+
+
+class Grid:
+    """A square grid in local metres around a set of points, row 0 at the north edge."""
+
+    def __init__(self, lat, lng, cell_size=50, margin=1000):
+        self.cell_size = cell_size
+        self.lat0 = np.radians(np.mean(lat))
+        x, y = self.project(lat, lng)
+        self.x0 = x.min() - margin
+        self.y1 = y.max() + margin
+        self.width = int(np.ceil((x.max() + margin - self.x0) / cell_size))
+        self.height = int(np.ceil((self.y1 - (y.min() - margin)) / cell_size))
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    def project(self, lat, lng):
+        lat, lng = np.asarray(lat, dtype=np.float64), np.asarray(lng, dtype=np.float64)
+        return (np.radians(lng) * np.cos(self.lat0) * flows.EARTH_RADIUS,
+                np.radians(lat) * flows.EARTH_RADIUS)
+
+    def unproject(self, x, y):
+        return (np.degrees(np.asarray(y) / flows.EARTH_RADIUS),
+                np.degrees(np.asarray(x) / (flows.EARTH_RADIUS * np.cos(self.lat0))))
+
+    def cell_of(self, lat, lng):
+        """Row and column of the cell holding each point (outside the grid gives -1)."""
+        x, y = self.project(lat, lng)
+        row = np.floor((self.y1 - y) / self.cell_size).astype(np.int64)
+        col = np.floor((x - self.x0) / self.cell_size).astype(np.int64)
+        outside = (row < 0) | (row >= self.height) | (col < 0) | (col >= self.width)
+        return np.where(outside, -1, row), np.where(outside, -1, col)
+
+    def centre(self, row, col):
+        """Latitude and longitude of cell centres."""
+        return self.unproject(self.x0 + (np.asarray(col) + 0.5) * self.cell_size,
+                              self.y1 - (np.asarray(row) + 0.5) * self.cell_size)
+
+    def bounds(self):
+        """[west, south, east, north] in degrees."""
+        south, west = self.unproject(self.x0, self.y1 - self.height * self.cell_size)
+        north, east = self.unproject(self.x0 + self.width * self.cell_size, self.y1)
+        return [float(west), float(south), float(east), float(north)]
+
+
+############################ Coverage ##############################################
+
+def distance_to_nearest(grid, lat, lng):
+    """(rows, cols) distance in metres from each cell centre to the nearest point."""
+    tree = cKDTree(np.column_stack(grid.project(lat, lng)))
+    xs = grid.x0 + (np.arange(grid.width) + 0.5) * grid.cell_size
+    ys = grid.y1 - (np.arange(grid.height) + 0.5) * grid.cell_size
+
+    # Row by row blocks keep the query points from taking more memory than the result
+    distance = np.empty(grid.shape, dtype=np.float32)
+    rows_per_block = max(1, 1_000_000 // grid.width)
+    for start in range(0, grid.height, rows_per_block):
+        block = ys[start:start + rows_per_block]
+        points = np.column_stack([np.tile(xs, len(block)), np.repeat(block, grid.width)])
+        distance[start:start + len(block)] = tree.query(points, workers=-1)[0].reshape(len(block), grid.width)
+    return distance
+
+
+def weight_layer(grid, points=None, distance=None, reach=REACH):
+    """Weight of every cell: summed point weights from a layer, or 1 within reach of a station.
+
+    The second is only an area to draw the surface over; it is not a weight to rank sites by.
+    """
+    if points is None:
+        return (distance <= reach).astype(np.float32)
+
+    lat = points['latitude'] if 'latitude' in points else points['lat']
+    lng = points['longitude'] if 'longitude' in points else points['lng']
+    row, col = grid.cell_of(lat, lng)
+    ok = row >= 0
+    weight = points['weight'].to_numpy(dtype=np.float64) if 'weight' in points else np.ones(len(points))
+    cells = np.bincount(row[ok] * grid.width + col[ok], weights=weight[ok], minlength=grid.height * grid.width)
+    return cells.reshape(grid.shape).astype(np.float32)
+
+
+def _disc(radius_cells):
+    r = int(radius_cells)
+    y, x = np.ogrid[-r:r + 1, -r:r + 1]
+    return (x ** 2 + y ** 2 <= radius_cells ** 2).astype(np.float32)
+
+
+def _best_site(gain, uncovered, distance):
+    # The cell with the highest gain; ties go to the most uncovered weight in the cell itself, then
+    # to the cell nearest an existing station
+    top = gain.max()
+    ties = np.flatnonzero(gain.ravel() >= top - 1e-4 * max(top, 1))
+    if len(ties) == 1:
+        return int(ties[0])
+    order = np.lexsort((distance.ravel()[ties], -uncovered.ravel()[ties]))
+    return int(ties[order[0]])
+
+
+def rank_sites(grid, distance, weight, n_sites=20, walk=WALK, candidate=None):
+    """Greedy ranking of new station sites by the uncovered weight each brings within walking distance.
+
+    candidate marks the cells a station may go in (by default every cell).
+    Returns a frame of the sites in order with the weight each newly covers and
+    the share of all weight covered once it is built.
+    """
+    radius = walk / grid.cell_size
+    disc = _disc(radius)
+    r = disc.shape[0] // 2
+    uncovered = np.where(distance > walk, weight, 0).astype(np.float32)
+    candidate = np.ones(grid.shape, dtype=bool) if candidate is None else candidate
+    gain = np.where(candidate, fftconvolve(uncovered, disc, mode='same'), -1)
+
+    total = float(weight.sum())
+    covered = total - float(uncovered.sum())
+    sites = []
+    for rank in range(1, n_sites + 1):
+        best = _best_site(gain, uncovered, distance)
+        row, col = divmod(best, grid.width)
+        if gain[row, col] <= 1e-6:
+            break
+
+        # Everything within walking distance of the new site is now covered
+        a, b = max(0, row - r), min(grid.height, row + r + 1)
+        c, d = max(0, col - r), min(grid.width, col + r + 1)
+        newly = float((uncovered[a:b, c:d] * disc[a - row + r:b - row + r, c - col + r:d - col + r]).sum())
+        uncovered[a:b, c:d] *= 1 - disc[a - row + r:b - row + r, c - col + r:d - col + r]
+        covered += newly
+
+        # Gains can only change within two walking distances; recompute them from a window one wider
+        a, b = max(0, row - 2 * r), min(grid.height, row + 2 * r + 1)
+        c, d = max(0, col - 2 * r), min(grid.width, col + 2 * r + 1)
+        wa, wb = max(0, a - r), min(grid.height, b + r)
+        wc, wd = max(0, c - r), min(grid.width, d + r)
+        window = fftconvolve(uncovered[wa:wb, wc:wd], disc, mode='same')
+        gain[a:b, c:d] = np.where(candidate[a:b, c:d], window[a - wa:b - wa, c - wc:d - wc], -1)
+
+        lat, lng = grid.centre(row, col)
+        sites.append({'rank': rank, 'latitude': round(float(lat), 5), 'longitude': round(float(lng), 5),
+                      'gain': round(newly, 1), 'coverage': round(covered / total, 4) if total else 0.0})
+
+    return pd.DataFrame(sites, columns=['rank', 'latitude', 'longitude', 'gain', 'coverage'])
+
+
+def coverage_share(distance, weight, walk=WALK):
+    total = weight.sum()
+    return float(weight[distance <= walk].sum() / total) if total else 0.0
+
+
+def analyse(stations, points=None, cell_size=50, walk=WALK, reach=REACH, n_sites=20):
+    """Grid, distance surface, weights and ranked sites for a table of stations with latitude/longitude.
+
+    Sites are only ranked with a layer of points; without one the frame of sites is empty.
+    """
+    lat, lng = stations['latitude'].to_numpy(), stations['longitude'].to_numpy()
+    grid = Grid(lat, lng, cell_size, margin=reach)
+    distance = distance_to_nearest(grid, lat, lng)
+    weight = weight_layer(grid, points, distance, reach)
+    if points is None:
+        sites = pd.DataFrame(columns=['rank', 'latitude', 'longitude', 'gain', 'coverage'])
+    else:
+        sites = rank_sites(grid, distance, weight, n_sites, walk, candidate=distance <= reach)
+    return grid, distance, weight, sites
+
+
+############################ Map image #############################################
+
+# Walking distance bands and their colours: covered cells are left clear
+BANDS = [(WALK, (0, 0, 0, 0)), (600, (254, 224, 139, 110)), (1000, (253, 174, 97, 140)),
+         (np.inf, (215, 48, 39, 160))]
+
+
+def surface_image(distance, weight):
+    """RGBA image of the distance surface in walking bands, clear where no weight lies."""
+    edges = np.array([limit for limit, _ in BANDS[:-1]])
+    colours = np.array([colour for _, colour in BANDS], dtype=np.uint8)
+    image = colours[np.searchsorted(edges, distance, side='left')]
+    image[weight <= 0] = 0
+    return image
+
+
+def image_url(image):
+    """PNG data URL of an RGBA array, for a deck.gl bitmap layer."""
+    import base64
+    import io
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.fromarray(image, 'RGBA').save(buffer, format='PNG', optimize=True)
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rank new station sites by coverage gain for a registered city/year.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    parser.add_argument('--weights', required=True,
+                        help='CSV of points with latitude, longitude and an optional weight column')
+    parser.add_argument('--cell-size', type=float, default=50, help='grid cell size in metres')
+    parser.add_argument('--sites', type=int, default=20)
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    points = pd.read_csv(args.weights)
+    grid, distance, weight, sites = analyse(registry.load_table(entry, 'start_stations'), points,
+                                            args.cell_size, n_sites=args.sites)
+    sites.to_parquet(os.path.join(registry.DATA_DIR, entry['path'], registry.TABLES['expansion_sites']), index=False)
+    registry.register(entry['city'], entry['city_name'], entry['year'], entry['path'])
+    print(f'{grid.height * grid.width:,} cells, {coverage_share(distance, weight):.1%} of the weight within '
+          f'{WALK} m of a station; {len(sites)} sites would raise that to {sites["coverage"].iloc[-1]:.1%}'
+          if len(sites) else 'No uncovered weight left')
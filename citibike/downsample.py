@@ -0,0 +1,103 @@
+####################################################################################
+############################ Time series downsampling ##############################
+####################################################################################
+
+# A browser can only draw as many distinct points as there are pixels across the
+# chart, so long series (hourly data over several years) are reduced on the
+# server before being handed to plotly.  Both methods keep the first and last
+# points so that the x-axis range is unchanged.
+
+import numpy as np
+import pandas as pd
+
+
+def _as_float(x):
+    # Dates are compared as nanoseconds since the epoch
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    return x.astype(np.float64)
+
+
+def lttb(x, y, n_out):
+    """Largest-Triangle-Three-Buckets downsampling.
+
+    Returns the integer positions of the points to keep.  LTTB keeps the visual
+    shape of a line, which makes it the default for the trips series.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    xf = _as_float(x)
+    yf = np.asarray(y, dtype=np.float64)
+
+    # Bucket edges for the n_out - 2 middle buckets (first and last point are fixed)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+
+        # Average of the next bucket is the third corner of the triangle
+        nxt_start, nxt_stop = edges[i + 1], (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x = xf[nxt_start:nxt_stop].mean()
+        avg_y = yf[nxt_start:nxt_stop].mean()
+
+        area = np.abs((xf[a] - avg_x) * (yf[start:stop] - yf[a])
+                      - (xf[a] - xf[start:stop]) * (avg_y - yf[a]))
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+
+    return keep
+
+
+def minmax(y, n_out):
+    """Min/max downsampling.
+
+    Splits the series into n_out // 2 buckets and keeps the smallest and largest
+    point of each, so single-day spikes are never dropped.  Returns positions.
+    """
+    n = len(y)
+    n_buckets = n_out // 2
+    if n_out >= n or n_buckets < 1:
+        return np.arange(n)
+
+    yf = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(0, n, n_buckets + 1).astype(np.int64)
+
+    # reduceat works on the start of each bucket, which keeps this fully vectorised
+    starts = edges[:-1]
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+    mins = np.minimum.reduceat(yf, starts)
+    maxs = np.maximum.reduceat(yf, starts)
+
+    lo = np.flatnonzero(yf == mins[bucket])
+    hi = np.flatnonzero(yf == maxs[bucket])
+
+    # Keep only the first min and first max found in each bucket
+    lo = lo[np.unique(bucket[lo], return_index=True)[1]]
+    hi = hi[np.unique(bucket[hi], return_index=True)[1]]
+
+    return np.unique(np.concatenate([[0, n - 1], lo, hi]))
+
+
+def downsample(df, x, y, n_out, method='lttb'):
+    """Return the rows of df needed to draw column y against column x at n_out points."""
+    if len(df) <= n_out:
+        return df
+    if method == 'minmax':
+        keep = minmax(df[y].to_numpy(), n_out)
+    else:
+        keep = lttb(df[x].to_numpy(), df[y].to_numpy(), n_out)
+    return df.iloc[keep]
+
+
+def window(df, x, start, end):
+    """Rows of df whose x column falls inside [start, end]."""
+    values = pd.to_datetime(df[x])
+    return df[(values >= pd.Timestamp(start)) & (values <= pd.Timestamp(end))]
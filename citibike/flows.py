@@ -0,0 +1,128 @@
+####################################################################################
+############################# Route flow aggregation ###############################
+####################################################################################
+
+# Drawing every station pair as an arc is unreadable at city zoom.  Stations are
+# grouped into square grid cells whose size depends on the zoom level, and all
+# routes between the same two cells are merged into one weighted flow drawn
+# between the trip-weighted centres of the cells.  Each level is precomputed so
+# the routes map only has to pick one:
+#
+#   level    cell size    shown at
+#   City       2000 m     zoom 10
+#   District   1000 m     zoom 11
+#   Area        500 m     zoom 12
+#   Block       250 m     zoom 13
+#   Station       -       zoom 14  (the original station pairs)
+#
+# The result is one table with a 'level' column and the same columns as the
+# routes table, so it can be drawn by citibike.maps.route_layer.
+#
+#   python -m citibike.flows --city nyc --year 2022
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from citibike import registry
+
+
+LEVELS = {
+    'City': (2000, 10),
+    'District': (1000, 11),
+    'Area': (500, 12),
+    'Block': (250, 13),
+    'Station': (None, 14),
+}
+
+EARTH_RADIUS = 6371000
+
+
+def station_table(routes):
+    """One row per station with its coordinates and total trips in and out."""
+    starts = routes.groupby('start_station_name').agg(lat=('start_lat', 'first'), lng=('start_lng', 'first'),
+                                                       trips=('trips', 'sum'))
+    ends = routes.groupby('end_station_name').agg(lat=('end_lat', 'first'), lng=('end_lng', 'first'),
+                                                   trips=('trips', 'sum'))
+    stations = pd.concat([starts, ends])
+    stations.index = stations.index.astype(str)         # names may be read in as categoricals
+    return stations.groupby(level=0).agg(lat=('lat', 'first'), lng=('lng', 'first'), trips=('trips', 'sum'))
+
+
+def cluster_stations(stations, cell_size):
+    """Grid cell of each station and the trip-weighted centre and label of each cell."""
+    # Equirectangular projection around the middle of the city is accurate to well under 1% here
+    lat0 = np.radians(stations['lat'].mean())
+    x = np.radians(stations['lng']) * np.cos(lat0) * EARTH_RADIUS
+    y = np.radians(stations['lat']) * EARTH_RADIUS
+
+    cells = pd.Series(list(zip((x // cell_size).astype(np.int64), (y // cell_size).astype(np.int64))),
+                      index=stations.index)
+    cluster = pd.Series(pd.factorize(cells)[0], index=stations.index, name='cluster')
+
+    df = stations.assign(cluster=cluster, wlat=stations['lat'] * stations['trips'],
+                         wlng=stations['lng'] * stations['trips'])
+    grouped = df.groupby('cluster')
+    centres = pd.DataFrame({
+        'lat': grouped['wlat'].sum() / grouped['trips'].sum(),
+        'lng': grouped['wlng'].sum() / grouped['trips'].sum(),
+        'size': grouped.size(),
+    })
+
+    # Name each cell after its busiest station
+    busiest = df.sort_values('trips', ascending=False).drop_duplicates('cluster')
+    centres['busiest'] = pd.Series(busiest.index, index=busiest['cluster'])
+    centres['label'] = np.where(centres['size'] > 1,
+                                centres['size'].astype(str) + ' stations around ' + centres['busiest'],
+                                centres['busiest'])
+    return cluster, centres
+
+
+def flows_at(routes, stations, cell_size):
+    """Routes merged into flows between grid cells of the given size."""
+    if cell_size is None:
+        return routes[['start_station_name', 'end_station_name', 'trips',
+                       'start_lat', 'start_lng', 'end_lat', 'end_lng']].copy()
+
+    cluster, centres = cluster_stations(stations, cell_size)
+    od = pd.DataFrame({
+        'origin': cluster.reindex(routes['start_station_name']).to_numpy(),
+        'destination': cluster.reindex(routes['end_station_name']).to_numpy(),
+        'trips': routes['trips'].to_numpy(),
+    })
+    flows = od.groupby(['origin', 'destination'], as_index=False)['trips'].sum()
+
+    origin, destination = centres.loc[flows['origin']], centres.loc[flows['destination']]
+    return pd.DataFrame({
+        'start_station_name': origin['label'].to_numpy(),
+        'end_station_name': destination['label'].to_numpy(),
+        'trips': flows['trips'].to_numpy(),
+        'start_lat': origin['lat'].to_numpy(), 'start_lng': origin['lng'].to_numpy(),
+        'end_lat': destination['lat'].to_numpy(), 'end_lng': destination['lng'].to_numpy(),
+    })
+
+
+def build_pyramid(routes, levels=LEVELS):
+    """Flows for every level in one table, heaviest first within each level."""
+    stations = station_table(routes)
+    tables = []
+    for level, (cell_size, zoom) in levels.items():
+        flows = flows_at(routes, stations, cell_size).sort_values('trips', ascending=False)
+        flows.insert(0, 'level', level)
+        tables.append(flows)
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the route flow pyramid for a registered city/year.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    pyramid = build_pyramid(registry.load_table(entry, 'routes'))
+    pyramid.to_parquet(os.path.join(registry.DATA_DIR, entry['path'], registry.TABLES['flow_pyramid']), index=False)
+    registry.register(entry['city'], entry['city_name'], entry['year'], entry['path'])
+    print(pyramid.groupby('level', sort=False).size().to_string())
@@ -0,0 +1,132 @@
+####################################################################################
+############################ Incentive what-if #####################################
+####################################################################################
+
+# Recommendation 3 suggests a discount for rides that end at stations losing
+# bikes.  This estimates what that would do to the yearly imbalance.
+#
+# Stations losing more than `min_deficit` bikes over the year (arrivals minus
+# departures) are offered the discount.  A share of the riders who end their
+# trip at some other station within `radius` of one of them are assumed to take
+# it and ride on to the discounted station; with several in reach they split in
+# proportion to how many bikes each is short.  With `cap` set, no station takes
+# in more riders than it is short of bikes, so the discount never turns a
+# deficit into a surplus.
+#
+# Departures do not change, only where trips end, so the new imbalance is
+#
+#   arrivals - moved + R' (moved) - departures
+#
+# where R is the sparse (destination -> discounted station) split.  The pairs of
+# stations within the largest radius offered are found once with a k-d tree,
+# and each slider change only filters and rescales those pairs, which takes
+# milliseconds for the whole system.
+#
+#   python -m citibike.incentives --city nyc --year 2022 --shift 0.1 --radius 400
+
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from citibike import flows, registry, zones
+
+
+MAX_RADIUS = 1000       # metres; the largest walk the sliders offer
+
+
+class IncentiveModel:
+    """The trip matrix of a routes table, ready for fast what-if runs."""
+
+    def __init__(self, routes, max_radius=MAX_RADIUS):
+        stations, self.od = zones.od_matrix(routes)
+        n = len(stations)
+
+        self.stations = stations.index
+        self.departures = np.asarray(self.od.sum(axis=1)).ravel()
+        self.arrivals = np.asarray(self.od.sum(axis=0)).ravel()
+        self.imbalance = self.arrivals - self.departures
+
+        # Every pair of stations within the largest radius, with the distance between them
+        lat0 = np.radians(stations['lat'].mean())
+        xy = np.column_stack([np.radians(stations['lng']) * np.cos(lat0), np.radians(stations['lat'])]) * flows.EARTH_RADIUS
+        pairs = cKDTree(xy).sparse_distance_matrix(cKDTree(xy), max_radius, output_type='coo_matrix')
+        off_diagonal = pairs.row != pairs.col
+        self.near_from = pairs.row[off_diagonal]
+        self.near_to = pairs.col[off_diagonal]
+        self.near_metres = pairs.data[off_diagonal]
+        self.distance = sparse.csr_matrix((self.near_metres, (self.near_from, self.near_to)), shape=(n, n))
+
+    def redirect(self, radius, min_deficit=0):
+        """Sparse split R of riders from each destination to the discounted stations within radius."""
+        n = len(self.stations)
+        deficit = np.maximum(-self.imbalance, 0)
+        offered = deficit > min_deficit
+
+        keep = (self.near_metres <= radius) & offered[self.near_to] & ~offered[self.near_from]
+        rows, cols = self.near_from[keep], self.near_to[keep]
+        split = sparse.csr_matrix((deficit[cols], (rows, cols)), shape=(n, n))
+        totals = np.asarray(split.sum(axis=1)).ravel()
+        return sparse.diags(np.divide(1.0, totals, out=np.zeros(n), where=totals > 0)) @ split
+
+    def what_if(self, shift=0.1, radius=400, min_deficit=0, cap=True):
+        """Per-station imbalance before and after a share `shift` of riders take the discount.
+
+        Returns a frame indexed by station with departures, arrivals, the
+        imbalance before and after, riders moved out and in, and the average
+        extra distance (m) ridden by those moved in.
+        """
+        split = self.redirect(radius, min_deficit)
+        reachable = np.asarray(split.sum(axis=1)).ravel() > 0
+        offered = np.where(reachable, shift * self.arrivals, 0.0)
+        flow = split.multiply(offered[:, None]).tocsr()        # riders from each destination to each station
+        inflow = np.asarray(flow.sum(axis=0)).ravel()
+        ridden = np.asarray(flow.multiply(self.distance).sum(axis=0)).ravel()
+        # Capping scales every rider into a station alike, so their average extra ride is the same either way
+        extra = np.divide(ridden, inflow, out=np.zeros_like(ridden), where=inflow > 0)
+        moved = offered
+
+        if cap:
+            # Scale down the riders heading to each station to what it is short of, and the
+            # riders leaving each destination to match
+            short = np.maximum(-self.imbalance, 0)
+            scale = np.minimum(1.0, np.divide(short, inflow, out=np.ones_like(inflow), where=inflow > 0))
+            moved = offered * (split @ scale)
+            inflow = inflow * scale
+
+        after = self.arrivals - moved + inflow - self.departures
+        return pd.DataFrame({
+            'departures': self.departures.astype(np.int64), 'arrivals': self.arrivals.astype(np.int64),
+            'imbalance': self.imbalance.astype(np.int64), 'imbalance_after': np.round(after).astype(np.int64),
+            'moved_out': np.round(moved).astype(np.int64), 'moved_in': np.round(inflow).astype(np.int64),
+            'extra_metres': np.round(extra),
+        }, index=self.stations)
+
+
+def summary(result):
+    """Bikes the trucks would have to move before and after, and the riders it takes."""
+    moved = result['moved_in'].sum()
+    return {
+        'rebalancing_before': int(result['imbalance'].clip(lower=0).sum()),
+        'rebalancing_after': int(result['imbalance_after'].clip(lower=0).sum()),
+        'riders_moved': int(moved),
+        'extra_metres': float((result['extra_metres'] * result['moved_in']).sum() / moved) if moved else 0.0,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate the effect of a rebalancing discount for a registered city/year.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    parser.add_argument('--shift', type=float, default=0.1, help='share of riders in reach who take the discount')
+    parser.add_argument('--radius', type=float, default=400, help='furthest extra ride in metres')
+    parser.add_argument('--min-deficit', type=float, default=0, help='only offer at stations short of more bikes than this')
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    model = IncentiveModel(registry.load_table(entry, 'routes'), max(MAX_RADIUS, args.radius))
+    result = summary(model.what_if(args.shift, args.radius, args.min_deficit))
+    print(f"Bikes to rebalance: {result['rebalancing_before']:,} -> {result['rebalancing_after']:,}, "
+          f"{result['riders_moved']:,} riders moved an average of {result['extra_metres']:.0f} m further")
@@ -0,0 +1,259 @@
+####################################################################################
+############################ Station inventory reconstruction ######################
+####################################################################################
+
+# The yearly 'difference' column of the imbalance table hides the swings within
+# each day that actually leave docks empty or full.  This rebuilds the bike count
+# of every station after every trip from the event stream alone.
+#
+# Events (departure -1, arrival +1) are sorted by station and time, and the
+# running sum within each station gives its net flow.  A station can never hold
+# fewer than 0 or more than `capacity` bikes, so wherever the flow would push it
+# outside those bounds bikes must have been dropped off or picked up by the
+# rebalancing crews without any trip being recorded.  The smallest such
+# corrections are found with cumulative maxima: one running maximum gives the
+# bikes that must have been added to stay at or above zero and another the bikes
+# that must have been removed to stay within capacity.  Alternating the two
+# converges to the exact bounded trajectory, and it does so in a handful of
+# rounds when the stream is cut into station-days.  The station-days are chained
+# together by a short loop over the days of the year.
+#
+# The result is kept as memory-mapped arrays (hourly inventory, daily drop-offs
+# and pick-ups per station) for the station drill-down chart, plus a summary
+# table per station.
+#
+#   python -m citibike.inventory --city nyc --year 2022
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from citibike import profiles, query, registry, simulate
+
+
+INVENTORY_DIR = 'station_inventory'
+MINUTES_PER_DAY = simulate.MINUTES_PER_DAY
+
+
+def inventory_path(entry, data_dir=registry.DATA_DIR):
+    return os.path.join(data_dir, entry['path'], INVENTORY_DIR)
+
+
+############################ Segmented scans #######################################
+
+def _segment_starts(segments):
+    return np.flatnonzero(np.r_[True, segments[1:] != segments[:-1]])
+
+
+def _segmented_cumsum(values, starts):
+    total = np.cumsum(values)
+    before = total[starts] - values[starts]
+    return total - np.repeat(before, np.diff(np.r_[starts, len(values)]))
+
+
+def _segmented_cummax(values, segments):
+    # Lifting each segment above everything before it keeps the running maximum from leaking
+    # across segments (values are >= 0 and segments are sorted)
+    step = int(values.max()) + 1 if len(values) else 1
+    offset = segments.astype(np.int64) * step
+    return np.maximum.accumulate(values + offset) - offset
+
+
+def _bounded(flow, start, capacity, segments, max_rounds=100):
+    """Bike count after each event when each segment starts at `start` and stays in [0, capacity].
+
+    Returns the counts and the running total of bikes added and removed to keep them there.
+    """
+    base = start + flow
+    removed = np.zeros_like(base)
+    for _ in range(max_rounds):
+        added = _segmented_cummax(np.maximum(removed - base, 0), segments)
+        new_removed = _segmented_cummax(np.maximum(base + added - capacity, 0), segments)
+        if np.array_equal(new_removed, removed):
+            break
+        removed = new_removed
+    return base + added - removed, added, removed
+
+
+############################ Reconstruction ########################################
+
+def event_stream(departures, arrivals):
+    """Station, minute and +1/-1 of every event, sorted by station then time.
+
+    Within the same minute arrivals come first, so a bike returned and taken
+    again in that minute does not need a drop-off.
+    """
+    station = np.concatenate([departures[1], arrivals[1]]).astype(np.int64)
+    minute = np.concatenate([departures[0], arrivals[0]]).astype(np.int64)
+    delta = np.concatenate([np.full(departures.shape[1], -1, dtype=np.int64),
+                            np.ones(arrivals.shape[1], dtype=np.int64)])
+    order = np.argsort((station * (minute.max() + 1) + minute) * 2 + (delta < 0), kind='stable')
+    return station[order], minute[order], delta[order]
+
+
+def reconstruct(departures, arrivals, capacity, year, initial_fill=0.5):
+    """Implied bike count after every event and the rebalancing needed to explain it.
+
+    Returns a dict of event arrays (station, minute, inventory, dropoffs, pickups),
+    where dropoffs/pickups are the bikes that must have been added or removed
+    just before each event, and the bike count at the start of every day.
+    """
+    n_stations = len(capacity)
+    n_days = len(pd.date_range(f'{year}-01-01', f'{year}-12-31'))
+    capacity = np.asarray(capacity, dtype=np.int64)
+
+    station, minute, delta = event_stream(departures, arrivals)
+    day = np.minimum(minute // MINUTES_PER_DAY, n_days - 1)
+    segments = station * n_days + day
+    starts = _segment_starts(segments)
+    ends = np.r_[starts[1:], len(segments)] - 1
+    flow = _segmented_cumsum(delta, starts)
+    cap = capacity[station]
+
+    # What each station-day does to any starting count: starting empty and starting full
+    # bound the result, and the net flow moves it in between
+    from_empty = _bounded(flow, 0, cap, segments)[0][ends]
+    from_full = _bounded(flow, cap, cap, segments)[0][ends]
+    seg_station, seg_day = station[starts], day[starts]
+
+    shape = (n_days, n_stations)
+    net, low, high = np.zeros(shape, np.int64), np.zeros(shape, np.int64), np.tile(capacity, (n_days, 1))
+    net[seg_day, seg_station] = flow[ends]
+    low[seg_day, seg_station] = from_empty
+    high[seg_day, seg_station] = from_full
+
+    day_start = np.empty((n_days + 1, n_stations), dtype=np.int64)
+    day_start[0] = np.round(capacity * initial_fill)
+    for d in range(n_days):
+        day_start[d + 1] = np.clip(day_start[d] + net[d], low[d], high[d])
+
+    inventory, added, removed = _bounded(flow, day_start[day, station], cap, segments)
+
+    # Turn the running totals into the bikes moved just before each event
+    dropoffs = np.diff(added, prepend=0)
+    pickups = np.diff(removed, prepend=0)
+    dropoffs[starts] = added[starts]
+    pickups[starts] = removed[starts]
+
+    return {'station': station, 'minute': minute, 'inventory': inventory,
+            'dropoffs': dropoffs, 'pickups': pickups, 'flow': flow, 'segments': segments,
+            'day_start': day_start[:n_days]}
+
+
+def hourly_inventory(result, n_stations, n_hours):
+    """(stations, hours) bike count at the end of every hour, carried forward through quiet hours."""
+    hour = result['minute'] // 60
+    ok = hour < n_hours
+    key = result['station'][ok] * n_hours + hour[ok]
+    last = np.r_[key[1:] != key[:-1], True]
+
+    grid = np.full(n_stations * n_hours, -1, dtype=np.int64)
+    grid[key[last]] = result['inventory'][ok][last]
+    grid = grid.reshape(n_stations, n_hours)
+
+    # Carry the last known count forward; before a station's first event it holds its starting count
+    filled = np.where(grid >= 0, np.arange(n_hours), 0)
+    np.maximum.accumulate(filled, axis=1, out=filled)
+    first = np.take_along_axis(grid, filled, axis=1)
+    start = result['day_start'][0]
+    return np.where(first >= 0, first, start[:, None]).astype(np.int16)
+
+
+def summary(result, stations, capacity):
+    """Per station: implied drop-offs and pick-ups, days that needed them and the typical daily swing."""
+    n = len(stations)
+    station = result['station']
+    starts = _segment_starts(result['segments'])
+    seg_station = station[starts]
+
+    swing = np.maximum.reduceat(result['flow'], starts) - np.minimum.reduceat(result['flow'], starts)
+    moved = np.add.reduceat(result['dropoffs'] + result['pickups'], starts)
+    days = np.bincount(seg_station, minlength=n).clip(min=1)
+    max_swing = np.zeros(n, dtype=np.int64)
+    np.maximum.at(max_swing, seg_station, swing)
+
+    return pd.DataFrame({
+        'station': stations,
+        'capacity': capacity,
+        'implied_dropoffs': np.bincount(station, weights=result['dropoffs'], minlength=n).astype(np.int64),
+        'implied_pickups': np.bincount(station, weights=result['pickups'], minlength=n).astype(np.int64),
+        'days_rebalanced': np.bincount(seg_station, weights=moved > 0, minlength=n).astype(np.int64),
+        'mean_daily_swing': (np.bincount(seg_station, weights=swing, minlength=n) / days).round(1),
+        'max_daily_swing': max_swing,
+    })
+
+
+def save(result, stations, capacity, year, path):
+    n = len(stations)
+    n_days = len(result['day_start'])
+    os.makedirs(path, exist_ok=True)
+
+    day = np.minimum(result['minute'] // MINUTES_PER_DAY, n_days - 1)
+    key = result['station'] * n_days + day
+    for name in ['dropoffs', 'pickups']:
+        daily = np.bincount(key, weights=result[name], minlength=n * n_days).reshape(n, n_days)
+        np.save(os.path.join(path, f'{name}.npy'), daily.astype(np.int16))
+
+    np.save(os.path.join(path, 'hourly.npy'), hourly_inventory(result, n, n_days * 24))
+    np.save(os.path.join(path, 'capacity.npy'), np.asarray(capacity, dtype=np.int16))
+    with open(os.path.join(path, 'stations.json'), 'w') as f:
+        json.dump({'stations': list(stations), 'year': int(year)}, f)
+
+
+class StationInventory:
+    """Read-only, memory-mapped access to a reconstructed inventory store."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'stations.json')) as f:
+            info = json.load(f)
+        self.stations = info['stations']
+        self.year = info['year']
+        self.ids = {name: i for i, name in enumerate(self.stations)}
+        self.arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                       for name in ['hourly', 'dropoffs', 'pickups', 'capacity']}
+
+    def __contains__(self, station):
+        return station in self.ids
+
+    def capacity(self, station):
+        return int(self.arrays['capacity'][self.ids[station]])
+
+    def hourly(self, station):
+        bikes = np.asarray(self.arrays['hourly'][self.ids[station]])
+        hours = pd.date_range(f'{self.year}-01-01', periods=len(bikes), freq='h')
+        return pd.DataFrame({'time': hours + pd.Timedelta(hours=1), 'bikes': bikes})
+
+    def rebalancing(self, station):
+        """Days on which bikes must have been dropped off or picked up, and how many."""
+        i = self.ids[station]
+        dropoffs = np.asarray(self.arrays['dropoffs'][i])
+        pickups = np.asarray(self.arrays['pickups'][i])
+        df = pd.DataFrame({'date': pd.date_range(f'{self.year}-01-01', periods=len(dropoffs)),
+                           'dropoffs': dropoffs, 'pickups': pickups})
+        return df[(df['dropoffs'] > 0) | (df['pickups'] > 0)]
+
+
+def build(trips_path, profiles_path, path, year):
+    store = profiles.StationProfiles(profiles_path)
+    capacity = simulate.estimate_capacity(store)
+    departures, arrivals = simulate.load_events(trips_path, store.stations, year)
+    result = reconstruct(departures, arrivals, capacity, year)
+    save(result, store.stations, capacity, year, path)
+    return summary(result, store.stations, capacity)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconstruct station bike counts for a registered city/year.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    table = build(query.trips_path(entry), profiles.profiles_path(entry), inventory_path(entry), args.year)
+    table.to_parquet(os.path.join(registry.DATA_DIR, entry['path'], registry.TABLES['inventory']), index=False)
+    registry.register(entry['city'], entry['city_name'], entry['year'], entry['path'])
+    print(f"Inventory rebuilt for {len(table):,} stations; "
+          f"{table['implied_dropoffs'].sum():,} bikes dropped off and {table['implied_pickups'].sum():,} picked up")
@@ -0,0 +1,208 @@
+####################################################################################
+############################ Live station status feed ##############################
+####################################################################################
+
+# Polls a GBFS feed (station_information + station_status) with asyncio.  One
+# HTTP session is kept open for all requests, failed polls back off
+# exponentially, and the last `history` readings of every station are kept in a
+# ring buffer.  Each poll works out which stations changed and pushes those
+# diffs to every subscriber queue, one per open dashboard session.  A session's
+# queue leaves the feed when the session is closed and garbage collected; one
+# that is not read keeps only the most recent diffs.
+#
+# The real Citi Bike feed lives at https://gbfs.citibikenyc.com/gbfs/en/ and a
+# local stand-in for offline work is started with python -m citibike.mock_gbfs.
+
+import asyncio
+import logging
+import queue
+import random
+import threading
+import time
+import weakref
+from collections import deque
+
+import pandas as pd
+
+
+STATUS_FIELDS = ['num_bikes_available', 'num_ebikes_available', 'num_docks_available',
+                 'is_renting', 'is_returning', 'last_reported']
+
+log = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One subscriber's queue of diffs; it unsubscribes on close() or when garbage collected."""
+
+    def __init__(self, feed, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._finalizer = weakref.finalize(self, feed.unsubscribe, self.queue)
+
+    def close(self):
+        self._finalizer()
+
+
+class StationStatusFeed:
+
+    def __init__(self, base_url, interval=10, history=360, info_interval=3600, max_backoff=300):
+        self.base_url = base_url.rstrip('/')
+        self.interval = interval
+        self.info_interval = info_interval
+        self.max_backoff = max_backoff
+
+        self.information = {}                                   # station_id -> name, lat, lon, capacity
+        self.latest = {}                                        # station_id -> latest status
+        self.history = {}                                       # station_id -> deque of statuses
+        self.history_length = history
+        self.last_update = None
+        self.errors = 0
+
+        self._subscribers = set()
+        self._lock = threading.Lock()                           # guards the subscribers and the dicts above
+        self._stop = None
+        self._loop = None
+
+    ############################ Subscribers ####################################
+
+    def subscribe(self, maxsize=1000):
+        """A Subscription whose queue receives a list of changed stations after every poll.
+
+        Keep it for as long as the reader lives (in session_state for a
+        dashboard session); it leaves the feed when dropped.
+        """
+        subscription = Subscription(self, maxsize)
+        with self._lock:
+            self._subscribers.add(subscription.queue)
+        return subscription
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def _publish(self, diffs):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            # A session that stopped reading should not hold up the feed, so its oldest diffs make room
+            while True:
+                try:
+                    q.put_nowait(diffs)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    ############################ Polling #######################################
+
+    async def _get(self, session, name):
+        async with session.get(f'{self.base_url}/{name}.json') as response:
+            response.raise_for_status()
+            return await response.json()
+
+    def _apply_information(self, payload):
+        information = {
+            s['station_id']: {'name': s.get('name'), 'lat': s.get('lat'), 'lon': s.get('lon'),
+                              'capacity': s.get('capacity')}
+            for s in payload['data']['stations']}
+        with self._lock:
+            self.information = information
+
+    def _apply_status(self, payload):
+        """Store a station_status payload and return the stations that changed."""
+        statuses = [(s['station_id'], {field: s.get(field) for field in STATUS_FIELDS})
+                    for s in payload['data']['stations']]
+
+        diffs = []
+        with self._lock:
+            for station_id, status in statuses:
+                previous = self.latest.get(station_id)
+
+                if previous is None or any(previous[f] != status[f] for f in STATUS_FIELDS if f != 'last_reported'):
+                    diff = {'station_id': station_id, **status}
+                    if previous is not None:
+                        diff['bikes_change'] = (status['num_bikes_available'] or 0) - (previous['num_bikes_available'] or 0)
+                    diffs.append(diff)
+
+                self.latest[station_id] = status
+                self.history.setdefault(station_id, deque(maxlen=self.history_length)).append(status)
+
+            self.last_update = time.time()
+        return diffs
+
+    async def run(self):
+        import aiohttp
+
+        self._stop = asyncio.Event()
+        backoff = self.interval
+        last_info = 0
+
+        timeout = aiohttp.ClientTimeout(total=30)
+        connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=60)
+
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            while not self._stop.is_set():
+                try:
+                    if time.time() - last_info > self.info_interval:
+                        self._apply_information(await self._get(session, 'station_information'))
+                        last_info = time.time()
+
+                    payload = await self._get(session, 'station_status')
+                    diffs = self._apply_status(payload)
+                    if diffs:
+                        self._publish(diffs)
+
+                    # GBFS feeds say how long their data stays fresh; there is no point polling faster
+                    wait = max(self.interval, payload.get('ttl') or 0)
+                    backoff = self.interval
+                    self.errors = 0
+                except Exception as e:
+                    # Network trouble and malformed payloads are expected now and then; anything
+                    # else is logged, but the feed keeps polling either way
+                    if not isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError)):
+                        log.exception('Unexpected error polling %s', self.base_url)
+                    self.errors += 1
+                    backoff = min(backoff * 2, self.max_backoff)
+                    wait = backoff * random.uniform(0.5, 1.0)
+
+                try:
+                    await asyncio.wait_for(self._stop.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    def stop(self):
+        if self._stop is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    def start_in_thread(self):
+        """Run the polling loop in a daemon thread with its own event loop."""
+        self._loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self._loop.run_until_complete, args=(self.run(),), daemon=True)
+        thread.start()
+        return thread
+
+    ############################ Reading #######################################
+
+    def snapshot(self):
+        """Latest status of every station joined to its name, location and capacity."""
+        with self._lock:
+            rows = [{'station_id': station_id, **self.information.get(station_id, {}), **status}
+                    for station_id, status in self.latest.items()]
+        return pd.DataFrame(rows)
+
+    def station_history(self, station_id):
+        with self._lock:
+            history = list(self.history.get(station_id, []))
+        return pd.DataFrame(history)
+
+
+def drain(q):
+    """All diffs waiting on a subscriber queue (or Subscription), flattened into one frame."""
+    q = q.queue if isinstance(q, Subscription) else q
+    diffs = []
+    while True:
+        try:
+            diffs.extend(q.get_nowait())
+        except queue.Empty:
+            return pd.DataFrame(diffs)
@@ -0,0 +1,288 @@
+####################################################################################
+############################## Dashboard load test #################################
+####################################################################################
+
+# How many people can use the dashboard at once before pages get slow?
+#
+# This opens N sessions against a dashboard running on this machine.  Each
+# session speaks the same WebSocket protocol as the Streamlit frontend
+# (protobuf BackMsg/ForwardMsg on /_stcore/stream): it asks for a run of the
+# script, reads everything the server sends back until the run has finished,
+# pauses as a reader would and then picks another page from the sidebar, as a
+# browser would after a click.  The time from asking for a run to the
+# script_finished message is the rerun latency a viewer waits for.  Large
+# messages the server only sends by reference are fetched over HTTP, as the
+# browser does.
+#
+# While the sessions run, the CPU time and resident memory of the server
+# process are sampled with psutil, so the report gives the cost of every rerun
+# and of every open session.  Several session counts can be given to see where
+# latency starts to climb; --max-p95 makes the run fail above a latency budget.
+#
+#   streamlit run Citi_Bike_Dashboard.py --server.headless true
+#   python -m citibike.loadtest --sessions 1 10 25 50 --duration 60 [--out loadtest.csv]
+
+import argparse
+import asyncio
+import ipaddress
+import os
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+import numpy as np
+import pandas as pd
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+
+THINK = 5               # seconds; mean pause between page switches
+
+
+def check_local(url):
+    """Refuse anything that is not on this machine: this is a load generator."""
+    host = urlsplit(url).hostname
+    if host == 'localhost':
+        return
+    try:
+        if ipaddress.ip_address(host).is_loopback:
+            return
+    except ValueError:
+        pass
+    raise ValueError(f'{url} is not a local address; the load test only runs against localhost')
+
+
+############################ Sessions ##############################################
+
+class Session:
+    """One simulated viewer on its own WebSocket connection."""
+
+    def __init__(self, http, base_url):
+        self.http = http
+        self.base_url = base_url.rstrip('/')
+        self.page_widget = None             # the sidebar page selectbox, once the server has sent it
+        self.ws = None
+
+    @property
+    def pages(self):
+        return list(self.page_widget.options) if self.page_widget is not None else []
+
+    async def connect(self):
+        stream = 'ws' + self.base_url[len('http'):] + '/_stcore/stream'
+        self.ws = await self.http.ws_connect(stream, protocols=('streamlit',), max_msg_size=0)
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+    async def run(self, page=None):
+        """Ask for a run of the script, optionally on another page, and time it to the end of the run."""
+        msg = BackMsg()
+        msg.rerun_script.query_string = ''
+        if page is not None:
+            self._set_page(msg.rerun_script.widget_states.widgets.add(), page)
+
+        start = time.perf_counter()
+        await self.ws.send_bytes(msg.SerializeToString())
+        while True:
+            reply = await self.ws.receive()
+            if reply.type != aiohttp.WSMsgType.BINARY:
+                raise ConnectionError(f'session closed by the server ({reply.type.name})')
+            status = await self._handle(ForwardMsg.FromString(reply.data))
+            if status is not None and status != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                return time.perf_counter() - start, ForwardMsg.ScriptFinishedStatus.Name(status)
+
+    async def _handle(self, forward):
+        kind = forward.WhichOneof('type')
+        if kind == 'script_finished':
+            return forward.script_finished
+        if kind == 'ref_hash':
+            # Sent only by reference because this session has had it before
+            async with self.http.get(f'{self.base_url}/_stcore/message', params={'hash': forward.ref_hash}) as response:
+                if response.status == 200:
+                    return await self._handle(ForwardMsg.FromString(await response.read()))
+        elif kind == 'delta' and self.page_widget is None and forward.delta.WhichOneof('type') == 'new_element':
+            element = forward.delta.new_element
+            if element.WhichOneof('type') == 'selectbox' and element.selectbox.options[:1] and \
+                    element.selectbox.options[0].startswith('1. '):
+                self.page_widget = element.selectbox
+        return None
+
+    def _set_page(self, state, page):
+        state.id = self.page_widget.id
+        if 'accept_new_options' in self.page_widget.DESCRIPTOR.fields_by_name:
+            state.string_value = self.page_widget.options[page]        # newer Streamlit keeps the option text
+        else:
+            state.int_value = page
+
+
+async def browse(http, base_url, until, think, rng, results):
+    """One viewer: open the app, then switch pages until the time is up."""
+    session = Session(http, base_url)
+    try:
+        await session.connect()
+        seconds, status = await session.run()
+        results.append(('(landing)', seconds, status))
+        page = 0
+        while time.monotonic() < until and len(session.pages) > 1:
+            await asyncio.sleep(min(rng.exponential(think), max(0.0, until - time.monotonic())))
+            page = (page + rng.integers(1, len(session.pages))) % len(session.pages)     # any page but this one
+            seconds, status = await session.run(page)
+            results.append((session.pages[page], seconds, status))
+    except (ConnectionError, OSError, asyncio.TimeoutError, aiohttp.ClientError) as error:
+        results.append(('(error)', np.nan, type(error).__name__))
+    finally:
+        await session.close()
+
+
+############################ Server resources ######################################
+
+def server_process(port, pid=None):
+    """The process serving the dashboard, from its pid or the port it listens on (None without psutil)."""
+    try:
+        import psutil
+    except ImportError:
+        return None
+    if pid:
+        return psutil.Process(pid)
+    try:
+        for conn in psutil.net_connections('tcp'):
+            if conn.status == psutil.CONN_LISTEN and conn.laddr.port == port and conn.pid:
+                return psutil.Process(conn.pid)
+    except psutil.AccessDenied:
+        pass
+    return None
+
+
+class ResourceMonitor:
+    """CPU seconds and peak resident memory of a process and its children between start() and stop()."""
+
+    def __init__(self, process, interval=0.25):
+        import psutil
+
+        self._gone = psutil.Error
+        self.process = process
+        self.interval = interval
+        self._task = None
+
+    def _cpu_and_rss(self):
+        processes = [self.process] + self.process.children(recursive=True)
+        cpu = rss = 0
+        for p in processes:
+            try:
+                times = p.cpu_times()
+                cpu += times.user + times.system
+                rss += p.memory_info().rss
+            except self._gone:              # a child exited between listing and reading it
+                continue
+        return cpu, rss
+
+    async def _sample(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, self._cpu_and_rss()[1])
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.start_cpu, self.base_rss = self._cpu_and_rss()
+        self.peak_rss = self.base_rss
+        self.start_time = time.monotonic()
+        self._task = asyncio.ensure_future(self._sample())
+
+    def stop(self):
+        self._task.cancel()
+        cpu, rss = self._cpu_and_rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.cpu_seconds = cpu - self.start_cpu
+        self.wall_seconds = time.monotonic() - self.start_time
+
+
+############################ Load levels ###########################################
+
+async def run_level(base_url, n_sessions, duration, think=THINK, ramp=10, process=None, seed=0):
+    """Run n_sessions viewers for duration seconds; every rerun as (page, seconds, status), and the monitor."""
+    rng = np.random.default_rng(seed)
+    results = []
+    monitor = ResourceMonitor(process) if process is not None else None
+    connector = aiohttp.TCPConnector(limit=0)               # one connection per viewer, as browsers have
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as http:
+        if monitor:
+            monitor.start()
+        until = time.monotonic() + duration
+        viewers = []
+        for i in range(n_sessions):
+            # Spread the arrivals over the ramp so the first runs do not all land at once
+            viewers.append(asyncio.ensure_future(browse(http, base_url, until, think,
+                                                        np.random.default_rng(rng.integers(2 ** 32)), results)))
+            await asyncio.sleep(ramp / n_sessions)
+        await asyncio.gather(*viewers)
+        if monitor:
+            monitor.stop()
+    return pd.DataFrame(results, columns=['page', 'seconds', 'status']), monitor
+
+
+def report(n_sessions, reruns, monitor=None):
+    """One row of the summary: rerun latency percentiles (ms) and server cost."""
+    ok = reruns[reruns['page'] != '(error)']
+    landing = ok[ok['page'] == '(landing)']['seconds'] * 1000
+    switches = ok[ok['page'] != '(landing)']['seconds'] * 1000
+    row = {
+        'sessions': n_sessions,
+        'reruns': len(ok),
+        'errors': int((reruns['page'] == '(error)').sum() + (ok['status'] != 'FINISHED_SUCCESSFULLY').sum()),
+        'landing_p95_ms': round(float(np.percentile(landing, 95)), 1) if len(landing) else np.nan,
+    }
+    for q in (50, 95, 99):
+        row[f'p{q}_ms'] = round(float(np.percentile(switches, q)), 1) if len(switches) else np.nan
+    if monitor is not None:
+        row['cpu_percent'] = round(100 * monitor.cpu_seconds / monitor.wall_seconds, 1)
+        row['cpu_ms_per_rerun'] = round(1000 * monitor.cpu_seconds / max(len(ok), 1), 1)
+        row['peak_rss_mb'] = round(monitor.peak_rss / 2 ** 20, 1)
+        row['mb_per_session'] = round((monitor.peak_rss - monitor.base_rss) / 2 ** 20 / n_sessions, 2)
+    return row
+
+
+def page_report(reruns):
+    """Rerun latency percentiles (ms) for every page."""
+    ok = reruns[reruns['status'] == 'FINISHED_SUCCESSFULLY']
+    by_page = ok.groupby('page')['seconds']
+    return pd.DataFrame({
+        'reruns': by_page.size(),
+        'p50_ms': by_page.quantile(0.5) * 1000,
+        'p95_ms': by_page.quantile(0.95) * 1000,
+        'p99_ms': by_page.quantile(0.99) * 1000,
+    }).round(1).sort_values('p95_ms', ascending=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test a dashboard running on this machine with simulated viewers.')
+    parser.add_argument('--url', default='http://localhost:8501')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 10, 25], help='session counts to run in turn')
+    parser.add_argument('--duration', type=float, default=60, help='seconds per session count')
+    parser.add_argument('--think', type=float, default=THINK, help='mean seconds between page switches')
+    parser.add_argument('--ramp', type=float, default=10, help='seconds over which the sessions arrive')
+    parser.add_argument('--pid', type=int, help='server process to sample (found from the port if not given)')
+    parser.add_argument('--out', help='append the summary rows to this CSV, to track scaling over time')
+    parser.add_argument('--max-p95', type=float, help='exit with an error if p95 rerun latency (ms) exceeds this')
+    args = parser.parse_args()
+
+    check_local(args.url)
+    process = server_process(urlsplit(args.url).port or 80, args.pid)
+    if process is None:
+        print('Server CPU and memory not sampled (needs psutil and access to the server process; try --pid)')
+
+    rows = []
+    for n_sessions in args.sessions:
+        reruns, monitor = asyncio.run(run_level(args.url, n_sessions, args.duration, args.think, args.ramp, process))
+        rows.append(report(n_sessions, reruns, monitor))
+        print(pd.DataFrame([rows[-1]]).to_string(index=False))
+
+    print()
+    print(f'Rerun latency by page at {args.sessions[-1]} sessions:')
+    print(page_report(reruns).to_string())
+
+    summary = pd.DataFrame(rows)
+    if args.out:
+        summary.assign(run_at=pd.Timestamp.now().floor('s')).to_csv(
+            args.out, mode='a', header=not os.path.exists(args.out), index=False)
+    if args.max_p95 is not None and (summary['p95_ms'] > args.max_p95).any():
+        raise SystemExit(f'p95 rerun latency above {args.max_p95:.0f} ms')
@@ -0,0 +1,215 @@
+####################################################################################
+################################ deck.gl station maps ##############################
+####################################################################################
+
+# The station and route maps used to be Kepler HTML files exported by hand from
+# the Ex 2.5 notebook.  They are now drawn with deck.gl layers (through pydeck)
+# straight from the aggregate tables, styled from the exported Kepler config in
+# 03 Scripts/map_config.json so they look the same.
+#
+# Streamlit hands pydeck layers to the browser as JSON, so to keep 100k+ arcs
+# manageable only the columns a layer draws are sent, with coordinates rounded
+# to 5 decimals (about 1 m), and filtering happens before the data is sent.
+#
+#   python -m citibike.maps --city nyc --year 2022      (builds the routes table)
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from citibike import query, registry
+
+
+MAP_CONFIG = os.path.join('03 Scripts', 'map_config.json')
+
+# Orange for departures and blue for arrivals, as on the rest of the dashboard
+DEPARTURE_COLOR = [253, 174, 97]
+ARRIVAL_COLOR = [44, 123, 182]
+
+# Station types from citibike.typology: stations losing bikes in the morning are drawn like departures
+TYPE_COLORS = {
+    'Commuter origin': DEPARTURE_COLOR,
+    'Commuter destination': ARRIVAL_COLOR,
+    'Leisure': [102, 189, 99],
+    'Mixed': [220, 220, 220],
+    'Low use': [110, 110, 110],
+}
+
+
+def hex_to_rgb(color):
+    color = color.lstrip('#')
+    return [int(color[i:i + 2], 16) for i in (0, 2, 4)]
+
+
+def degrees(values):
+    """Coordinates rounded to 5 decimals, widened first so float32 columns do not reach the JSON with 15 digits."""
+    return values.astype(np.float64).round(5)
+
+
+def load_map_config(path=MAP_CONFIG):
+    with open(path) as f:
+        return json.load(f)['config']
+
+
+def point_style(config):
+    """Colour range, radius and opacity of the first point layer in a Kepler config."""
+    for layer in config['visState']['layers']:
+        if layer['type'] == 'point':
+            vis = layer['config']['visConfig']
+            return {'colors': [hex_to_rgb(c) for c in vis['colorRange']['colors']],
+                    'radius': vis['radius'], 'opacity': vis['opacity']}
+    raise ValueError('The map config has no point layer')
+
+
+def view_state(config, **overrides):
+    import pydeck as pdk
+
+    map_state = config['mapState']
+    settings = dict(latitude=map_state['latitude'], longitude=map_state['longitude'], zoom=map_state['zoom'],
+                    bearing=map_state['bearing'], pitch=map_state['pitch'])
+    settings.update(overrides)
+    return pdk.ViewState(**settings)
+
+
+def quantile_colors(values, colors):
+    """Kepler's 'quantile' colour scale: equal numbers of points in each colour."""
+    values = np.asarray(values, dtype=np.float64)
+    edges = np.quantile(values, np.linspace(0, 1, len(colors) + 1)[1:-1])
+    return np.asarray(colors, dtype=np.uint8)[np.searchsorted(edges, values, side='right')]
+
+
+def station_layers(stations, config, value='total_departures', hexagons=False):
+    """Scatterplot (or hexagon density) layer of stations coloured by value."""
+    import pydeck as pdk
+
+    style = point_style(config)
+    df = pd.DataFrame({
+        'station_name': stations['station_name'] if 'station_name' in stations else stations.index,
+        'lng': degrees(stations['longitude']),
+        'lat': degrees(stations['latitude']),
+        'value': stations[value],
+    })
+
+    if hexagons:
+        return [pdk.Layer(
+            'HexagonLayer', df, get_position=['lng', 'lat'], get_elevation_weight='value',
+            elevation_aggregation='SUM', radius=250, elevation_scale=4, extruded=True, pickable=True,
+            color_range=style['colors'], opacity=style['opacity'])]
+
+    df[['r', 'g', 'b']] = quantile_colors(df['value'], style['colors'])
+    return [pdk.Layer(
+        'ScatterplotLayer', df, get_position=['lng', 'lat'], get_fill_color=['r', 'g', 'b'],
+        get_radius=style['radius'] * 5, radius_min_pixels=2, opacity=style['opacity'], pickable=True)]
+
+
+def category_layer(stations, config, column='label', colors=TYPE_COLORS):
+    """Scatterplot layer of stations coloured by a category such as the station type."""
+    import pydeck as pdk
+
+    style = point_style(config)
+    df = pd.DataFrame({
+        'station_name': stations['station_name'] if 'station_name' in stations else stations.index,
+        'lng': degrees(stations['longitude']),
+        'lat': degrees(stations['latitude']),
+        column: stations[column].astype(str),
+    })
+    rgb = np.array([colors.get(c, [128, 128, 128]) for c in df[column]], dtype=np.uint8).reshape(-1, 3)
+    df[['r', 'g', 'b']] = rgb
+    return [pdk.Layer(
+        'ScatterplotLayer', df, get_position=['lng', 'lat'], get_fill_color=['r', 'g', 'b'],
+        get_radius=style['radius'] * 5, radius_min_pixels=2, opacity=style['opacity'], pickable=True)]
+
+
+def zone_layer(outlines, color=(255, 255, 255)):
+    """Outlines of the rebalancing zones (citibike.zones.outlines), drawn under the stations."""
+    import pydeck as pdk
+
+    # Not pickable, so hovering still shows the station or route underneath
+    return [pdk.Layer(
+        'PolygonLayer', outlines, get_polygon='polygon', filled=True, get_fill_color=[*color, 12], stroked=True,
+        get_line_color=[*color, 160], line_width_min_pixels=1.5, pickable=False)]
+
+
+def image_layer(url, bounds):
+    """A raster (e.g. citibike.coverage.surface_image as a PNG data URL) stretched over [west, south, east, north]."""
+    import pydeck as pdk
+
+    return [pdk.Layer('BitmapLayer', data=None, image=url, bounds=bounds, pickable=False)]
+
+
+def site_layer(sites, color=(255, 255, 255)):
+    """Ranked candidate station sites as numbered rings, with station_name and label for the tooltip."""
+    import pydeck as pdk
+
+    df = pd.DataFrame({
+        'station_name': 'Candidate site ' + sites['rank'].astype(str),
+        'label': (sites['coverage'] * 100).round(1).astype(str) + '% covered once built',
+        'lng': degrees(sites['longitude']), 'lat': degrees(sites['latitude']), 'rank': sites['rank'].astype(str),
+    })
+    return [
+        pdk.Layer('ScatterplotLayer', df, get_position=['lng', 'lat'], get_radius=120, radius_min_pixels=6,
+                  stroked=True, filled=False, get_line_color=list(color), line_width_min_pixels=2, pickable=True),
+        pdk.Layer('TextLayer', df, get_position=['lng', 'lat'], get_text='rank', get_size=12,
+                  get_color=list(color), get_pixel_offset=[0, -16]),
+    ]
+
+
+def route_layer(routes, min_trips=0, width_scale=1.0):
+    """Arc layer of routes with at least min_trips trips; round trips are drawn as points."""
+    import pydeck as pdk
+
+    routes = routes[routes['trips'] >= min_trips]
+    df = pd.DataFrame({
+        'from': routes['start_station_name'], 'to': routes['end_station_name'], 'trips': routes['trips'],
+        'slng': degrees(routes['start_lng']), 'slat': degrees(routes['start_lat']),
+        'elng': degrees(routes['end_lng']), 'elat': degrees(routes['end_lat']),
+    })
+    df['width'] = (np.sqrt(df['trips'] / df['trips'].max()) * 10 * width_scale).round(2) if len(df) else []
+
+    round_trips = df['from'] == df['to']
+
+    layers = [pdk.Layer(
+        'ArcLayer', df[~round_trips], get_source_position=['slng', 'slat'], get_target_position=['elng', 'elat'],
+        get_source_color=DEPARTURE_COLOR, get_target_color=ARRIVAL_COLOR, get_width='width',
+        width_min_pixels=1, pickable=True, auto_highlight=True)]
+
+    if round_trips.any():
+        layers.append(pdk.Layer(
+            'ScatterplotLayer', df[round_trips], get_position=['slng', 'slat'], get_fill_color=DEPARTURE_COLOR,
+            get_radius='width * 20', radius_min_pixels=3, pickable=True))
+    return layers
+
+
+def deck(layers, view, tooltip):
+    import pydeck as pdk
+
+    return pdk.Deck(layers=layers, initial_view_state=view, map_style='dark', tooltip=tooltip)
+
+
+def build_routes(trips_path):
+    """Trips per (start, end) station pair with coordinates, as in Ex 2.5 but for every pair."""
+    con = query.connect(trips_path)
+    return con.execute("""
+        SELECT start_station_name, end_station_name, count(*) AS trips,
+               any_value(start_lat) AS start_lat, any_value(start_lng) AS start_lng,
+               any_value(end_lat) AS end_lat, any_value(end_lng) AS end_lng
+        FROM trips
+        WHERE start_station_name IS NOT NULL AND end_station_name IS NOT NULL
+        GROUP BY ALL
+        ORDER BY trips DESC""").df()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the station-to-station routes table for a registered city/year.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    routes = build_routes(query.trips_path(entry))
+    routes.to_parquet(os.path.join(registry.DATA_DIR, entry['path'], registry.TABLES['routes']), index=False)
+    registry.register(entry['city'], entry['city_name'], entry['year'], entry['path'])
+    print(f'{len(routes):,} routes written for {args.city} {args.year}')
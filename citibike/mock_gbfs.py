@@ -0,0 +1,89 @@
+####################################################################################
+############################## Mock GBFS feed server ###############################
+####################################################################################
+
+# A local stand-in for the Citi Bike GBFS feed so the live ingestion can be
+# developed and tested offline.  Stations come from start_stations.csv and each
+# request to station_status moves every station's bike count a little, as if
+# trips were being taken.
+#
+#   python -m citibike.mock_gbfs --port 8765
+#
+# then point the dashboard at it with CITIBIKE_GBFS_URL=http://localhost:8765/gbfs/en
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from citibike import registry
+
+
+class MockSystem:
+
+    def __init__(self, stations, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.stations = stations.reset_index(drop=True)
+        n = len(self.stations)
+        self.ids = [str(1000 + i) for i in range(n)]
+        self.capacity = self.rng.integers(15, 60, n)
+        self.bikes = (self.capacity * self.rng.uniform(0.2, 0.8, n)).astype(int)
+
+    def step(self):
+        # Busier stations see bigger swings
+        weight = (self.stations['total_departures'] / self.stations['total_departures'].max()).to_numpy()
+        change = self.rng.poisson(3 * weight) - self.rng.poisson(3 * weight)
+        self.bikes = np.clip(self.bikes + change, 0, self.capacity)
+
+    def information(self):
+        return [{'station_id': station_id, 'name': row['station_name'], 'lat': float(row['latitude']),
+                 'lon': float(row['longitude']), 'capacity': int(capacity)}
+                for station_id, (_, row), capacity in zip(self.ids, self.stations.iterrows(), self.capacity)]
+
+    def status(self):
+        now = int(time.time())
+        return [{'station_id': station_id, 'num_bikes_available': int(bikes),
+                 'num_ebikes_available': int(bikes // 4), 'num_docks_available': int(capacity - bikes),
+                 'is_renting': 1, 'is_returning': 1, 'last_reported': now}
+                for station_id, bikes, capacity in zip(self.ids, self.bikes, self.capacity)]
+
+
+def make_app(system, ttl=5):
+    from aiohttp import web
+
+    def envelope(data):
+        return {'last_updated': int(time.time()), 'ttl': ttl, 'data': data}
+
+    async def gbfs(request):
+        base = f'{request.scheme}://{request.host}/gbfs/en'
+        feeds = [{'name': name, 'url': f'{base}/{name}.json'} for name in ['station_information', 'station_status']]
+        return web.json_response(envelope({'en': {'feeds': feeds}}))
+
+    async def station_information(request):
+        return web.json_response(envelope({'stations': system.information()}))
+
+    async def station_status(request):
+        system.step()
+        return web.json_response(envelope({'stations': system.status()}))
+
+    app = web.Application()
+    app.router.add_get('/gbfs/gbfs.json', gbfs)
+    app.router.add_get('/gbfs/en/station_information.json', station_information)
+    app.router.add_get('/gbfs/en/station_status.json', station_status)
+    return app
+
+
+if __name__ == '__main__':
+    from aiohttp import web
+
+    parser = argparse.ArgumentParser(description='Serve a mock GBFS feed built from the station aggregates.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--city', default='nyc')
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--ttl', type=int, default=5)
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    system = MockSystem(registry.load_table(entry, 'start_stations'))
+    web.run_app(make_app(system, args.ttl), host='127.0.0.1', port=args.port)
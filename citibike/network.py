@@ -0,0 +1,395 @@
+####################################################################################
+########################### Street network travel times ############################
+####################################################################################
+
+# Distances between stations have so far been straight lines.  This reads a
+# local OpenStreetMap extract of the streets a bike can use and works out the
+# shortest cycling distance and the fastest cycling time between every pair of
+# stations, once, into a compact cache that route detours, rider speeds and
+# truck routing then read from.
+#
+#   1. The ways of the extract become a sparse graph: one edge per pair of
+#      consecutive way nodes, weighted by its length, and by its length over a
+#      typical cycling speed for the kind of street.  One-way streets only get
+#      an edge in their direction unless bikes are allowed both ways.
+#   2. Each station is snapped to the nearest node of the largest connected
+#      part of the network (islands of footpaths would trap it otherwise).
+#   3. scipy's Dijkstra runs from batches of station nodes at once, and only
+#      the station columns of each batch are kept, so the memory used is a few
+#      batches of rows rather than stations x nodes.
+#
+# The matrices are saved as 16-bit integers (metres and seconds, 65535 for
+# unreachable or further than that), about 6 MB each for 1,700 stations, and
+# memory-mapped when read.  The cache records a hash of the extract and the
+# station list and is only rebuilt when either changes.
+#
+# The extract must be OSM XML (.osm, optionally .gz or .bz2); a .pbf extract
+# can be converted with `osmium cat extract.osm.pbf -o extract.osm`.
+#
+#   python -m citibike.network --city nyc --year 2022 --osm data/nyc/streets.osm
+
+import argparse
+import bz2
+import gzip
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+from citibike import flows, query, registry
+
+
+MATRIX_DIR = 'network_matrix'
+UNREACHABLE = np.iinfo(np.uint16).max
+
+# Typical cycling speed in km/h by OSM highway class; classes missing here are not cycled on
+SPEEDS = {
+    'cycleway': 16, 'primary': 14, 'primary_link': 14, 'secondary': 15, 'secondary_link': 15,
+    'tertiary': 15, 'tertiary_link': 15, 'unclassified': 15, 'residential': 15, 'living_street': 10,
+    'service': 12, 'road': 14, 'trunk': 12, 'trunk_link': 12, 'path': 10, 'track': 10,
+    'pedestrian': 8, 'footway': 8,
+}
+
+# Footways only count where bikes are allowed on them
+NEEDS_BICYCLE_TAG = {'pedestrian', 'footway'}
+
+
+def matrix_path(entry, data_dir=registry.DATA_DIR):
+    return os.path.join(data_dir, entry['path'], MATRIX_DIR)
+
+
+############################ Street graph ##########################################
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _cyclable(tags):
+    highway = tags.get('highway')
+    if highway not in SPEEDS or tags.get('bicycle') == 'no' or tags.get('access') in ('no', 'private'):
+        return None
+    if highway in NEEDS_BICYCLE_TAG and tags.get('bicycle') not in ('yes', 'designated', 'permissive'):
+        return None
+    return SPEEDS[highway] * (1.1 if tags.get('cycleway') in ('lane', 'track') else 1.0)
+
+
+def _oneway(tags):
+    # 1 forwards only, -1 backwards only, 0 both ways
+    if tags.get('oneway:bicycle') == 'no' or str(tags.get('cycleway', '')).startswith('opposite'):
+        return 0
+    oneway = tags.get('oneway')
+    if oneway in ('yes', 'true', '1') or tags.get('junction') == 'roundabout':
+        return 1
+    return -1 if oneway == '-1' else 0
+
+
+def read_osm(path):
+    """Nodes and cyclable way segments of an OSM XML extract.
+
+    Returns node ids, latitudes and longitudes, and per segment the two node
+    ids, the speed in km/h and the one-way direction.  Elements are cleared as
+    they are read, so only the arrays are kept in memory.
+    """
+    node_ids, lats, lngs = [], [], []
+    starts, ends, speeds, oneways = [], [], [], []
+    refs, tags = [], {}
+    root = None
+
+    with _open(path) as f:
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                root = elem if root is None else root
+                if elem.tag == 'way':
+                    refs, tags = [], {}
+                continue
+
+            if elem.tag == 'node':
+                node_ids.append(int(elem.get('id')))
+                lats.append(float(elem.get('lat')))
+                lngs.append(float(elem.get('lon')))
+            elif elem.tag == 'nd':
+                refs.append(int(elem.get('ref')))
+                continue
+            elif elem.tag == 'tag':
+                tags[elem.get('k')] = elem.get('v')
+                continue
+            elif elem.tag == 'way':
+                speed = _cyclable(tags)
+                if speed is not None and len(refs) > 1:
+                    starts.extend(refs[:-1])
+                    ends.extend(refs[1:])
+                    speeds.extend([speed] * (len(refs) - 1))
+                    oneways.extend([_oneway(tags)] * (len(refs) - 1))
+            elif elem.tag != 'relation':
+                continue
+            root.clear()                    # drops the finished element and everything in it
+
+    nodes = pd.DataFrame({'id': np.array(node_ids, dtype=np.int64), 'lat': lats, 'lng': lngs})
+    segments = pd.DataFrame({'start': np.array(starts, dtype=np.int64), 'end': np.array(ends, dtype=np.int64),
+                             'speed': np.array(speeds, dtype=np.float64), 'oneway': np.array(oneways, dtype=np.int8)})
+    return nodes, segments
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance in metres."""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * flows.EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def street_graph(nodes, segments):
+    """Sparse graphs of segment lengths (m) and cycling times (s) over the nodes the ways use.
+
+    Returns the two graphs and the coordinates of their nodes.
+    """
+    used = pd.Index(np.unique(np.concatenate([segments['start'], segments['end']])))
+    nodes = nodes.drop_duplicates('id').set_index('id').reindex(used).dropna()
+
+    # Ways can run off the edge of an extract, so drop segments with a node that is not in it
+    start = nodes.index.get_indexer(segments['start'])
+    end = nodes.index.get_indexer(segments['end'])
+    ok = (start >= 0) & (end >= 0)
+    start, end = start[ok], end[ok]
+    speed, oneway = segments['speed'].to_numpy()[ok], segments['oneway'].to_numpy()[ok]
+
+    lat, lng = nodes['lat'].to_numpy(), nodes['lng'].to_numpy()
+    length = haversine(lat[start], lng[start], lat[end], lng[end])
+
+    # Forward edges unless the way is one-way backwards, and backward edges unless one-way forwards
+    forward, backward = oneway >= 0, oneway <= 0
+    u = np.concatenate([start[forward], end[backward]])
+    v = np.concatenate([end[forward], start[backward]])
+    metres = np.concatenate([length[forward], length[backward]])
+    seconds = metres / (np.concatenate([speed[forward], speed[backward]]) / 3.6)
+
+    n = len(nodes)
+    return _adjacency(u, v, metres, n), _adjacency(u, v, seconds, n), lat, lng
+
+
+def _adjacency(u, v, weight, n):
+    # Parallel edges keep the lightest one (a sparse build would add them up), and zero-length
+    # edges get a token weight so they do not vanish from the matrix
+    order = np.lexsort((weight, v, u))
+    u, v, weight = u[order], v[order], weight[order]
+    first = np.r_[True, (u[1:] != u[:-1]) | (v[1:] != v[:-1])]
+    return sparse.csr_matrix((np.maximum(weight[first], 0.01), (u[first], v[first])), shape=(n, n))
+
+
+def snap(stations, lat, lng, graph):
+    """Nearest node of the largest strongly connected part of the network to each station, and how far it is."""
+    _, component = csgraph.connected_components(graph, directed=True, connection='strong')
+    main = np.flatnonzero(component == np.bincount(component).argmax())
+
+    lat0 = np.radians(np.mean(lat[main]))
+    scale = np.array([np.cos(lat0), 1.0]) * np.pi / 180 * flows.EARTH_RADIUS
+    tree = cKDTree(np.column_stack([lng[main], lat[main]]) * scale)
+    offset, nearest = tree.query(np.column_stack([stations['lng'], stations['lat']]) * scale)
+    return main[nearest], offset
+
+
+############################ Matrix ################################################
+
+def _from_sources(graph, sources, targets):
+    # Shortest paths from a batch of sources, keeping only the target columns
+    found = csgraph.dijkstra(graph, directed=True, indices=sources)
+    return found[:, targets]
+
+
+def _to_uint16(values):
+    values = np.where(np.isfinite(values), np.round(values), UNREACHABLE)
+    return np.clip(values, 0, UNREACHABLE).astype(np.uint16)
+
+
+def station_matrices(graphs, station_nodes, batch_size=32, jobs=None):
+    """(stations, stations) shortest distance and fastest time between station nodes.
+
+    Batches of sources are spread over processes; each only returns its rows.
+    """
+    batches = [station_nodes[i:i + batch_size] for i in range(0, len(station_nodes), batch_size)]
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for name, graph in graphs.items():
+            futures = [pool.submit(_from_sources, graph, batch, station_nodes) for batch in batches]
+            results[name] = _to_uint16(np.vstack([f.result() for f in futures]))
+    return results
+
+
+def fingerprint(osm_path, stations):
+    digest = hashlib.sha256()
+    with open(osm_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    digest.update(json.dumps(list(stations.index)).encode())
+    digest.update(np.round(stations[['lat', 'lng']].to_numpy(), 5).tobytes())
+    return digest.hexdigest()
+
+
+def build(osm_path, stations, path, jobs=None, force=False):
+    """Build (or reuse) the travel matrix cache for stations (index = name, with lat and lng)."""
+    key = fingerprint(osm_path, stations)
+    info_path = os.path.join(path, 'stations.json')
+    if not force and os.path.exists(info_path):
+        with open(info_path) as f:
+            if json.load(f).get('fingerprint') == key:
+                return TravelMatrix(path)
+
+    distance, time, lat, lng = street_graph(*read_osm(osm_path))
+    nodes, offset = snap(stations, lat, lng, distance)
+    matrices = station_matrices({'distance': distance, 'time': time}, nodes, jobs=jobs)
+
+    os.makedirs(path, exist_ok=True)
+    for name, matrix in matrices.items():
+        np.save(os.path.join(path, f'{name}.npy'), matrix)
+    with open(info_path, 'w') as f:
+        json.dump({'stations': list(stations.index), 'snap_metres': np.round(offset, 1).tolist(),
+                   'fingerprint': key}, f)
+    return TravelMatrix(path)
+
+
+class TravelMatrix:
+    """Read-only, memory-mapped access to the station travel matrices.
+
+    Distances are in metres and times in seconds; pairs with no path (or beyond
+    65 km / 18 hours) come back as NaN.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'stations.json')) as f:
+            info = json.load(f)
+        self.stations = info['stations']
+        self.snap_metres = np.asarray(info['snap_metres'])
+        self.ids = pd.Series(np.arange(len(self.stations)), index=self.stations)
+        self.arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ['distance', 'time']}
+
+    def __contains__(self, station):
+        return station in self.ids.index
+
+    def lookup(self, name, origins, destinations):
+        """Values of one matrix for paired arrays of origin and destination names."""
+        i = self.ids.reindex(origins).to_numpy()
+        j = self.ids.reindex(destinations).to_numpy()
+        ok = ~(np.isnan(i) | np.isnan(j))
+        values = np.full(len(i), np.nan)
+        found = np.asarray(self.arrays[name][i[ok].astype(np.int64), j[ok].astype(np.int64)], dtype=np.float64)
+        values[ok] = np.where(found == UNREACHABLE, np.nan, found)
+        return values
+
+    def distance(self, origins, destinations):
+        return self.lookup('distance', origins, destinations)
+
+    def time(self, origins, destinations):
+        return self.lookup('time', origins, destinations)
+
+
+############################ Uses ##################################################
+
+def route_detours(routes, matrix):
+    """Street and straight-line distance of each route and how much longer the street route is."""
+    routes = routes[routes['start_station_name'] != routes['end_station_name']].copy()
+    routes['straight_m'] = haversine(routes['start_lat'], routes['start_lng'], routes['end_lat'], routes['end_lng']).round()
+    routes['network_m'] = matrix.distance(routes['start_station_name'], routes['end_station_name'])
+    routes['cycling_min'] = (matrix.time(routes['start_station_name'], routes['end_station_name']) / 60).round(1)
+    routes['detour'] = (routes['network_m'] / routes['straight_m'].where(routes['straight_m'] > 0)).round(2)
+    return routes
+
+
+def rider_speeds(trips_path, matrix, min_trips=20):
+    """Median trip time and the implied riding speed over the street network for each busy route.
+
+    Trips of more than twice the modelled cycling time are mostly stops on the
+    way rather than slow riding, so the speed is taken over the rest.
+    """
+    con = query.connect(trips_path)
+    pairs = con.execute(f"""
+        SELECT start_station_name, end_station_name, count(*) AS trips
+        FROM trips
+        WHERE start_station_name IS NOT NULL AND end_station_name IS NOT NULL
+          AND start_station_name <> end_station_name
+        GROUP BY ALL HAVING count(*) >= {int(min_trips)}""").df()
+    pairs['network_m'] = matrix.distance(pairs['start_station_name'], pairs['end_station_name'])
+    pairs['cycling_min'] = matrix.time(pairs['start_station_name'], pairs['end_station_name']) / 60
+
+    con.register('pairs', pairs)
+    result = con.execute("""
+        SELECT p.start_station_name, p.end_station_name, any_value(p.trips) AS trips,
+               any_value(p.network_m) AS network_m,
+               median(t.trip_duration) AS median_minutes,
+               median(t.trip_duration) FILTER (WHERE t.trip_duration <= 2 * p.cycling_min) AS riding_minutes
+        FROM trips t JOIN pairs p USING (start_station_name, end_station_name)
+        GROUP BY ALL""").df()
+    result['speed_kmh'] = (result['network_m'] / 1000 / (result['riding_minutes'] / 60)).round(1)
+    return result.drop(columns='riding_minutes').sort_values('trips', ascending=False, ignore_index=True)
+
+
+def truck_route(matrix, stations, start=None):
+    """Visiting order for a truck through stations, by fastest cycling time as a stand-in for driving.
+
+    Nearest-neighbour tour improved with 2-opt on the one-way times; returns the ordered names
+    and the total minutes.
+    """
+    stations = [s for s in stations if s in matrix]
+    if len(stations) < 2:
+        return stations, 0.0
+    ids = matrix.ids[stations].to_numpy()
+    cost = np.asarray(matrix.arrays['time'])[np.ix_(ids, ids)].astype(np.float64)
+
+    tour = [stations.index(start) if start in stations else 0]
+    left = set(range(len(stations))) - set(tour)
+    while left:
+        nearest = min(left, key=lambda j: cost[tour[-1], j])
+        tour.append(nearest)
+        left.remove(nearest)
+
+    # The matrix is one-way (streets are), so reversing a stretch of the tour also changes the
+    # cost of every leg inside it.  Running sums of the legs forwards and backwards give that
+    # in O(1) per move.
+    improved = True
+    while improved:
+        improved = False
+        for a in range(1, len(tour) - 1):
+            order = np.asarray(tour)
+            forward = np.concatenate([[0.0], np.cumsum(cost[order[:-1], order[1:]])])
+            backward = np.concatenate([[0.0], np.cumsum(cost[order[1:], order[:-1]])])
+            for b in range(a + 1, len(tour)):
+                # Reverse tour[a..b]; at the end of the (open) tour there is no leg after it
+                tail = b + 1 < len(tour)
+                before = cost[tour[a - 1], tour[a]] + forward[b] - forward[a]
+                after = cost[tour[a - 1], tour[b]] + backward[b] - backward[a]
+                if tail:
+                    before += cost[tour[b], tour[b + 1]]
+                    after += cost[tour[a], tour[b + 1]]
+                if after < before - 1e-9:
+                    tour[a:b + 1] = tour[a:b + 1][::-1]
+                    improved = True
+                    break
+
+    minutes = sum(cost[i, j] for i, j in zip(tour[:-1], tour[1:])) / 60
+    return [stations[i] for i in tour], round(minutes, 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the station travel matrix from an OSM extract for a registered city/year.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    parser.add_argument('--osm', required=True, help='OSM XML extract (.osm, .osm.gz or .osm.bz2)')
+    parser.add_argument('--jobs', type=int)
+    parser.add_argument('--force', action='store_true', help='rebuild even if the cache is up to date')
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    stations = flows.station_table(registry.load_table(entry, 'routes'))
+    matrix = build(args.osm, stations, matrix_path(entry), args.jobs, args.force)
+    far = (matrix.snap_metres > 100).sum()
+    print(f'Travel matrix ready for {len(matrix.stations):,} stations '
+          f'({far:,} more than 100 m from the street network)')
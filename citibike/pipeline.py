@@ -0,0 +1,489 @@
+####################################################################################
+################################# Build pipeline ###################################
+####################################################################################
+
+# Rebuilds a city/year partition from the raw monthly trip files (the zip
+# archives as downloaded, or CSVs) in one command:
+#
+#   python -m citibike.pipeline --city nyc --city-name "New York City" --year 2022 [--watch]
+#
+# Each stage declares the files it reads and writes, and the stage graph is
+# worked out from those.  A stage is skipped when the content hashes of its
+# inputs, its parameters and its code match the last successful run and its
+# outputs are still as that run left them; a stage whose inputs were rebuilt
+# but came out identical is skipped too.  Stages whose inputs are ready run in
+# parallel, each in a fresh process, so the peak memory recorded for a stage is
+# its own.
+#
+#   weather + raw zips ─ merge ─ prepare ─┬─ aggregates ─┬───────────────┐
+#                                         ├─ profiles ───┼─ anomalies ───┤
+#                                         │              ├─ rebalancing ─┤
+#                                         │              ├─ inventory ───┤
+#                                         │              └─ typology ────┤
+#                                         ├─ sketches ───────────────────┤
+#                                         └─ routes ─┬─ flows ───────────┤
+#                                                    ├─ zones ───────────┴─ snapshot
+#                                                    └─ network     (only with a streets.osm extract)
+#   aggregates + coverage_weights.csv ─ coverage  (only with a weight layer)
+#
+# File hashes are cached by size and modification time, and the state of the
+# last run is kept in pipeline_state.json inside the partition.
+#
+# With --watch the pipeline keeps running and polls the raw folder.  Once a new
+# archive has been dropped in and has stopped growing, the stages run again;
+# merge reads only the new months and the rest of the graph brings the tables,
+# the manifest and the dashboard snapshot up to date.
+
+import argparse
+import glob
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+
+from citibike import registry, snapshot
+
+
+STATE_FILE = 'pipeline_state.json'
+
+
+class Stage:
+
+    def __init__(self, name, func, inputs=(), outputs=(), modules=(), params=None):
+        self.name = name
+        self.func = func                    # module-level function, called as func(**params)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.modules = list(modules)        # modules whose source counts as the stage's code
+        self.params = params or {}
+
+
+############################ Stage functions #######################################
+
+# These run in worker processes, so they take plain paths and import what they need.
+
+def _weather(year, station, path):
+    from citibike import prepare
+
+    # Without a token a weather.csv put there by hand is used as it is
+    if 'NOAA_TOKEN' not in os.environ and os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    prepare.fetch_temperatures(year, station).to_csv(path, index=False)
+
+
+def _merge(raw_dir, weather, merged):
+    from citibike import prepare
+    prepare.merge(raw_dir, weather, merged)
+
+
+def _prepare(merged, trips):
+    from citibike import prepare
+    prepare.build_trip_store(merged, trips)
+
+
+def _aggregates(trips, outputs):
+    from citibike import prepare
+    for table, df in prepare.build_aggregates(trips).items():
+        df.to_csv(outputs[table])
+
+
+def _sketches(trips, duration_sketches, heavy_hitters):
+    from citibike import sketches
+    sketches.build_duration_sketches(trips).to_parquet(duration_sketches)
+    sketches.build_heavy_hitters(trips).to_parquet(heavy_hitters)
+
+
+def _profiles(trips, year, path):
+    from citibike import profiles
+    profiles.build(trips, path, year)
+
+
+def _routes(trips, path):
+    from citibike import maps
+    maps.build_routes(trips).to_parquet(path, index=False)
+
+
+def _flows(routes, path):
+    import pandas as pd
+    from citibike import flows
+    flows.build_pyramid(pd.read_parquet(routes)).to_parquet(path, index=False)
+
+
+def _anomalies(trips, profiles_path, avg_day, path):
+    from citibike import anomalies, profiles
+    store = profiles.StationProfiles(profiles_path)
+    flags = anomalies.station_anomalies(trips, store, registry.read_table(avg_day, 'avg_day'))
+    flags.to_parquet(path, index=False)
+
+
+def _rebalancing(trips, profiles_path, year, path):
+    from citibike import simulate
+    simulate.build(trips, profiles_path, year).to_parquet(path, index=False)
+
+
+def _inventory(trips, profiles_path, year, store_path, path):
+    from citibike import inventory
+    inventory.build(trips, profiles_path, store_path, year).to_parquet(path, index=False)
+
+
+def _typology(profiles_path, path):
+    from citibike import typology
+    typology.build(profiles_path).to_parquet(path, index=False)
+
+
+def _zones(routes, path, flows_path):
+    import pandas as pd
+    from citibike import zones
+    station_zones, flows_between = zones.build(pd.read_parquet(routes))
+    station_zones.to_parquet(path, index=False)
+    flows_between.to_parquet(flows_path, index=False)
+
+
+def _network(osm, routes, path):
+    import pandas as pd
+    from citibike import flows, network
+    network.build(osm, flows.station_table(pd.read_parquet(routes)), path, force=True)
+
+
+def _coverage(start_stations, weights, path):
+    import pandas as pd
+    from citibike import coverage
+    sites = coverage.analyse(registry.read_table(start_stations, 'start_stations'), pd.read_csv(weights))[3]
+    sites.to_parquet(path, index=False)
+
+
+def _snapshot(snapshot_dir, keep):
+    # Waits for a build a dashboard process may have started, then builds from the latest tables
+    with snapshot.build_lock(snapshot_dir):
+        version = snapshot.build(snapshot_dir=snapshot_dir)
+        snapshot.validate(version, snapshot_dir)
+        snapshot.activate(version, snapshot_dir)
+        snapshot.prune(keep, snapshot_dir)
+
+
+def stages(city, year, raw_dir=None, data_dir=registry.DATA_DIR, snapshot_dir=snapshot.SNAPSHOT_DIR):
+    """The stages that build one partition, in an order that respects their dependencies."""
+    partition = os.path.join(data_dir, city, str(year))
+    raw_dir = raw_dir or os.path.join(partition, 'raw')
+
+    def table(name):
+        return os.path.join(partition, registry.TABLES[name])
+
+    weather = os.path.join(partition, 'weather.csv')
+    merged = os.path.join(partition, 'merged')
+    trips = os.path.join(partition, 'trips')
+    station_profiles = os.path.join(partition, 'station_profiles')
+    station_inventory = os.path.join(partition, 'station_inventory')
+    aggregates = {name: table(name) for name in ['daily', 'start_stations', 'top20', 'avg_day', 'imbalance']}
+    tables = list(aggregates.values()) + [table(name) for name in
+                                          ['duration_sketches', 'heavy_hitters', 'routes', 'flow_pyramid', 'anomalies',
+                                           'rebalancing', 'inventory', 'typology', 'zones', 'zone_flows']]
+
+    all_stages = [
+        Stage('weather', _weather, outputs=[weather], modules=['citibike.prepare'],
+              params={'year': year, 'station': 'GHCND:USW00014732', 'path': weather}),
+        Stage('merge', _merge, inputs=[raw_dir, weather], outputs=[merged], modules=['citibike.prepare'],
+              params={'raw_dir': raw_dir, 'weather': weather, 'merged': merged}),
+        Stage('prepare', _prepare, inputs=[merged], outputs=[trips], modules=['citibike.prepare', 'citibike.query'],
+              params={'merged': merged, 'trips': trips}),
+        Stage('aggregates', _aggregates, inputs=[trips], outputs=list(aggregates.values()),
+              modules=['citibike.prepare', 'citibike.query'], params={'trips': trips, 'outputs': aggregates}),
+        Stage('sketches', _sketches, inputs=[trips], outputs=[table('duration_sketches'), table('heavy_hitters')],
+              modules=['citibike.sketches'],
+              params={'trips': trips, 'duration_sketches': table('duration_sketches'),
+                      'heavy_hitters': table('heavy_hitters')}),
+        Stage('profiles', _profiles, inputs=[trips], outputs=[station_profiles], modules=['citibike.profiles'],
+              params={'trips': trips, 'year': year, 'path': station_profiles}),
+        Stage('routes', _routes, inputs=[trips], outputs=[table('routes')], modules=['citibike.maps', 'citibike.query'],
+              params={'trips': trips, 'path': table('routes')}),
+        Stage('flows', _flows, inputs=[table('routes')], outputs=[table('flow_pyramid')], modules=['citibike.flows'],
+              params={'routes': table('routes'), 'path': table('flow_pyramid')}),
+        Stage('anomalies', _anomalies, inputs=[trips, station_profiles, aggregates['avg_day']],
+              outputs=[table('anomalies')], modules=['citibike.anomalies', 'citibike.profiles', 'citibike.registry'],
+              params={'trips': trips, 'profiles_path': station_profiles, 'avg_day': aggregates['avg_day'],
+                      'path': table('anomalies')}),
+        Stage('rebalancing', _rebalancing, inputs=[trips, station_profiles], outputs=[table('rebalancing')],
+              modules=['citibike.simulate'],
+              params={'trips': trips, 'profiles_path': station_profiles, 'year': year, 'path': table('rebalancing')}),
+        Stage('inventory', _inventory, inputs=[trips, station_profiles],
+              outputs=[station_inventory, table('inventory')], modules=['citibike.inventory', 'citibike.simulate'],
+              params={'trips': trips, 'profiles_path': station_profiles, 'year': year,
+                      'store_path': station_inventory, 'path': table('inventory')}),
+        Stage('typology', _typology, inputs=[station_profiles], outputs=[table('typology')],
+              modules=['citibike.typology', 'citibike.profiles'],
+              params={'profiles_path': station_profiles, 'path': table('typology')}),
+        Stage('zones', _zones, inputs=[table('routes')], outputs=[table('zones'), table('zone_flows')],
+              modules=['citibike.zones', 'citibike.flows'],
+              params={'routes': table('routes'), 'path': table('zones'), 'flows_path': table('zone_flows')}),
+        Stage('snapshot', _snapshot, inputs=tables, outputs=[os.path.join(snapshot_dir, snapshot.CURRENT)],
+              modules=['citibike.snapshot'], params={'snapshot_dir': snapshot_dir, 'keep': 3}),
+    ]
+
+    # The travel matrix needs a street extract, so it is only built where one has been put in the partition
+    streets = [path for path in (os.path.join(partition, 'streets' + ext) for ext in ['.osm', '.osm.gz', '.osm.bz2'])
+               if os.path.exists(path)]
+    if streets:
+        matrix = os.path.join(partition, 'network_matrix')
+        all_stages.append(Stage('network', _network, inputs=[streets[0], table('routes')], outputs=[matrix],
+                                modules=['citibike.network', 'citibike.flows'],
+                                params={'osm': streets[0], 'routes': table('routes'), 'path': matrix}))
+
+    # Expansion sites are ranked against a population/transit point layer, when one has been put in the partition
+    weights = os.path.join(partition, 'coverage_weights.csv')
+    if os.path.exists(weights):
+        all_stages.append(Stage('coverage', _coverage, inputs=[aggregates['start_stations'], weights],
+                                outputs=[table('expansion_sites')], modules=['citibike.coverage', 'citibike.registry'],
+                                params={'start_stations': aggregates['start_stations'], 'weights': weights,
+                                        'path': table('expansion_sites')}))
+    return all_stages
+
+
+############################ Hashing ###############################################
+
+class Hasher:
+    """Content hashes of files and folders, cached by size and modification time."""
+
+    def __init__(self, cache=None):
+        self.cache = cache or {}
+
+    def file(self, path):
+        st = os.stat(path)
+        cached = self.cache.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        self.cache[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+    def path(self, path):
+        """Hash of a file, or of every file in a folder with its relative name.  None if missing."""
+        if os.path.isfile(path):
+            return self.file(path)
+        if not os.path.isdir(path):
+            return None
+
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                h.update(os.path.relpath(full, path).encode())
+                h.update(self.file(full).encode())
+        return h.hexdigest()
+
+
+def stage_key(stage, hasher):
+    """Hash of everything that decides a stage's outputs: inputs, parameters and code."""
+    h = hashlib.sha256(stage.name.encode())
+    h.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+    for path in stage.inputs:
+        h.update(f'{path}={hasher.path(path)}'.encode())
+    for module in stage.modules:
+        h.update(hasher.file(importlib.util.find_spec(module).origin).encode())
+    return h.hexdigest()
+
+
+############################ Running ###############################################
+
+def _peak_memory_mb():
+    try:
+        import resource
+    except ImportError:                     # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _run_stage(func, params):
+    # Runs in a fresh worker process
+    start = time.perf_counter()
+    func(**params)
+    return round(time.perf_counter() - start, 2), _peak_memory_mb()
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {'hashes': {}, 'stages': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+
+def dependencies(all_stages):
+    """The stages each stage waits for: those that write any of its inputs."""
+    producers = {output: stage.name for stage in all_stages for output in stage.outputs}
+    return {stage.name: {producers[path] for path in stage.inputs if path in producers} - {stage.name}
+            for stage in all_stages}
+
+
+def run(all_stages, state_path, jobs=None, force=(), on_success=None, log=print):
+    """Run the stages that are out of date, in parallel where the graph allows.
+
+    on_success(stage) is called in this process after each stage that ran.
+    Returns {stage: 'ran' | 'skipped' | 'failed' | 'blocked'}.
+    """
+    state = load_state(state_path)
+    hasher = Hasher(state['hashes'])
+    by_name = {stage.name: stage for stage in all_stages}
+    needs = dependencies(all_stages)
+
+    status = {}
+    running = {}
+    context = multiprocessing.get_context('spawn')
+
+    # A fresh process per stage keeps one stage's memory from counting towards the next
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), mp_context=context,
+                             max_tasks_per_child=1) as pool:
+        while len(status) < len(all_stages):
+            for name, stage in by_name.items():
+                if name in status or name in running.values():
+                    continue
+                if any(status.get(dep) in ('failed', 'blocked') for dep in needs[name]):
+                    status[name] = 'blocked'
+                    log(f'{name:<12} blocked by a failed stage')
+                    continue
+                if not all(status.get(dep) in ('ran', 'skipped') for dep in needs[name]):
+                    continue
+
+                key = stage_key(stage, hasher)
+                previous = state['stages'].get(name, {})
+                up_to_date = (previous.get('key') == key and
+                              all(hasher.path(p) == previous['outputs'].get(p) for p in stage.outputs))
+                if up_to_date and name not in force and 'all' not in force:
+                    status[name] = 'skipped'
+                    log(f'{name:<12} up to date')
+                    continue
+
+                log(f'{name:<12} started')
+                running[pool.submit(_run_stage, stage.func, stage.params)] = name
+                state['stages'][name] = {'key': key, 'outputs': {}}
+
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                stage = by_name[name]
+                try:
+                    seconds, peak_mb = future.result()
+                except Exception as e:
+                    status[name] = 'failed'
+                    del state['stages'][name]
+                    log(f'{name:<12} FAILED: {e!r}')
+                    continue
+
+                state['stages'][name].update({
+                    'outputs': {p: hasher.path(p) for p in stage.outputs},
+                    'seconds': seconds,
+                    'peak_memory_mb': peak_mb,
+                    'finished': datetime.now().isoformat(timespec='seconds'),
+                })
+                status[name] = 'ran'
+                log(f'{name:<12} done in {seconds:,.1f}s, peak memory {peak_mb} MB')
+                if on_success is not None:
+                    on_success(stage)
+
+            save_state(state, state_path)
+
+    save_state(state, state_path)
+    return status
+
+
+############################ Watching ##############################################
+
+WATCH_INTERVAL = 60     # seconds between looks at the raw folder
+
+
+def raw_listing(raw_dir):
+    """(name, size, mtime) of every file under raw_dir, to notice files arriving, changing or leaving."""
+    listing = set()
+    for path in glob.glob(os.path.join(raw_dir, '**', '*'), recursive=True):
+        if os.path.isfile(path) and not os.path.basename(path).startswith('.'):
+            st = os.stat(path)
+            listing.add((os.path.relpath(path, raw_dir), st.st_size, st.st_mtime_ns))
+    return listing
+
+
+def watch(raw_dir, build, interval=WATCH_INTERVAL, log=print):
+    """Call build() now and again whenever the raw folder changes, until interrupted.
+
+    A change is only acted on once two looks in a row agree, so an archive
+    that is still being copied in is not read half written.
+    """
+    built = raw_listing(raw_dir)
+    build()
+    log(f'Watching {raw_dir} every {interval:g}s (Ctrl+C to stop)')
+    seen = built
+    while True:
+        time.sleep(interval)
+        listing = raw_listing(raw_dir)
+        if listing != built and listing == seen:
+            arrived = sorted({name for name, _, _ in listing - built})
+            log(f"{datetime.now():%Y-%m-%d %H:%M:%S} raw files changed: {', '.join(arrived) or 'files removed'}")
+            build()
+            built = listing
+        seen = listing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build (or bring up to date) a city/year partition from its raw CSVs.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--city-name', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    parser.add_argument('--raw', help='folder of monthly trip zips or CSVs (default data/<city>/<year>/raw)')
+    parser.add_argument('--jobs', type=int, help='stages to run at once (default: number of cores)')
+    parser.add_argument('--force', nargs='*', default=[], help="stages to rerun even if up to date, or 'all'")
+    parser.add_argument('--list', action='store_true', help='show the stages and their last run, then exit')
+    parser.add_argument('--watch', type=float, nargs='?', const=WATCH_INTERVAL, metavar='SECONDS',
+                        help='keep running and rebuild whenever new trip files land in the raw folder')
+    args = parser.parse_args()
+
+    all_stages = stages(args.city, args.year, args.raw)
+    state_path = os.path.join(registry.DATA_DIR, args.city, str(args.year), STATE_FILE)
+
+    if args.list:
+        needs = dependencies(all_stages)
+        last = load_state(state_path)['stages']
+        for stage in all_stages:
+            info = last.get(stage.name, {})
+            print(f"{stage.name:<12} {info.get('finished', 'never run'):<20} {info.get('seconds', '-'):>8}s "
+                  f"{info.get('peak_memory_mb', '-'):>8} MB   after {', '.join(sorted(needs[stage.name])) or '-'}")
+        sys.exit(0)
+
+    # Register after every stage so the manifest always lists what exists; the snapshot stage reads it
+    def register(stage):
+        if stage.name != 'snapshot':
+            registry.register(args.city, args.city_name, args.year)
+
+    def build():
+        if os.path.isdir(os.path.join(registry.DATA_DIR, args.city, str(args.year))):
+            registry.register(args.city, args.city_name, args.year)
+        # Stages are listed again each time, as optional inputs may have appeared since
+        return run(stages(args.city, args.year, args.raw), state_path, args.jobs, args.force, on_success=register)
+
+    if args.watch:
+        raw_dir = args.raw or os.path.join(registry.DATA_DIR, args.city, str(args.year), 'raw')
+        try:
+            watch(raw_dir, build, args.watch)
+        except KeyboardInterrupt:
+            sys.exit(0)
+    status = build()
+    sys.exit(0 if all(s in ('ran', 'skipped') for s in status.values()) else 1)
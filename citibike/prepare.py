@@ -0,0 +1,261 @@
+####################################################################################
+############################ Trip data preparation #################################
+####################################################################################
+
+# The steps the Ex 2.2 - 2.6 notebooks took by hand, as functions the pipeline
+# (citibike.pipeline) can run:
+#
+#   Ex 2.2      monthly Citi Bike zips/CSVs + NOAA daily temperatures -> merged/
+#   Ex 2.3/2.4  trip durations, day type and hour                  -> trips/ (the trip store)
+#   Ex 2.4-2.6  the small tables the dashboard reads               -> *.csv
+#
+# Each raw CSV is merged on its own and the trip store is written one month at a
+# time, so a year of trips never has to fit in memory at once.
+
+import glob
+import json
+import os
+import shutil
+import zipfile
+from datetime import datetime
+
+import pandas as pd
+
+from citibike import query
+
+
+NOAA_URL = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/data'
+NOAA_STATION = 'GHCND:USW00014732'      # LaGuardia Airport, as in Ex 2.2
+SOURCE_LISTINGS = 'sources.json'        # in merged/: what each raw archive holds (see raw_sources)
+
+
+def fetch_temperatures(year, station=NOAA_STATION, token=None):
+    """Average daily temperature (°C) for a year from the NOAA API.
+
+    The API token is read from the NOAA_TOKEN environment variable unless one is given.
+    """
+    import requests
+
+    token = token or os.environ.get('NOAA_TOKEN')
+    if not token:
+        raise RuntimeError('Set NOAA_TOKEN to a NOAA API token to download temperatures')
+
+    r = requests.get(NOAA_URL, headers={'token': token}, timeout=60, params={
+        'datasetid': 'GHCND', 'datatypeid': 'TAVG', 'limit': 1000, 'stationid': station,
+        'startdate': f'{year}-01-01', 'enddate': f'{year}-12-31'})
+    r.raise_for_status()
+
+    # Temperatures come in tenths of a degree Celsius, so 116 means 11.6 °C
+    avg_temps = [item for item in r.json()['results'] if item['datatype'] == 'TAVG']
+    return pd.DataFrame({
+        'date': [datetime.strptime(item['date'], '%Y-%m-%dT%H:%M:%S') for item in avg_temps],
+        'avgTemp': [float(item['value']) / 10.0 for item in avg_temps],
+    })
+
+
+############################ Raw trip files ########################################
+
+# Citi Bike publishes each month as a zip archive (and each year as an archive of
+# those).  CSV members are streamed straight out of the archives, so nothing is
+# extracted to disk and read back, and CSVs that have been extracted by hand
+# are read as they are.  Each source is named by its CSV file name, which also
+# stops a month that is there both zipped and extracted from being read twice.
+
+def _is_trip_csv(name):
+    base = os.path.basename(name)
+    return base.lower().endswith('.csv') and not base.startswith('._') and '__MACOSX' not in name
+
+
+def _zip_members(archive, chain=()):
+    # (member chain, CSV name) of every trip CSV in an archive, looking one level into archives inside it.
+    # Inner archives are read through a stream on the outer one rather than into memory.
+    found = []
+    for info in archive.infolist():
+        if _is_trip_csv(info.filename):
+            found.append((chain + (info.filename,), os.path.basename(info.filename)))
+        elif info.filename.lower().endswith('.zip') and not chain and '__MACOSX' not in info.filename:
+            with archive.open(info) as stream, zipfile.ZipFile(stream) as inner:
+                found.extend(_zip_members(inner, (info.filename,)))
+    return found
+
+
+def _archive_members(path, cache):
+    # Listing an archive inside an archive means decompressing it, so listings are kept by
+    # (size, modification time) and only redone when the archive changes
+    st = os.stat(path)
+    cached = cache.get(path)
+    if cached and cached['size'] == st.st_size and cached['mtime_ns'] == st.st_mtime_ns:
+        return [(tuple(chain), name) for chain, name in cached['members']]
+    with zipfile.ZipFile(path) as archive:
+        members = _zip_members(archive)
+    cache[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'members': [[list(c), n] for c, n in members]}
+    return members
+
+
+def raw_sources(raw_dir, cache=None):
+    """{CSV name: (file, member chain)} of every trip CSV under raw_dir, on disk or inside zip archives.
+
+    cache is a dict of archive listings kept between calls (see merge).
+    """
+    cache = {} if cache is None else cache
+    sources = {}
+    for path in sorted(glob.glob(os.path.join(raw_dir, '**', '*'), recursive=True)):
+        if _is_trip_csv(path):
+            sources[os.path.basename(path)] = (path, ())
+    archives = sorted(glob.glob(os.path.join(raw_dir, '**', '*.zip'), recursive=True))
+    for path in archives:
+        for chain, name in _archive_members(path, cache):
+            sources.setdefault(name, (path, chain))
+    for path in set(cache) - set(archives):
+        del cache[path]
+    return sources
+
+
+def open_source(path, chain=()):
+    """Binary stream of a raw CSV, streamed out of its archive (and the archive inside that) if it has one."""
+    if not chain:
+        return open(path, 'rb')
+    archive = zipfile.ZipFile(path)
+    for member in chain[:-1]:
+        archive = zipfile.ZipFile(archive.open(member))
+    return archive.open(chain[-1])
+
+
+def merge_source(path, chain, weather_path, output):
+    """Join one raw trip CSV to the daily temperatures (Ex 2.2) and write it as Parquet."""
+    weather = pd.read_csv(weather_path, parse_dates=['date'])
+    with open_source(path, chain) as f:
+        df = pd.read_csv(f, low_memory=False)
+
+    df = df.rename(columns={'started_at': 'start_time', 'ended_at': 'end_time'})
+    df['start_time'] = pd.to_datetime(df['start_time'])
+    df['end_time'] = pd.to_datetime(df['end_time'])
+    df['date'] = df['start_time'].dt.normalize()
+
+    # Station names and ids are a mix of strings and numbers in the raw files
+    for column in ['start_station_name', 'start_station_id', 'end_station_name', 'end_station_id']:
+        if column in df:
+            df[column] = df[column].astype('string')
+
+    df = df.merge(weather, how='left', on='date')
+    df['month'] = df['date'].dt.month.astype('int8')
+
+    # Written under a temporary name so an interrupted merge never leaves a file that looks finished
+    df.to_parquet(output + '.tmp', index=False)
+    os.replace(output + '.tmp', output)
+
+
+def merge(raw_dir, weather_path, merged_dir, jobs=None):
+    """Bring merged/ up to date with the raw trip files, one Parquet file per CSV.
+
+    Only sources without a merged file newer than their archive, the
+    temperatures and this module are read, so adding a month's archive merges
+    just that month.
+    Merged files whose source has gone are removed.  Sources are decoded in
+    `jobs` processes (default up to 4; each holds a month of trips in memory).
+    Returns the names of the sources merged.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    os.makedirs(merged_dir, exist_ok=True)
+    listings_path = os.path.join(merged_dir, SOURCE_LISTINGS)
+    try:
+        with open(listings_path) as f:
+            listings = json.load(f)
+    except (FileNotFoundError, ValueError):
+        listings = {}
+    sources = raw_sources(raw_dir, listings)
+    with open(listings_path + '.tmp', 'w') as f:
+        json.dump(listings, f, indent=2)
+    os.replace(listings_path + '.tmp', listings_path)
+    outputs = {name: os.path.join(merged_dir, os.path.splitext(name)[0] + '.parquet') for name in sources}
+
+    for stale in set(glob.glob(os.path.join(merged_dir, '*.parquet'))) - set(outputs.values()):
+        os.remove(stale)
+
+    changed = max(os.path.getmtime(weather_path), os.path.getmtime(__file__))
+    todo = [name for name, (path, _) in sources.items()
+            if not os.path.exists(outputs[name])
+            or os.path.getmtime(outputs[name]) < max(os.path.getmtime(path), changed)]
+
+    jobs = min(jobs or 4, os.cpu_count() or 1, len(todo) or 1)
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for future in [pool.submit(merge_source, *sources[name], weather_path, outputs[name]) for name in todo]:
+            future.result()
+    return todo
+
+
+def prepare_trips(df):
+    """Trip duration, day of week, day type and start hour (Ex 2.3 and 2.4)."""
+    # Trips that began before the year started have no temperature and are dropped
+    df = df.dropna(subset=['avgTemp']).reset_index(drop=True)
+
+    df['trip_duration'] = (df['end_time'] - df['start_time']).dt.total_seconds() / 60
+
+    # Negative durations all come from the clocks going back an hour at 2am on the first
+    # Sunday of November
+    df.loc[df['trip_duration'] < 0, 'trip_duration'] += 60
+
+    df['day_of_week'] = df['date'].dt.day_name()
+    df['day_type'] = df['day_of_week'].isin(['Saturday', 'Sunday']).map({True: 'Weekend', False: 'Weekday'})
+    df['start_hour'] = df['start_time'].dt.hour
+    return df
+
+
+def build_trip_store(merged_dir, trips_path):
+    """Prepare the merged trips and write them as a trip store, one month at a time."""
+    files = sorted(glob.glob(os.path.join(merged_dir, '*.parquet')))
+    shutil.rmtree(trips_path, ignore_errors=True)
+
+    for month in range(1, 13):
+        # The month statistics in each file let pyarrow skip files holding other months
+        parts = [pd.read_parquet(f, filters=[('month', '=', month)]) for f in files]
+        parts = [p for p in parts if len(p)]
+        if parts:
+            query.write_trip_store(prepare_trips(pd.concat(parts, ignore_index=True)), trips_path)
+
+
+def build_aggregates(trips_path):
+    """The tables behind the dashboard pages, keyed by registry table name."""
+    con = query.connect(trips_path)
+    tables = {}
+
+    tables['daily'] = con.execute("""
+        SELECT date, any_value(avgTemp) AS avgTemp, count(*) AS no_of_trips
+        FROM trips GROUP BY date ORDER BY date""").df()
+
+    tables['start_stations'] = con.execute("""
+        SELECT start_station_name AS station_name, count(*) AS total_departures,
+               any_value(start_lat) AS latitude, any_value(start_lng) AS longitude
+        FROM trips WHERE start_station_name IS NOT NULL
+        GROUP BY ALL ORDER BY total_departures DESC""").df()
+
+    tables['top20'] = (tables['start_stations'].head(20)[['station_name', 'total_departures']]
+                       .rename(columns={'station_name': 'start_station_name', 'total_departures': 'value'}))
+
+    tables['avg_day'] = con.execute("""
+        WITH hourly AS (
+            SELECT date, day_type, start_hour, count(*) AS trip_count
+            FROM trips GROUP BY ALL
+        )
+        SELECT day_type, start_hour, avg(trip_count) AS trip_count
+        FROM hourly GROUP BY ALL ORDER BY day_type, start_hour""").df()
+
+    # The ten stations gaining the most bikes over the year and the ten losing the most
+    imbalance = con.execute("""
+        WITH departures AS (
+            SELECT start_station_name AS station, count(*) AS departures,
+                   any_value(start_lat) AS latitude, any_value(start_lng) AS longitude
+            FROM trips WHERE start_station_name IS NOT NULL GROUP BY ALL
+        ), arrivals AS (
+            SELECT end_station_name AS station, count(*) AS arrivals
+            FROM trips WHERE end_station_name IS NOT NULL GROUP BY ALL
+        )
+        SELECT station, departures, arrivals, latitude, longitude, arrivals - departures AS difference
+        FROM departures JOIN arrivals USING (station)
+        ORDER BY difference DESC""").df().set_index('station')
+    imbalance.index.name = None
+    tables['imbalance'] = pd.concat([imbalance.head(10), imbalance.tail(10)])
+
+    return tables
@@ -0,0 +1,237 @@
+####################################################################################
+############################ Per-station profile store #############################
+####################################################################################
+
+# Everything the station drill-down shows is precomputed here for every station
+# at once and saved as plain NumPy arrays, one row per station:
+#
+#   hourly        (stations, 2, 2, 24) average trips per hour
+#                 [weekday/weekend][departures/arrivals][hour]
+#   daily         (stations, 366)      departures per day of the year
+#   destinations  (stations, 10)       station ids of the most common destinations
+#   destination_trips (stations, 10)   trips to each of those destinations
+#   net           (stations,)          arrivals - departures for the year
+#   weekly        (stations, 2, 12, 7, 24) trips by [departures/arrivals][month]
+#                 [day of week][hour], for the day-of-week heatmaps
+#   weekly_total  (2, 12, 7, 24)       the same for every trip, with or without a station
+#   weekly_days   (12, 7)              days of each weekday seen in each month
+#
+# The arrays are memory-mapped when opened, so looking a station up is a single
+# row read rather than a filter over the trip data.
+#
+#   python -m citibike.profiles --city nyc --year 2022
+
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from citibike import query, registry
+
+
+PROFILE_DIR = 'station_profiles'
+TOP_DESTINATIONS = 10
+DAY_TYPES = ['Weekday', 'Weekend']
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+WEEKLY = 2 * 12 * 7 * 24            # direction, month, day of week, hour
+
+
+def profiles_path(entry, data_dir=registry.DATA_DIR):
+    return os.path.join(data_dir, entry['path'], PROFILE_DIR)
+
+
+def _codes(names, stations):
+    # Station position for each name; unknown or missing names become -1
+    return pd.Categorical(names, categories=stations).codes.astype(np.int64)
+
+
+def _calendar(times, year):
+    # Whether each time falls in the year, and its month (0-11), day of year (0-365), day of week
+    # (Monday 0) and hour, from the hours since 1970-01-01 (a Thursday) and a lookup table over
+    # the days of the year.  This is several times faster than the .dt accessors.  Missing times
+    # and times in other years are not in the year; their other fields are meaningless.
+    values = times.to_numpy().astype('datetime64[h]')
+    calendar = pd.date_range(f'{year}-01-01', f'{year}-12-31')
+    first = calendar[0].to_datetime64().astype('datetime64[D]').view(np.int64)
+    hours = values.view(np.int64)
+    day = hours // 24
+    valid = ~np.isnat(values) & (day >= first) & (day < first + len(calendar))
+    day = np.where(valid, day, first)
+    hours = np.where(valid, hours, 0)
+    month = (calendar.month - 1).to_numpy()[day - first]
+    day_of_year = (calendar.dayofyear - 1).to_numpy()[day - first]
+    return valid, month, day_of_year, (day + 3) % 7, hours % 24
+
+
+def accumulate(trips, stations, year, totals=None):
+    """Add one chunk of trips to the running totals and return them.
+
+    Every quantity is a bincount over an integer key, so a chunk of any size
+    is handled in a few vectorised passes and chunks simply add together.
+    Departures or arrivals with no time or outside the year are left out.
+    """
+    n = len(stations)
+    if totals is None:
+        totals = {
+            'hourly': np.zeros(n * 2 * 2 * 24, dtype=np.int64),
+            'daily': np.zeros(n * 366, dtype=np.int64),
+            'pairs': np.zeros(n * n, dtype=np.int64),
+            'weekly': np.zeros(n * WEEKLY, dtype=np.int64),
+            'weekly_total': np.zeros(WEEKLY, dtype=np.int64),
+            'days': {},
+        }
+
+    start = pd.to_datetime(trips['start_time'])
+    end = pd.to_datetime(trips['end_time'])
+    origin = _codes(trips['start_station_name'], stations)
+    destination = _codes(trips['end_station_name'], stations)
+
+    for direction, codes, times in [(0, origin, start), (1, destination, end)]:
+        seen, month, day_of_year, day_of_week, hour = _calendar(times, year)
+        ok = (codes >= 0) & seen
+        key = ((codes * 2 + (day_of_week >= 5)) * 2 + direction) * 24 + hour
+        totals['hourly'] += np.bincount(key[ok], minlength=n * 96)
+
+        # (month, day of week, hour) for this direction, for every trip and per station
+        week = ((direction * 12 + month) * 7 + day_of_week) * 24 + hour
+        totals['weekly_total'] += np.bincount(week[seen], minlength=WEEKLY)
+        totals['weekly'] += np.bincount((codes * WEEKLY + week)[ok], minlength=n * WEEKLY)
+
+        if direction == 0:
+            totals['daily'] += np.bincount((codes * 366 + day_of_year)[ok], minlength=n * 366)
+
+    ok = (origin >= 0) & (destination >= 0) & _calendar(start, year)[0]
+    totals['pairs'] += np.bincount((origin * n + destination)[ok], minlength=n * n)
+
+    # Distinct days of each type seen, to turn hourly totals into averages
+    for day in pd.to_datetime(trips['date']).dt.normalize().dropna().unique():
+        if pd.Timestamp(day).year == year:
+            totals['days'][pd.Timestamp(day).date().isoformat()] = int(pd.Timestamp(day).dayofweek >= 5)
+
+    return totals
+
+
+def save(totals, stations, year, path):
+    n = len(stations)
+    os.makedirs(path, exist_ok=True)
+
+    day_counts = np.bincount(list(totals['days'].values()), minlength=2).clip(min=1)
+    hourly = totals['hourly'].reshape(n, 2, 2, 24) / day_counts[None, :, None, None]
+
+    pairs = totals['pairs'].reshape(n, n)
+    destinations = np.argsort(-pairs, axis=1, kind='stable')[:, :TOP_DESTINATIONS]
+    destination_trips = np.take_along_axis(pairs, destinations, axis=1)
+
+    net = pairs.sum(axis=0) - pairs.sum(axis=1)
+
+    dates = pd.to_datetime(sorted(totals['days']))
+    weekly_days = np.bincount((dates.month - 1) * 7 + dates.dayofweek, minlength=12 * 7).reshape(12, 7)
+
+    np.save(os.path.join(path, 'hourly.npy'), hourly.astype(np.float32))
+    np.save(os.path.join(path, 'daily.npy'), totals['daily'].reshape(n, 366).astype(np.int32))
+    np.save(os.path.join(path, 'destinations.npy'), destinations.astype(np.int32))
+    np.save(os.path.join(path, 'destination_trips.npy'), destination_trips.astype(np.int32))
+    np.save(os.path.join(path, 'net.npy'), net.astype(np.int32))
+    np.save(os.path.join(path, 'weekly.npy'), totals['weekly'].reshape(n, 2, 12, 7, 24).astype(np.int32))
+    np.save(os.path.join(path, 'weekly_total.npy'), totals['weekly_total'].reshape(2, 12, 7, 24))
+    np.save(os.path.join(path, 'weekly_days.npy'), weekly_days)
+
+    with open(os.path.join(path, 'stations.json'), 'w') as f:
+        json.dump({'stations': list(stations), 'year': year}, f)
+
+
+def build(trips_path, path, year):
+    """Build the profile store for one year from a trip store, one monthly file at a time."""
+    files = sorted(glob.glob(os.path.join(trips_path, '**', '*.parquet'), recursive=True))
+    columns = ['start_time', 'end_time', 'start_station_name', 'end_station_name', 'date']
+
+    # First pass over the station columns only, to fix the station ids
+    names = set()
+    for f in files:
+        df = pd.read_parquet(f, columns=['start_station_name', 'end_station_name'])
+        names.update(df['start_station_name'].dropna().unique())
+        names.update(df['end_station_name'].dropna().unique())
+    stations = sorted(names)
+
+    totals = None
+    for f in files:
+        totals = accumulate(pd.read_parquet(f, columns=columns), stations, year, totals)
+    save(totals, stations, year, path)
+
+
+class StationProfiles:
+    """Read-only, memory-mapped access to a profile store."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'stations.json')) as f:
+            info = json.load(f)
+        self.stations = info['stations']
+        if not info.get('year'):
+            raise ValueError(f'{path} does not record its year; rebuild it with python -m citibike.profiles')
+        self.year = int(info['year'])
+        self.ids = {name: i for i, name in enumerate(self.stations)}
+        self.arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                       for name in ['hourly', 'daily', 'destinations', 'destination_trips', 'net']}
+
+        # Stores built before the day-of-week heatmaps have no weekly arrays
+        for name in ['weekly', 'weekly_total', 'weekly_days']:
+            if os.path.exists(os.path.join(path, f'{name}.npy')):
+                self.arrays[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+
+    @property
+    def has_weekly(self):
+        return 'weekly' in self.arrays
+
+    def __contains__(self, station):
+        return station in self.ids
+
+    def hourly(self, station):
+        """Average trips by hour as a frame with day_type, direction, hour and trips."""
+        i = self.ids[station]
+        profile = np.asarray(self.arrays['hourly'][i])
+        rows = [{'day_type': DAY_TYPES[d], 'direction': ['Departures', 'Arrivals'][a], 'hour': h,
+                 'trips': float(profile[d, a, h])}
+                for d in range(2) for a in range(2) for h in range(24)]
+        return pd.DataFrame(rows)
+
+    def daily(self, station):
+        i = self.ids[station]
+        dates = pd.date_range(f'{self.year}-01-01', f'{self.year}-12-31')
+        return pd.DataFrame({'date': dates, 'departures': np.asarray(self.arrays['daily'][i][:len(dates)])})
+
+    def destinations(self, station):
+        i = self.ids[station]
+        trips = np.asarray(self.arrays['destination_trips'][i])
+        names = [self.stations[j] for j in self.arrays['destinations'][i]]
+        df = pd.DataFrame({'destination': names, 'trips': trips})
+        return df[df['trips'] > 0]
+
+    def net(self, station):
+        return int(self.arrays['net'][self.ids[station]])
+
+    def weekly(self, station=None, months=range(1, 13), direction=0):
+        """Average trips per hour by day of week (rows) and hour (columns).
+
+        For one station, or every trip when station is None, over the given
+        months; direction 0 counts departures and 1 arrivals.
+        """
+        months = np.asarray(months) - 1
+        counts = (self.arrays['weekly'][self.ids[station]] if station is not None
+                  else self.arrays['weekly_total'])[direction, months].sum(axis=0)
+        days = np.asarray(self.arrays['weekly_days'])[months].sum(axis=0)
+        average = counts / np.maximum(days, 1)[:, None]
+        return pd.DataFrame(average, index=WEEKDAYS, columns=range(24))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the per-station profile store for a registered city/year.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    build(query.trips_path(entry), profiles_path(entry), args.year)
+    print(f'Station profiles written for {args.city} {args.year}')
@@ -0,0 +1,147 @@
+####################################################################################
+############################# Ad-hoc trip queries ##################################
+####################################################################################
+
+# An in-process DuckDB engine over the prepared trip data.  The trips are kept as
+# Parquet files partitioned by month under data/<city>/<year>/trips/, and DuckDB
+# scans them directly with all cores, spilling to disk when a query does not fit
+# in memory.  Only the (small) result of a query ever becomes a pandas frame.
+#
+# Convert the prepared pickle from the notebooks into a trip store with:
+#
+#   python -m citibike.query --pickle ny_data_ex_2.4.pkl --city nyc --year 2022
+
+import argparse
+import os
+import re
+import time
+
+import pandas as pd
+
+from citibike import registry
+
+
+# Where DuckDB spills intermediate results that do not fit in memory_limit
+SPILL_DIR = '.duckdb_tmp'
+
+# Queries answering questions from the notebooks, offered as starting points in the dashboard
+EXAMPLES = {
+    'Trips missing a start or end station (Ex 2.5)': """
+SELECT
+    count(*) FILTER (WHERE start_station_name IS NULL) AS missing_start,
+    count(*) FILTER (WHERE end_station_name IS NULL) AS missing_end,
+    count(*) AS all_trips
+FROM trips""",
+    'Average daily trips by season (Seasonal Variations)': """
+WITH daily AS (
+    SELECT date, month, count(*) AS no_of_trips
+    FROM trips
+    GROUP BY date, month
+)
+SELECT
+    CASE WHEN month IN (11, 12, 1, 2, 3, 4) THEN 'Nov-Apr'
+         WHEN month IN (6, 7, 8, 9) THEN 'Jun-Sep'
+         WHEN month = 5 THEN 'May'
+         ELSE 'Oct' END AS month_group,
+    round(avg(no_of_trips)) AS avg_daily_trips
+FROM daily
+GROUP BY month_group
+ORDER BY avg_daily_trips DESC""",
+    'Most popular routes': """
+SELECT start_station_name, end_station_name, count(*) AS trips
+FROM trips
+WHERE start_station_name IS NOT NULL AND end_station_name IS NOT NULL
+GROUP BY ALL
+ORDER BY trips DESC
+LIMIT 20""",
+    'Trip duration by member type': """
+SELECT
+    member_casual,
+    count(*) AS trips,
+    round(median(trip_duration), 1) AS median_minutes,
+    round(quantile_cont(trip_duration, 0.9), 1) AS p90_minutes
+FROM trips
+GROUP BY member_casual""",
+}
+
+
+def trips_path(entry, data_dir=registry.DATA_DIR):
+    return os.path.join(data_dir, entry['path'], entry.get('trips', 'trips'))
+
+
+def write_trip_store(df, path):
+    """Write a prepared trip frame as Parquet files partitioned by month."""
+    df = df.copy()
+    df['month'] = pd.to_datetime(df['date']).dt.month.astype('int8')
+
+    # The notebooks add a helper 'value' column for counting; it is not needed here
+    df = df.drop(columns=[c for c in ['value', '_merge'] if c in df.columns])
+
+    for month, df_month in df.groupby('month'):
+        folder = os.path.join(path, f'month={month:02d}')
+        os.makedirs(folder, exist_ok=True)
+        df_month.drop(columns='month').to_parquet(os.path.join(folder, 'trips.parquet'), index=False)
+
+
+def connect(path, threads=None, memory_limit='4GB', spill_dir=SPILL_DIR):
+    """Open an in-memory DuckDB database with a 'trips' view over the trip store at path."""
+    import duckdb
+
+    con = duckdb.connect(database=':memory:')
+    if threads:
+        con.execute(f'SET threads = {int(threads)}')
+    con.execute(f"SET memory_limit = '{memory_limit}'")
+    con.execute(f"SET temp_directory = '{spill_dir}'")
+
+    # Result order is irrelevant for aggregates and dropping it lets DuckDB stream more
+    con.execute('SET preserve_insertion_order = false')
+
+    pattern = os.path.join(path, '**', '*.parquet').replace("'", "''")
+    con.execute(f"CREATE VIEW trips AS SELECT * FROM read_parquet('{pattern}', hive_partitioning = true)")
+
+    # Queries typed into the dashboard must not read anything on the machine but the trips
+    allowed = ', '.join("'" + p.replace("'", "''") + "'" for p in {path, os.path.abspath(path)})
+    con.execute(f'SET allowed_directories = [{allowed}]')
+    con.execute('SET enable_external_access = false')
+    con.execute('SET lock_configuration = true')
+    return con
+
+
+def check_read_only(sql):
+    # The dashboard panel only runs queries; anything that could change the database is rejected
+    statement = re.sub(r'--[^\n]*', '', sql).strip().rstrip(';')
+    if ';' in statement:
+        raise ValueError('Only a single statement can be run at a time.')
+    if not re.match(r'(?is)^\s*(select|with|describe|summarize|pivot|from)\b', statement):
+        raise ValueError('Only SELECT queries can be run here.')
+    return statement
+
+
+def run(con, sql, max_rows=10000):
+    """Run a read-only query and return (result frame, seconds taken, whether rows were cut off).
+
+    At most max_rows rows are fetched into pandas, whatever the query returns.
+    The query runs on its own cursor, so one connection can serve several
+    threads at once.
+    """
+    statement = check_read_only(sql)
+    start = time.perf_counter()
+    result = con.cursor().execute(statement)
+    rows = result.fetchmany(max_rows + 1)
+    df = pd.DataFrame(rows[:max_rows], columns=[c[0] for c in result.description])
+    return df, time.perf_counter() - start, len(rows) > max_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the Parquet trip store for a registered city/year.')
+    parser.add_argument('--pickle', required=True, help='prepared trip data, e.g. ny_data_ex_2.4.pkl')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    write_trip_store(pd.read_pickle(args.pickle), trips_path(entry))
+
+    # Re-register so the manifest records that this partition now has a trip store
+    registry.register(entry['city'], entry['city_name'], entry['year'], entry['path'])
+    print(f'Trip store written to {trips_path(entry)}')
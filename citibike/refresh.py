@@ -0,0 +1,141 @@
+####################################################################################
+########################## Background aggregate refresh ############################
+####################################################################################
+
+# Keeps the dashboard's snapshot up to date without a restart.  A worker thread
+# watches the registered aggregate files; when they change it builds a new
+# snapshot (in a separate process, so the app's own threads are not slowed),
+# validates it, warms it and only then activates it.  Until that moment every
+# session keeps being served the previous snapshot, so a refresh never shows
+# up as a slow page.  Listeners are called with the new version afterwards so
+# open sessions can re-render.
+#
+# Each Streamlit process has its own refresher, but only the one that gets the
+# snapshot build lock rebuilds; the others skip that round and pick up the
+# version it activates.
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from citibike import registry, snapshot
+
+
+def fingerprint(data_dir=registry.DATA_DIR):
+    """Size and modification time of every registered table and of the manifest itself."""
+    manifest_path = os.path.join(data_dir, 'manifest.json')
+    manifest = registry.load_manifest(manifest_path)
+    files = [manifest_path] + [registry.table_path(entry, table, data_dir)
+                               for entry in manifest['datasets'] for table in entry['tables']]
+    stats = []
+    for path in files:
+        try:
+            st = os.stat(path)
+            stats.append((path, st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            stats.append((path, None, None))
+    return tuple(stats)
+
+
+def _build(data_dir, snapshot_dir):
+    # Runs in the worker process
+    return snapshot.build(data_dir=data_dir, snapshot_dir=snapshot_dir)
+
+
+class Refresher:
+
+    def __init__(self, interval=60, warm=None, data_dir=registry.DATA_DIR,
+                 snapshot_dir=snapshot.SNAPSHOT_DIR, keep=3):
+        self.interval = interval
+        self.warm = warm                    # called with a new version before it is activated
+        self.data_dir = data_dir
+        self.snapshot_dir = snapshot_dir
+        self.keep = keep
+
+        self.version = snapshot.current_version(snapshot_dir)
+        self.last_error = None
+        self.refreshing = False
+
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._fingerprint = None
+
+    def add_listener(self, callback):
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def request_refresh(self):
+        """Rebuild on the next loop iteration instead of waiting for a file change."""
+        self._fingerprint = None
+        self._wake.set()
+
+    def refresh(self):
+        """Build, validate, warm and activate a new snapshot.
+
+        Returns the new version, or None if another process is building one.
+        """
+        with snapshot.build_lock(self.snapshot_dir, blocking=False) as locked:
+            if not locked:
+                return None
+            self.refreshing = True
+            try:
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    version = pool.submit(_build, self.data_dir, self.snapshot_dir).result()
+
+                snapshot.validate(version, self.snapshot_dir)
+                if self.warm is not None:
+                    self.warm(version)
+
+                snapshot.activate(version, self.snapshot_dir)
+                snapshot.prune(self.keep, self.snapshot_dir)
+                self.last_error = None
+            finally:
+                self.refreshing = False
+
+        self._activated(version)
+        return version
+
+    def _activated(self, version):
+        self.version = version
+        with self._lock:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback(version)
+
+    def _loop(self):
+        while True:
+            current = fingerprint(self.data_dir)
+            if current != self._fingerprint:
+                try:
+                    # The first pass only records the files unless there is no snapshot yet
+                    if self._fingerprint is not None or self.version is None:
+                        self.refresh()
+                    self._fingerprint = current
+                except Exception as e:
+                    # Keep serving the old snapshot and try again next time round
+                    self.last_error = e
+
+            # Another process may have built and activated a snapshot
+            active = snapshot.current_version(self.snapshot_dir)
+            if active is not None and active != self.version:
+                try:
+                    if self.warm is not None:
+                        self.warm(active)
+                    self._activated(active)
+                except Exception as e:
+                    self.last_error = e
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        thread = threading.Thread(target=self._loop, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,243 @@
+####################################################################################
+############################### Dataset registry ###################################
+####################################################################################
+
+# Every city/year is a partition under data/<city>/<year>/ holding the small
+# pre-aggregated tables the dashboard needs.  data/manifest.json lists the
+# partitions, the file behind each table and a monthly trip summary, so
+# year-over-year comparisons can be made from the manifest alone without
+# opening any partition, let alone the raw trips.
+#
+# Register (or refresh) a partition after building its tables with:
+#
+#   python -m citibike.registry --city nyc --city-name "New York City" --year 2022
+
+import argparse
+import json
+import os
+
+import pandas as pd
+
+
+DATA_DIR = 'data'
+MANIFEST = os.path.join(DATA_DIR, 'manifest.json')
+
+# Default file name for each table inside a partition
+TABLES = {
+    'daily': 'daily_trips_temp.csv',
+    'start_stations': 'start_stations.csv',
+    'avg_day': 'avg_day.csv',
+    'imbalance': 'station_imbalance_to_graph.csv',
+    'top20': 'top20_start_stations.csv',
+    'duration_sketches': 'duration_sketches.parquet',
+    'heavy_hitters': 'heavy_hitters.parquet',
+    'routes': 'routes.parquet',
+    'flow_pyramid': 'flow_pyramid.parquet',
+    'anomalies': 'anomalies.parquet',
+    'rebalancing': 'rebalancing.parquet',
+    'inventory': 'inventory.parquet',
+    'typology': 'station_typology.parquet',
+    'zones': 'station_zones.parquet',
+    'zone_flows': 'zone_flows.parquet',
+    'expansion_sites': 'expansion_sites.parquet',
+}
+
+# Columns parsed as dates when a table is read
+DATE_COLUMNS = {
+    'daily': ['date'],
+}
+
+# Types columns are read into.  Every other column is compacted by compact(): repeated names
+# become categoricals (each distinct name stored once), 64-bit integers 32-bit and coordinates
+# float32, so a table held by the dashboard takes a fraction of the default pandas types.
+COLUMN_TYPES = {
+    'daily': {'avgTemp': 'float32', 'no_of_trips': 'int32'},
+    'start_stations': {'total_departures': 'int32', 'latitude': 'float32', 'longitude': 'float32'},
+    'avg_day': {'day_type': 'category', 'start_hour': 'int8', 'trip_count': 'float32'},
+    'imbalance': {'departures': 'int32', 'arrivals': 'int32', 'difference': 'int32',
+                  'latitude': 'float32', 'longitude': 'float32'},
+    'top20': {'value': 'int32'},
+}
+
+# Tables whose first CSV column is a real index (station names).  In the others it only holds the
+# row numbers of the frame the table was cut from in the notebooks, and is dropped.
+INDEX_TABLES = {'imbalance'}
+
+COORDINATES = {'lat', 'lng', 'latitude', 'longitude', 'start_lat', 'start_lng', 'end_lat', 'end_lng'}
+
+
+def load_manifest(path=MANIFEST):
+    if not os.path.exists(path):
+        return {'datasets': []}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path=MANIFEST):
+    # Write to a temporary file first so a reader never sees half a manifest
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def find(manifest, city, year):
+    for entry in manifest['datasets']:
+        if entry['city'] == city and entry['year'] == int(year):
+            return entry
+    raise KeyError(f'No dataset registered for {city} {year}')
+
+
+def cities(manifest):
+    """Registered cities as {city code: display name}, in manifest order."""
+    return {entry['city']: entry['city_name'] for entry in manifest['datasets']}
+
+
+def years(manifest, city):
+    return sorted(entry['year'] for entry in manifest['datasets'] if entry['city'] == city)
+
+
+def table_path(entry, table, data_dir=DATA_DIR):
+    return os.path.join(data_dir, entry['path'], entry['tables'][table])
+
+
+def has_table(entry, table, data_dir=DATA_DIR):
+    return table in entry['tables'] and os.path.exists(table_path(entry, table, data_dir))
+
+
+def compact(df, types=None):
+    """df with repeated names as categoricals, 32-bit integers and float32 coordinates.
+
+    Columns in `types` are cast to the type given instead.  Names that are
+    mostly distinct, other floats and values too large for 32 bits are kept as
+    they are.
+    """
+    types = types or {}
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if column in types:
+            columns[column] = values.astype(types[column])
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            continue
+        elif pd.api.types.is_string_dtype(values):
+            if values.nunique() <= len(values) // 2:
+                columns[column] = values.astype('category')
+        elif pd.api.types.is_integer_dtype(values) and values.dtype.itemsize > 4:
+            if len(values) == 0 or (values.min() >= -2 ** 31 and values.max() < 2 ** 31):
+                columns[column] = values.astype('int32')
+        elif column in COORDINATES and pd.api.types.is_float_dtype(values):
+            columns[column] = values.astype('float32')
+    return df.assign(**columns) if columns else df
+
+
+def read_table(path, table):
+    """Read a table file into its compact types (see COLUMN_TYPES)."""
+    types = COLUMN_TYPES.get(table, {})
+    if path.endswith('.parquet'):
+        return compact(pd.read_parquet(path), types)
+    df = pd.read_csv(path, index_col=0, dtype=types, parse_dates=DATE_COLUMNS.get(table, False))
+    if table not in INDEX_TABLES:
+        df = df.reset_index(drop=True)
+    return compact(df)
+
+
+def load_table(entry, table, data_dir=DATA_DIR):
+    """Read one table of one partition.  Nothing else in the partition is touched."""
+    return read_table(table_path(entry, table, data_dir), table)
+
+
+def table_memory(entry, data_dir=DATA_DIR):
+    """Rows and bytes in memory of every table of a partition, read with default pandas types and compacted."""
+    rows = []
+    for table in entry['tables']:
+        path = table_path(entry, table, data_dir)
+        default = (pd.read_parquet(path) if path.endswith('.parquet')
+                   else pd.read_csv(path, index_col=0, parse_dates=DATE_COLUMNS.get(table, False)))
+        rows.append({'table': table, 'rows': len(default),
+                     'default_bytes': int(default.memory_usage(deep=True).sum()),
+                     'compact_bytes': int(read_table(path, table).memory_usage(deep=True).sum())})
+    df = pd.DataFrame(rows, columns=['table', 'rows', 'default_bytes', 'compact_bytes'])
+    df['ratio'] = (df['default_bytes'] / df['compact_bytes']).round(1)
+    return df
+
+
+def monthly_summary(daily):
+    """Trips and mean temperature per calendar month from a daily table."""
+    by_month = daily.groupby(daily['date'].dt.month)
+    return {
+        'total_trips': int(daily['no_of_trips'].sum()),
+        'monthly_trips': {str(m): int(v) for m, v in by_month['no_of_trips'].sum().items()},
+        'monthly_avg_temp': {str(m): round(float(v), 2) for m, v in by_month['avgTemp'].mean().items()},
+    }
+
+
+def year_over_year(manifest, city):
+    """Monthly trips for every registered year of a city, read from the manifest summaries.
+
+    Returns a frame with one row per month and one column per year.
+    """
+    columns = {}
+    for entry in manifest['datasets']:
+        if entry['city'] == city and 'summary' in entry:
+            trips = entry['summary']['monthly_trips']
+            columns[entry['year']] = pd.Series({int(m): v for m, v in trips.items()})
+    df = pd.DataFrame(columns).sort_index(axis=1)
+    df.index.name = 'month'
+    return df
+
+
+def register(city, city_name, year, path=None, tables=None, data_dir=DATA_DIR):
+    """Add or update a partition in the manifest and recompute its summary."""
+    manifest = load_manifest(os.path.join(data_dir, 'manifest.json'))
+    entry = {
+        'city': city,
+        'city_name': city_name,
+        'year': int(year),
+        'path': path or f'{city}/{year}',
+        'tables': {},
+    }
+
+    # Only list the tables that actually exist in the partition folder
+    for table, filename in (tables or TABLES).items():
+        if os.path.exists(os.path.join(data_dir, entry['path'], filename)):
+            entry['tables'][table] = filename
+
+    # Trip-level Parquet store used for ad-hoc queries (see citibike.query), if one has been built
+    if os.path.isdir(os.path.join(data_dir, entry['path'], 'trips')):
+        entry['trips'] = 'trips'
+
+    if 'daily' in entry['tables']:
+        entry['summary'] = monthly_summary(load_table(entry, 'daily', data_dir))
+
+    manifest['datasets'] = [e for e in manifest['datasets']
+                            if not (e['city'] == city and e['year'] == int(year))]
+    manifest['datasets'].append(entry)
+    manifest['datasets'].sort(key=lambda e: (e['city'], e['year']))
+
+    save_manifest(manifest, os.path.join(data_dir, 'manifest.json'))
+    return entry
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Register a city/year partition in the dataset manifest.')
+    parser.add_argument('--city', required=True, help='short city code, e.g. nyc or chicago')
+    parser.add_argument('--city-name', help='name shown in the dashboard sidebar')
+    parser.add_argument('--year', required=True, type=int)
+    parser.add_argument('--path', help='partition folder relative to data/ (default <city>/<year>)')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--memory', action='store_true',
+                        help='report the memory each table of a registered partition takes instead')
+    args = parser.parse_args()
+
+    if args.memory:
+        manifest = load_manifest(os.path.join(args.data_dir, 'manifest.json'))
+        usage = table_memory(find(manifest, args.city, args.year), args.data_dir)
+        print(usage.to_string(index=False))
+        print(f"Total: {usage['default_bytes'].sum() / 2 ** 20:.1f} MB with default types, "
+              f"{usage['compact_bytes'].sum() / 2 ** 20:.1f} MB compacted")
+    elif not args.city_name:
+        parser.error('--city-name is required to register a partition')
+    else:
+        entry = register(args.city, args.city_name, args.year, args.path, data_dir=args.data_dir)
+        print(f"Registered {entry['city']} {entry['year']}: {', '.join(entry['tables'])}")
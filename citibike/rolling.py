@@ -0,0 +1,138 @@
+####################################################################################
+######################### Rolling weather/ridership statistics #####################
+####################################################################################
+
+# Puts numbers on the trips-temperature relationship that page 4 only shows on
+# dual axes.  Everything works from running sums: RollingStats takes one new
+# observation at a time in O(1) however long the window, and the batch
+# versions are differences of cumulative sums over whole arrays, which keeps
+# multi-year hourly series fast.
+
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+class RollingStats:
+    """Rolling mean, variance and correlation of two series, updated one pair at a time.
+
+    A pair with a missing value takes up its place in the window but adds
+    nothing to the sums, as in rolling_correlation.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.values = deque()
+        self.n = 0
+        self.sx = self.sy = self.sxx = self.syy = self.sxy = 0.0
+
+    def _add(self, x, y, sign):
+        if np.isnan(x) or np.isnan(y):
+            return
+        self.n += sign
+        self.sx += sign * x
+        self.sy += sign * y
+        self.sxx += sign * x * x
+        self.syy += sign * y * y
+        self.sxy += sign * x * y
+
+    def update(self, x, y):
+        x, y = float(x), float(y)
+        self.values.append((x, y))
+        self._add(x, y, 1)
+        if len(self.values) > self.window:
+            self._add(*self.values.popleft(), -1)
+        return self
+
+    def mean(self):
+        if self.n == 0:
+            return np.nan, np.nan
+        return self.sx / self.n, self.sy / self.n
+
+    def variance(self):
+        if self.n < 2:
+            return np.nan, np.nan
+        return ((self.sxx - self.sx ** 2 / self.n) / (self.n - 1),
+                (self.syy - self.sy ** 2 / self.n) / (self.n - 1))
+
+    def correlation(self):
+        if self.n < 2:
+            return np.nan
+        cov = self.sxy - self.sx * self.sy / self.n
+        var_x = self.sxx - self.sx ** 2 / self.n
+        var_y = self.syy - self.sy ** 2 / self.n
+        if var_x <= 0 or var_y <= 0:
+            return np.nan
+        return cov / np.sqrt(var_x * var_y)
+
+
+def _window_sums(a, window):
+    # Sum of each trailing window via one cumulative sum
+    c = np.concatenate([[0.0], np.cumsum(a)])
+    sums = np.full(len(a), np.nan)
+    sums[window - 1:] = c[window:] - c[:-window]
+    return sums
+
+
+def rolling_correlation(x, y, window, min_periods=2):
+    """Pearson correlation over each trailing window of the two series (vectorised).
+
+    Pairs with a missing value are left out of the windows they fall in, so a
+    gap only affects the windows that contain it; windows with fewer than
+    min_periods complete pairs give NaN.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~(np.isnan(x) | np.isnan(y))
+
+    # Centre first so the running sums do not lose precision on large counts, and zero the gaps
+    # so they add nothing to the sums
+    x = np.where(valid, x - (x[valid].mean() if valid.any() else 0), 0)
+    y = np.where(valid, y - (y[valid].mean() if valid.any() else 0), 0)
+
+    n = _window_sums(valid, window)
+    sx, sy = _window_sums(x, window), _window_sums(y, window)
+    sxx, syy, sxy = _window_sums(x * x, window), _window_sums(y * y, window), _window_sums(x * y, window)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = sxy - sx * sy / n
+        var_x = sxx - sx ** 2 / n
+        var_y = syy - sy ** 2 / n
+        r = cov / np.sqrt(var_x * var_y)
+    return np.where(n >= max(min_periods, 2), r, np.nan)
+
+
+def lagged_correlation(x, y, max_lag):
+    """Correlation of x today with y `lag` steps later, for lags -max_lag..max_lag."""
+    x = pd.Series(np.asarray(x, dtype=np.float64))
+    y = pd.Series(np.asarray(y, dtype=np.float64))
+    lags = np.arange(-max_lag, max_lag + 1)
+    return pd.DataFrame({'lag': lags, 'correlation': [x.corr(y.shift(-lag)) for lag in lags]})
+
+
+def temperature_elasticity(temperature, trips, bin_width=5):
+    """How ridership responds to temperature within each temperature band.
+
+    For each band the slope of log(trips) against temperature is fitted by
+    least squares (from grouped sums, no loop over bands), and reported as the
+    percentage change in trips for each extra degree.
+    """
+    df = pd.DataFrame({'temp': np.asarray(temperature, dtype=np.float64),
+                       'log_trips': np.log(np.asarray(trips, dtype=np.float64))})
+    df = df.replace([np.inf, -np.inf], np.nan).dropna()
+    df['band'] = (np.floor(df['temp'] / bin_width) * bin_width).astype(int)
+    df['tt'] = df['temp'] ** 2
+    df['ty'] = df['temp'] * df['log_trips']
+
+    g = df.groupby('band').agg(n=('temp', 'size'), st=('temp', 'sum'), sy=('log_trips', 'sum'),
+                               stt=('tt', 'sum'), sty=('ty', 'sum'))
+    denominator = g['n'] * g['stt'] - g['st'] ** 2
+    slope = (g['n'] * g['sty'] - g['st'] * g['sy']) / denominator.where(denominator > 0)
+
+    return pd.DataFrame({
+        'band': g.index.astype(str) + ' to ' + (g.index + bin_width).astype(str) + ' °C',
+        'days': g['n'].to_numpy(),
+        'mean_trips': np.exp(g['sy'] / g['n']).round().to_numpy(),
+        'pct_change_per_degree': ((np.exp(slope) - 1) * 100).round(2).to_numpy(),
+    })
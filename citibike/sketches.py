@@ -0,0 +1,259 @@
+####################################################################################
+############################## Streaming sketches ##################################
+####################################################################################
+
+# Small, mergeable summaries that are updated chunk by chunk while trips are
+# ingested, so distributions can be shown for any slice of the data without
+# going back to the 30 million raw rows.
+
+import argparse
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+from citibike import query, registry
+
+
+####################### Log-bucketed duration histograms ###########################
+
+# Each bucket covers values within +/- RELATIVE_ERROR of its centre, so any
+# quantile read back from the sketch is within 2% of the exact answer.  Trip
+# durations from one second to several days need only a few hundred buckets.
+
+RELATIVE_ERROR = 0.02
+GAMMA = (1 + RELATIVE_ERROR) / (1 - RELATIVE_ERROR)
+MIN_VALUE = 1 / 60          # one second, in minutes
+
+# The dimensions sketches are kept for during ingestion
+DURATION_KEYS = ['member_casual', 'rideable_type', 'start_station_name', 'month']
+
+
+def bucket_index(values):
+    """Bucket number for each value (vectorised)."""
+    values = np.maximum(np.asarray(values, dtype=np.float64), MIN_VALUE)
+    return np.ceil(np.log(values) / np.log(GAMMA)).astype(np.int32)
+
+
+def bucket_value(index):
+    """Representative value (centre) of each bucket."""
+    return 2 * GAMMA ** np.asarray(index, dtype=np.float64) / (GAMMA + 1)
+
+
+class LogHistogram:
+    """A mergeable quantile sketch over positive values.
+
+    counts maps bucket number to the number of values that fell into it.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = pd.Series(counts if counts is not None else {}, dtype=np.int64)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        index, n = np.unique(bucket_index(values), return_counts=True)
+        self.counts = self.counts.add(pd.Series(n, index=index), fill_value=0).astype(np.int64)
+        return self
+
+    def merge(self, other):
+        self.counts = self.counts.add(other.counts, fill_value=0).astype(np.int64)
+        return self
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def quantile(self, q):
+        return quantiles_from_counts(self.counts, [q])[0]
+
+
+def quantiles_from_counts(counts, qs):
+    """Quantiles from a Series of bucket counts indexed by bucket number."""
+    counts = counts[counts > 0].sort_index()
+    if counts.empty:
+        return [np.nan for _ in qs]
+
+    cumulative = counts.to_numpy().cumsum()
+    total = cumulative[-1]
+    ranks = np.asarray(qs) * (total - 1)
+    positions = np.searchsorted(cumulative, ranks, side='right')
+    return [float(v) for v in bucket_value(counts.index.to_numpy()[positions])]
+
+
+def duration_sketches(trips, keys=DURATION_KEYS):
+    """Sketch table for one chunk of trips.
+
+    Returns a long frame with one row per (keys..., bucket) and the number of
+    trips in it.  Chunks are combined with merge_sketches, so the full year
+    never has to be in memory at once.
+    """
+    df = trips[[k for k in keys if k != 'month'] + ['trip_duration']].copy()
+    if 'month' in keys:
+        df['month'] = pd.to_datetime(trips['date']).dt.month.astype('int8')
+
+    df = df.dropna(subset=['trip_duration'])
+    df['bucket'] = bucket_index(df['trip_duration'].to_numpy())
+    return (df.groupby(keys + ['bucket'], observed=True, dropna=False)
+              .size().rename('trips').reset_index())
+
+
+def merge_sketches(*tables):
+    """Combine sketch tables (from different chunks, months or workers) into one."""
+    df = pd.concat(tables, ignore_index=True)
+    keys = [c for c in df.columns if c != 'trips']
+    return df.groupby(keys, observed=True, dropna=False)['trips'].sum().reset_index()
+
+
+def slice_histogram(sketch, **filters):
+    """Bucket counts for the trips matching filters, e.g. member_casual=['member'].
+
+    A filter that is None or empty means 'all values'.
+    """
+    mask = np.ones(len(sketch), dtype=bool)
+    for column, allowed in filters.items():
+        if allowed:
+            mask &= sketch[column].isin(allowed).to_numpy()
+    return sketch[mask].groupby('bucket')['trips'].sum()
+
+
+######################### Heavy hitters (top stations/routes) ######################
+
+# Space-Saving keeps at most `capacity` keys with an over-estimate of their
+# count; any key whose true count exceeds N / capacity is guaranteed to be kept,
+# and each reported count is at most `error` above the truth.  Summaries for
+# different months or workers merge into a summary with the same guarantee.
+
+HEAVY_HITTER_CAPACITY = 2000
+ROUTE_SEPARATOR = ' -> '
+
+
+class SpaceSaving:
+
+    def __init__(self, capacity=HEAVY_HITTER_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+
+    def _min_count(self):
+        # Keys not in a full summary may have occurred up to this many times
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def update(self, keys):
+        """Add one occurrence of every key in an array-like of keys."""
+        chunk = pd.Series(keys).dropna().value_counts()
+        return self.update_counts(chunk.index, chunk.to_numpy())
+
+    def update_counts(self, keys, counts):
+        """Add pre-aggregated (key, count) pairs.
+
+        The chunk is turned into an exact summary of its heaviest keys and
+        merged in, which keeps ingestion vectorised rather than key by key.
+        """
+        chunk = pd.Series(np.asarray(counts), index=pd.Index(keys, dtype=object)).groupby(level=0).sum()
+        heaviest = chunk.nlargest(self.capacity)
+
+        summary = SpaceSaving(self.capacity)
+        summary.counts = dict(zip(heaviest.index, heaviest.tolist()))
+        summary.errors = dict.fromkeys(heaviest.index, 0)
+        summary.total = int(chunk.sum())
+        return self.merge(summary)
+
+    def merge(self, other):
+        """Merge another summary into this one (Cafaro et al. parallel Space-Saving)."""
+        min_self, min_other = self._min_count(), other._min_count()
+        counts, errors = {}, {}
+        for key in set(self.counts) | set(other.counts):
+            counts[key] = self.counts.get(key, min_self) + other.counts.get(key, min_other)
+            errors[key] = self.errors.get(key, min_self) + other.errors.get(key, min_other)
+
+        keep = sorted(counts, key=counts.get, reverse=True)[:self.capacity]
+        self.counts = {k: counts[k] for k in keep}
+        self.errors = {k: errors[k] for k in keep}
+        self.total += other.total
+        return self
+
+    def top(self, k):
+        """The k heaviest keys with estimated count and the most it can be over by."""
+        df = pd.DataFrame({'key': list(self.counts), 'count': list(self.counts.values()),
+                           'error': [self.errors[key] for key in self.counts]})
+        return df.nlargest(k, 'count').reset_index(drop=True)
+
+    def to_frame(self):
+        return pd.DataFrame({'key': list(self.counts), 'count': list(self.counts.values()),
+                             'error': [self.errors[key] for key in self.counts]})
+
+    @classmethod
+    def from_frame(cls, df, total, capacity=HEAVY_HITTER_CAPACITY):
+        summary = cls(capacity)
+        summary.counts = dict(zip(df['key'], df['count'].tolist()))
+        summary.errors = dict(zip(df['key'], df['error'].tolist()))
+        summary.total = int(total)
+        return summary
+
+
+def route_keys(trips):
+    # Names may come in as categoricals (registry.compact), which do not concatenate
+    start, end = trips['start_station_name'].astype('string'), trips['end_station_name'].astype('string')
+    return (start + ROUTE_SEPARATOR + end).dropna()
+
+
+def heavy_hitters(trips, capacity=HEAVY_HITTER_CAPACITY):
+    """Space-Saving summaries of start stations and routes for one month of trips.
+
+    Returns a long frame (month, kind, key, count, error, total).
+    """
+    month = int(pd.to_datetime(trips['date']).dt.month.iloc[0])
+    frames = []
+    for kind, keys in [('station', trips['start_station_name']), ('route', route_keys(trips))]:
+        summary = SpaceSaving(capacity).update(keys)
+        df = summary.to_frame()
+        df['kind'], df['month'], df['total'] = kind, month, summary.total
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)[['month', 'kind', 'key', 'count', 'error', 'total']]
+
+
+def top_k(table, kind, months, k=20):
+    """Top k keys of one kind over a window of months, by merging the monthly summaries."""
+    merged = None
+    for month, df in table[(table['kind'] == kind) & table['month'].isin(months)].groupby('month'):
+        summary = SpaceSaving.from_frame(df, df['total'].iloc[0])
+        merged = summary if merged is None else merged.merge(summary)
+    if merged is None:
+        return pd.DataFrame(columns=['key', 'count', 'error'])
+    return merged.top(k)
+
+
+def build_duration_sketches(trips_path):
+    """Sketch table for a whole trip store, read one monthly Parquet file at a time."""
+    tables = []
+    for path in sorted(glob.glob(os.path.join(trips_path, '**', '*.parquet'), recursive=True)):
+        columns = [k for k in DURATION_KEYS if k != 'month'] + ['trip_duration', 'date']
+        tables.append(duration_sketches(pd.read_parquet(path, columns=columns)))
+    return merge_sketches(*tables)
+
+
+def build_heavy_hitters(trips_path, capacity=HEAVY_HITTER_CAPACITY):
+    """Monthly heavy-hitter summaries for a whole trip store, one month in memory at a time."""
+    tables = []
+    for path in sorted(glob.glob(os.path.join(trips_path, '**', '*.parquet'), recursive=True)):
+        trips = pd.read_parquet(path, columns=['start_station_name', 'end_station_name', 'date'])
+        tables.append(heavy_hitters(trips, capacity))
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the trip duration and heavy-hitter sketches for a registered city/year.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    sketch = build_duration_sketches(query.trips_path(entry))
+    sketch.to_parquet(os.path.join(registry.DATA_DIR, entry['path'], registry.TABLES['duration_sketches']))
+    build_heavy_hitters(query.trips_path(entry)).to_parquet(
+        os.path.join(registry.DATA_DIR, entry['path'], registry.TABLES['heavy_hitters']))
+    registry.register(entry['city'], entry['city_name'], entry['year'], entry['path'])
+    print(f'{len(sketch):,} sketch rows written for {args.city} {args.year}')
@@ -0,0 +1,239 @@
+####################################################################################
+########################### Aggregate snapshot bundles #############################
+####################################################################################
+
+# The aggregate tables of every registered partition are packed into one
+# versioned snapshot under data/snapshots/<version>/: an Arrow IPC file per
+# table plus a manifest.json describing them.  The dashboard memory-maps these
+# files read-only, so all Streamlit processes on a host share the same pages
+# and a cold start does not parse any CSV.
+#
+# data/snapshots/CURRENT names the active version.  It is replaced with a single
+# os.replace, so readers see either the old or the new snapshot, never a mix.
+# PREVIOUS names the version it replaced, which processes that have not yet
+# moved on may still have mapped, so pruning leaves both alone.
+#
+# Every Streamlit process runs its own refresher, so builds take an exclusive
+# lock on data/snapshots/.build.lock; a refresher that finds it held leaves the
+# build to the process holding it.
+#
+#   python -m citibike.snapshot build --activate
+#   python -m citibike.snapshot activate v20221231T000000.000000
+#   python -m citibike.snapshot list
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+
+from citibike import registry
+
+
+SNAPSHOT_DIR = os.path.join(registry.DATA_DIR, 'snapshots')
+CURRENT = 'CURRENT'
+PREVIOUS = 'PREVIOUS'
+LOCK_FILE = '.build.lock'
+
+
+def _table_file(city, year, table):
+    return os.path.join(city, str(year), f'{table}.arrow')
+
+
+@contextmanager
+def build_lock(snapshot_dir=SNAPSHOT_DIR, blocking=True):
+    """Hold the snapshot build lock for the duration of the block.
+
+    Yields True once the lock is held, or False straight away when it is not
+    blocking and another process holds it.  The operating system releases
+    the lock if the holder dies.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open(os.path.join(snapshot_dir, LOCK_FILE), 'a+b') as f:
+        try:
+            import fcntl
+            lock = lambda: fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            unlock = lambda: fcntl.flock(f, fcntl.LOCK_UN)
+        except ImportError:             # Windows
+            import msvcrt
+            lock = lambda: msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            unlock = lambda: msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        try:
+            lock()
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            unlock()
+
+
+def build(manifest=None, snapshot_dir=SNAPSHOT_DIR, data_dir=registry.DATA_DIR, version=None):
+    """Write every table of every registered partition into a new snapshot folder.
+
+    The folder is written under a temporary name of its own and renamed when
+    complete, so a half-written snapshot can never be activated and two builds
+    never share a folder.  Version names go down to the microsecond, so builds
+    run one after the other within a second get their own.  Returns the version
+    name.
+    """
+    import pyarrow as pa
+
+    manifest = manifest or registry.load_manifest(os.path.join(data_dir, 'manifest.json'))
+    version = version or datetime.now().strftime('v%Y%m%dT%H%M%S.%f')
+    if os.path.exists(os.path.join(snapshot_dir, version)):
+        raise FileExistsError(f'Snapshot {version} already exists')
+    os.makedirs(snapshot_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=version + '.', suffix='.tmp', dir=snapshot_dir)
+    os.chmod(tmp, 0o755)                # mkdtemp makes it private; other users' servers read it too
+
+    contents = {'version': version, 'created': datetime.now().isoformat(timespec='seconds'),
+                'datasets': manifest['datasets'], 'tables': {}}
+
+    for entry in manifest['datasets']:
+        for table in entry['tables']:
+            df = registry.load_table(entry, table, data_dir)
+            # A RangeIndex is kept as metadata only; real indexes (station names) are stored as columns
+            arrow_table = pa.Table.from_pandas(df, preserve_index=None)
+
+            relative = _table_file(entry['city'], entry['year'], table)
+            path = os.path.join(tmp, relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Uncompressed IPC files can be memory-mapped without any decoding
+            with pa.OSFile(path, 'wb') as sink:
+                with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+                    writer.write_table(arrow_table)
+
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+
+            contents['tables'][f"{entry['city']}/{entry['year']}/{table}"] = {
+                'file': relative,
+                'rows': arrow_table.num_rows,
+                'columns': arrow_table.schema.names,
+                'sha256': digest,
+            }
+
+    with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+        json.dump(contents, f, indent=2)
+
+    try:
+        os.replace(tmp, os.path.join(snapshot_dir, version))
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return version
+
+
+def validate(version, snapshot_dir=SNAPSHOT_DIR):
+    """Check that every table listed in a snapshot exists and matches its checksum."""
+    folder = os.path.join(snapshot_dir, version)
+    with open(os.path.join(folder, 'manifest.json')) as f:
+        contents = json.load(f)
+
+    for key, info in contents['tables'].items():
+        path = os.path.join(folder, info['file'])
+        if not os.path.exists(path):
+            raise ValueError(f'Snapshot {version} is missing {key}')
+        with open(path, 'rb') as f:
+            if hashlib.sha256(f.read()).hexdigest() != info['sha256']:
+                raise ValueError(f'Snapshot {version} has a corrupt file for {key}')
+    return contents
+
+
+def activate(version, snapshot_dir=SNAPSHOT_DIR):
+    """Make version the snapshot served to new reads.  The switch is a single atomic rename."""
+    validate(version, snapshot_dir)
+    previous = current_version(snapshot_dir)
+    if previous is not None and previous != version:
+        _write_pointer(PREVIOUS, previous, snapshot_dir)
+    _write_pointer(CURRENT, version, snapshot_dir)
+
+
+def _write_pointer(name, version, snapshot_dir):
+    tmp = os.path.join(snapshot_dir, name + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(snapshot_dir, name))
+
+
+def _read_pointer(name, snapshot_dir):
+    try:
+        with open(os.path.join(snapshot_dir, name)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def current_version(snapshot_dir=SNAPSHOT_DIR):
+    """Name of the active snapshot, or None if no snapshot has been activated."""
+    return _read_pointer(CURRENT, snapshot_dir)
+
+
+def versions(snapshot_dir=SNAPSHOT_DIR):
+    if not os.path.isdir(snapshot_dir):
+        return []
+    return sorted(name for name in os.listdir(snapshot_dir)
+                  if name.startswith('v') and not name.endswith('.tmp'))
+
+
+def prune(keep=3, snapshot_dir=SNAPSHOT_DIR):
+    """Delete all but the newest `keep` snapshots, never touching the active one or the one before it."""
+    in_use = {current_version(snapshot_dir), _read_pointer(PREVIOUS, snapshot_dir)}
+    for version in versions(snapshot_dir)[:-keep]:
+        if version not in in_use:
+            shutil.rmtree(os.path.join(snapshot_dir, version), ignore_errors=True)
+
+
+def load_table(version, city, year, table, snapshot_dir=SNAPSHOT_DIR):
+    """Memory-map one table of a snapshot and return it as a DataFrame.
+
+    Numeric columns are backed directly by the mapped file, so the operating
+    system shares them between processes.  Returns None if the snapshot does
+    not contain the table.
+    """
+    import pyarrow as pa
+
+    path = os.path.join(snapshot_dir, version, _table_file(city, year, table))
+    if not os.path.exists(path):
+        return None
+
+    source = pa.memory_map(path, 'r')
+    arrow_table = pa.ipc.open_file(source).read_all()
+    return arrow_table.to_pandas(split_blocks=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and activate aggregate snapshot bundles.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_cmd = commands.add_parser('build', help='pack all registered tables into a new snapshot')
+    build_cmd.add_argument('--activate', action='store_true', help='activate the new snapshot once built')
+    activate_cmd = commands.add_parser('activate', help='switch to an existing snapshot')
+    activate_cmd.add_argument('version')
+    commands.add_parser('list', help='list snapshots, marking the active one')
+    prune_cmd = commands.add_parser('prune', help='delete old snapshots')
+    prune_cmd.add_argument('--keep', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        with build_lock():
+            version = build()
+            print(f'Built snapshot {version}')
+            if args.activate:
+                activate(version)
+                print(f'Activated {version}')
+    elif args.command == 'activate':
+        activate(args.version)
+        print(f'Activated {args.version}')
+    elif args.command == 'list':
+        active = current_version()
+        for version in versions():
+            print(('* ' if version == active else '  ') + version)
+    else:
+        with build_lock():
+            prune(args.keep)
@@ -0,0 +1,175 @@
+####################################################################################
+############################## Station typology ####################################
+####################################################################################
+
+# Page 5 shows the system-wide weekday/weekend profile, but stations differ: a
+# station near homes empties in the morning rush and fills in the evening, one
+# near offices does the opposite, and one by a park is busiest at the weekend.
+#
+# Each station is described by its average departures and arrivals for every
+# hour of a weekday and a weekend day (the 96 columns of the profile store),
+# scaled to shares of its week so that busy and quiet stations with the same
+# rhythm look alike.  The rows are clustered with mini-batch k-means, and each
+# cluster is named from its centre: the morning and evening balance of
+# departures against arrivals separates commuter origins from destinations, and
+# stations busier on a weekend day than on a weekday are leisure stations.
+# Stations with too few trips for a reliable shape are labelled 'Low use'
+# rather than clustered.
+#
+# Several years can be fitted together so the clusters mean the same thing in
+# every year:
+#
+#   python -m citibike.typology --city nyc --year 2021 2022
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from citibike import profiles, registry
+
+
+LABELS = ['Commuter origin', 'Commuter destination', 'Leisure', 'Mixed', 'Low use']
+
+# Departures and arrivals per average day below which a station's shape is mostly noise
+MIN_TRIPS_PER_DAY = 4
+
+MORNING = slice(6, 10)
+EVENING = slice(16, 20)
+
+
+############################ Features ##############################################
+
+def profile_matrix(store):
+    """(stations, 96) hourly profiles as shares of each station's week, and trips per average day.
+
+    Columns run [weekday/weekend][departures/arrivals][hour] as in the profile store.
+    """
+    hourly = np.asarray(store.arrays['hourly'], dtype=np.float64)          # (stations, 2, 2, 24)
+    week = hourly * np.array([5, 2])[None, :, None, None]
+    total = week.sum(axis=(1, 2, 3))
+    shares = week.reshape(len(hourly), -1) / np.where(total > 0, total, 1)[:, None]
+    return shares, total / 7
+
+
+def describe(shares):
+    """Weekend-day over weekday trips, and the weekday morning and evening balance of departures over arrivals."""
+    profile = np.asarray(shares).reshape(-1, 2, 2, 24)
+    weekday = profile[:, 0].sum(axis=(1, 2)) / 5
+    weekend = profile[:, 1].sum(axis=(1, 2)) / 2
+
+    def balance(hours):
+        departures = profile[:, 0, 0, hours].sum(axis=1)
+        arrivals = profile[:, 0, 1, hours].sum(axis=1)
+        return (departures - arrivals) / np.maximum(departures + arrivals, 1e-12)
+
+    return pd.DataFrame({
+        'weekend_ratio': weekend / np.maximum(weekday, 1e-12),
+        'morning_balance': balance(MORNING),
+        'evening_balance': balance(EVENING),
+    })
+
+
+############################ Clustering ############################################
+
+def _nearest(x, centres):
+    # Squared distances without forming the (rows, centres, columns) difference
+    d = (x ** 2).sum(axis=1)[:, None] - 2 * x @ centres.T + (centres ** 2).sum(axis=1)[None, :]
+    return d.argmin(axis=1), d.min(axis=1).clip(min=0)
+
+
+def kmeans(x, k, batch_size=1024, iterations=100, seed=0):
+    """Mini-batch k-means (Sculley 2010) with k-means++ seeding.
+
+    Returns the centres and the cluster of every row.  Each step moves the
+    centres towards a random batch with a per-centre learning rate of 1/count,
+    so the cost per step does not grow with the number of rows.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    k = min(k, n)
+
+    centres = x[[rng.integers(n)]]
+    for _ in range(k - 1):
+        d = _nearest(x, centres)[1]
+        p = d / d.sum() if d.sum() > 0 else None
+        centres = np.vstack([centres, x[rng.choice(n, p=p)]])
+
+    counts = np.zeros(k)
+    for _ in range(iterations):
+        batch = x[rng.choice(n, min(batch_size, n), replace=False)]
+        nearest = _nearest(batch, centres)[0]
+        batch_counts = np.bincount(nearest, minlength=k)
+        sums = np.zeros_like(centres)
+        np.add.at(sums, nearest, batch)
+
+        counts += batch_counts
+        seen = batch_counts > 0
+        rate = (batch_counts[seen] / counts[seen])[:, None]
+        centres[seen] += rate * (sums[seen] / batch_counts[seen][:, None] - centres[seen])
+
+    return centres, _nearest(x, centres)[0]
+
+
+def name_clusters(centres, balance=0.1, weekend_ratio=1.1):
+    """A label for each cluster centre.
+
+    Commuter stations lose bikes at one rush hour and gain them at the other;
+    leisure stations see more trips on an average weekend day than on a weekday.
+    """
+    traits = describe(centres)
+    names = np.full(len(centres), 'Mixed', dtype=object)
+    names[traits['weekend_ratio'] > weekend_ratio] = 'Leisure'
+    names[(traits['morning_balance'] > balance) & (traits['evening_balance'] < -balance)] = 'Commuter origin'
+    names[(traits['morning_balance'] < -balance) & (traits['evening_balance'] > balance)] = 'Commuter destination'
+    return names
+
+
+def classify(stores, k=6, **options):
+    """Cluster the stations of one or more profile stores together; one frame per store.
+
+    Every frame has the station, its cluster and label, trips per average day and
+    the traits the label was read from.
+    """
+    matrices = [profile_matrix(store) for store in stores]
+    shares = np.vstack([m[0] for m in matrices])
+    volume = np.concatenate([m[1] for m in matrices])
+    active = volume >= MIN_TRIPS_PER_DAY
+
+    clusters = np.full(len(shares), -1)
+    labels = np.full(len(shares), 'Low use', dtype=object)
+    if active.sum() >= k:
+        centres, clusters[active] = kmeans(shares[active], k, **options)
+        labels[active] = name_clusters(centres)[clusters[active]]
+
+    table = pd.concat([pd.DataFrame({'station': store.stations}) for store in stores], ignore_index=True)
+    table['cluster'] = clusters
+    table['label'] = pd.Categorical(labels, categories=LABELS)
+    table['trips_per_day'] = volume.round(1)
+    table = pd.concat([table, describe(shares).round(3)], axis=1)
+
+    bounds = np.cumsum([0] + [len(store.stations) for store in stores])
+    return [table.iloc[bounds[i]:bounds[i + 1]].reset_index(drop=True) for i in range(len(stores))]
+
+
+def build(profiles_path, k=6):
+    return classify([profiles.StationProfiles(profiles_path)], k)[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Label stations by their hourly profile for registered city/years.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int, nargs='+', help='years to fit together')
+    parser.add_argument('--clusters', type=int, default=6)
+    args = parser.parse_args()
+
+    manifest = registry.load_manifest()
+    entries = [registry.find(manifest, args.city, year) for year in args.year]
+    stores = [profiles.StationProfiles(profiles.profiles_path(entry)) for entry in entries]
+
+    for entry, table in zip(entries, classify(stores, args.clusters)):
+        table.to_parquet(os.path.join(registry.DATA_DIR, entry['path'], registry.TABLES['typology']), index=False)
+        registry.register(entry['city'], entry['city_name'], entry['year'], entry['path'])
+        counts = table['label'].value_counts()
+        print(f"{entry['year']}: " + ', '.join(f'{n:,} {label.lower()}' for label, n in counts.items() if n))
@@ -0,0 +1,235 @@
+####################################################################################
+############################ Rebalancing zones #####################################
+####################################################################################
+
+# Rebalancing is planned per station, but a truck works an area.  This treats
+# the routes table as a weighted graph (stations as nodes, trips between two
+# stations as edge weights) and splits it into zones of stations that mostly
+# exchange bikes with each other.
+#
+#   zones         Louvain modularity communities of the undirected trip graph.
+#                 The resolution sets how many zones there are: higher gives
+#                 more, smaller zones.
+#   centrality    PageRank over the directed trip graph: where bikes end up
+#                 after many hops, weighted by how often each route is ridden.
+#   zone flows    trips between every pair of zones, from which each zone's
+#                 self-containment and net gain or loss of bikes follow.
+#
+# The graph is held as a scipy sparse matrix, so every step is a sparse
+# product or a scan over one station's row.
+#
+#   python -m citibike.zones --city nyc --year 2022
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from citibike import flows, registry
+
+
+############################ Graph #################################################
+
+def od_matrix(routes):
+    """Stations (with coordinates) and the sparse origin-destination trip matrix between them."""
+    stations = flows.station_table(routes)
+    ids = pd.Series(np.arange(len(stations)), index=stations.index)
+    origin = ids.reindex(routes['start_station_name']).to_numpy()
+    destination = ids.reindex(routes['end_station_name']).to_numpy()
+    trips = routes['trips'].to_numpy(dtype=np.float64)
+    od = sparse.csr_matrix((trips, (origin, destination)), shape=(len(stations), len(stations)))
+    return stations, od
+
+
+def pagerank(od, damping=0.85, tol=1e-10, max_iter=200):
+    """PageRank of every station over the trip-weighted directed graph."""
+    n = od.shape[0]
+    out = np.asarray(od.sum(axis=1)).ravel()
+    transition = sparse.diags(np.divide(1.0, out, out=np.zeros(n), where=out > 0)) @ od
+    dangling = out == 0
+
+    rank = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        new = damping * (transition.T @ rank + rank[dangling].sum() / n) + (1 - damping) / n
+        if np.abs(new - rank).sum() < tol:
+            return new
+        rank = new
+    return rank
+
+
+############################ Communities ###########################################
+
+def _local_moves(graph, resolution, rng):
+    # One Louvain phase: move nodes to the neighbouring community that gains the most modularity
+    # until no move helps.  Returns a community per node, numbered from 0.
+    n = graph.shape[0]
+    degree = np.asarray(graph.sum(axis=1)).ravel()
+    m2 = degree.sum()
+    community = np.arange(n)
+    total = degree.copy()                   # summed degree of each community
+    indptr, indices, weights = graph.indptr, graph.indices, graph.data
+
+    moved = True
+    while moved:
+        moved = False
+        for i in rng.permutation(n):
+            neighbours = indices[indptr[i]:indptr[i + 1]]
+            w = weights[indptr[i]:indptr[i + 1]]
+            not_self = neighbours != i
+            if not not_self.any():
+                continue
+
+            current = community[i]
+            total[current] -= degree[i]
+            candidates, link = np.unique(community[neighbours[not_self]], return_inverse=True)
+            link = np.bincount(link, weights=w[not_self])
+            inside = link[candidates == current].sum()
+
+            gain = link - resolution * degree[i] * total[candidates] / m2
+            stay = inside - resolution * degree[i] * total[current] / m2
+            best = gain.argmax()
+            target = candidates[best] if gain[best] > stay + 1e-12 else current
+
+            total[target] += degree[i]
+            if target != current:
+                community[i] = target
+                moved = True
+
+    return np.unique(community, return_inverse=True)[1]
+
+
+def louvain(graph, resolution=1.0, seed=0):
+    """Louvain communities (Blondel et al. 2008) of a symmetric sparse weight matrix.
+
+    Each level moves nodes between communities, then collapses every community
+    into one node (a sparse product P' W P) and repeats until nothing moves.
+    """
+    rng = np.random.default_rng(seed)
+    graph = sparse.csr_matrix(graph)
+    membership = np.arange(graph.shape[0])
+
+    while True:
+        community = _local_moves(graph, resolution, rng)
+        n_communities = community.max() + 1
+        if n_communities == graph.shape[0]:
+            return membership
+        membership = community[membership]
+        assign = sparse.csr_matrix((np.ones(len(community)), (np.arange(len(community)), community)))
+        graph = (assign.T @ graph @ assign).tocsr()
+
+
+def modularity(graph, membership, resolution=1.0):
+    graph = sparse.csr_matrix(graph)
+    degree = np.asarray(graph.sum(axis=1)).ravel()
+    m2 = degree.sum()
+    assign = sparse.csr_matrix((np.ones(len(membership)), (np.arange(len(membership)), membership)))
+    inside = (assign.T @ graph @ assign).diagonal().sum()
+    totals = assign.T @ degree
+    return inside / m2 - resolution * (totals ** 2).sum() / m2 ** 2
+
+
+############################ Zones #################################################
+
+def zone_stations(stations, od, resolution=1.0, min_size=3):
+    """Zone, PageRank and trips of every station.
+
+    Round trips say nothing about which stations belong together, so the
+    community search runs on the symmetric graph without them.  Zones of fewer
+    than min_size stations are folded into the zone they exchange most trips with.
+    """
+    undirected = (od + od.T).tolil()
+    undirected.setdiag(0)
+    undirected = undirected.tocsr()
+    undirected.eliminate_zeros()
+
+    zone = louvain(undirected, resolution)
+    sizes = np.bincount(zone)
+    for small in np.flatnonzero(sizes < min_size):
+        members = np.flatnonzero(zone == small)
+        assign = sparse.csr_matrix((np.ones(len(zone)), (np.arange(len(zone)), zone)))
+        links = np.asarray((undirected[members] @ assign).sum(axis=0)).ravel()
+        links[small] = 0
+        if links.max() > 0:
+            zone[members] = links.argmax()
+    zone = np.unique(zone, return_inverse=True)[1]
+
+    # Number zones from the busiest down so zone 1 is the heart of the system
+    trips = np.asarray(od.sum(axis=0)).ravel() + np.asarray(od.sum(axis=1)).ravel()
+    order = np.argsort(-np.bincount(zone, weights=trips), kind='stable')
+    zone = np.argsort(order)[zone] + 1
+
+    return pd.DataFrame({
+        'station': stations.index, 'latitude': stations['lat'].to_numpy(), 'longitude': stations['lng'].to_numpy(),
+        'zone': zone, 'pagerank': pagerank(od), 'trips': trips.astype(np.int64),
+    })
+
+
+def zone_flows(station_zones, od):
+    """Trips between every pair of zones, largest first."""
+    zone = station_zones['zone'].to_numpy()
+    assign = sparse.csr_matrix((np.ones(len(zone)), (np.arange(len(zone)), zone - 1)))
+    between = (assign.T @ od @ assign).tocoo()
+    return (pd.DataFrame({'origin_zone': between.row + 1, 'destination_zone': between.col + 1,
+                          'trips': between.data.astype(np.int64)})
+            .sort_values('trips', ascending=False, ignore_index=True))
+
+
+def zone_summary(station_zones, flows_between):
+    """Per zone: stations, trips starting there, share of them staying in the zone, and net bikes gained."""
+    departures = flows_between.groupby('origin_zone')['trips'].sum()
+    arrivals = flows_between.groupby('destination_zone')['trips'].sum()
+    within = flows_between['origin_zone'] == flows_between['destination_zone']
+    internal = flows_between[within].set_index('origin_zone')['trips']
+    by_zone = station_zones.groupby('zone')
+    hubs = station_zones.loc[by_zone['pagerank'].idxmax()].set_index('zone')['station']
+    summary = pd.DataFrame({
+        'stations': by_zone.size(),
+        'hub': hubs,
+        'departures': departures,
+        'self_contained': (internal.reindex(departures.index, fill_value=0) / departures).round(3),
+        'net_bikes': arrivals.reindex(departures.index, fill_value=0) - departures,
+    })
+    summary.index.name = 'zone'
+    return summary
+
+
+def outlines(station_zones):
+    """Convex hull of each zone's stations as a closed [lng, lat] ring, for drawing zone boundaries."""
+    from scipy.spatial import ConvexHull, QhullError
+
+    rings = []
+    for zone, group in station_zones.groupby('zone'):
+        points = group[['longitude', 'latitude']].to_numpy(dtype=np.float64)
+        if len(points) < 3:
+            continue
+        try:
+            hull = ConvexHull(points)
+        except QhullError:
+            continue                        # all stations on one line
+        ring = points[hull.vertices]
+        rings.append({'zone': zone, 'polygon': np.vstack([ring, ring[:1]]).round(5).tolist()})
+    return pd.DataFrame(rings, columns=['zone', 'polygon'])
+
+
+def build(routes, resolution=1.0):
+    stations, od = od_matrix(routes)
+    station_zones = zone_stations(stations, od, resolution)
+    return station_zones, zone_flows(station_zones, od)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split the station graph into rebalancing zones for a registered city/year.')
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--year', required=True, type=int)
+    parser.add_argument('--resolution', type=float, default=1.0, help='higher gives more, smaller zones')
+    args = parser.parse_args()
+
+    entry = registry.find(registry.load_manifest(), args.city, args.year)
+    station_zones, flows_between = build(registry.load_table(entry, 'routes'), args.resolution)
+    partition = os.path.join(registry.DATA_DIR, entry['path'])
+    station_zones.to_parquet(os.path.join(partition, registry.TABLES['zones']), index=False)
+    flows_between.to_parquet(os.path.join(partition, registry.TABLES['zone_flows']), index=False)
+    registry.register(entry['city'], entry['city_name'], entry['year'], entry['path'])
+    print(zone_summary(station_zones, flows_between).to_string())